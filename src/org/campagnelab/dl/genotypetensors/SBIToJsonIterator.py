@@ -1,4 +1,6 @@
 import argparse
+import math
+import shutil
 import threading
 
 import os
@@ -6,10 +8,131 @@ import ujson
 import subprocess
 import sys
 
+import numpy
+
+# command used to convert sbi records to json, followed by the memory size:
+SBI_TO_JSON_COMMAND = ["sbi-to-json.sh"]
+# option of the command that sets the index of the first record to convert. Sharded extraction requires a command
+# that supports it, see command_supports_option:
+START_INDEX_OPTION = "--start-index"
+
+
+def sbi_num_records(sbi_path):
+    """
+    Return the number of records of an sbi file, read from its .sbip properties, or None when not available.
+    """
+    try:
+        with open(os.path.splitext(sbi_path)[0] + ".sbip") as properties:
+            for line in properties:
+                key, separator, value = line.partition("=")
+                if separator and key.strip() == "numRecords":
+                    return int(value.strip())
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def command_supports_option(command, option, mem="3g"):
+    """
+    Return True when the usage printed by a conversion command for --help mentions option. Commands that ignore an
+    unknown option would convert the wrong records without failing, so options are checked before they are used.
+    """
+    try:
+        usage = subprocess.run(list(command) + [mem, "--help"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                               timeout=300).stdout
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+    return option.encode() in usage
+
+
+def extract_json_cache_sharded(sbi_path, json_path, num_records, num_shards, mem="3g", sort=False,
+                               include_frequencies=False, command=SBI_TO_JSON_COMMAND):
+    """
+    Write the json cache of an sbi file with num_shards conversion processes, each converting a contiguous range of
+    records. The outputs of the processes are consumed concurrently into one file per shard, then concatenated in
+    record order and indexed (see load_json_cache_index). The command must support START_INDEX_OPTION (see
+    command_supports_option), otherwise every shard would convert the first records of the file.
+    """
+    shard_size = int(math.ceil(num_records / num_shards))
+    shards = [(start, min(shard_size, num_records - start)) for start in range(0, num_records, shard_size)]
+    shard_paths = ["{}.shard-{}".format(json_path, shard_index) for shard_index in range(len(shards))]
+    shard_commands = []
+    for start, length in shards:
+        shard_command = list(command) + [mem, "-i", sbi_path, "-n", str(length), START_INDEX_OPTION, str(start)]
+        if sort:
+            shard_command.append("--sort")
+        if include_frequencies:
+            shard_command.append("--include-frequency")
+        shard_commands.append(shard_command)
+    num_written = [0] * len(shards)
+
+    def copy_output(shard_index, process):
+        with open(shard_paths[shard_index], "wb") as shard_file:
+            for line in process.stdout:
+                if line.lstrip().startswith(b"{"):
+                    shard_file.write(line if line.endswith(b"\n") else line + b"\n")
+                    num_written[shard_index] += 1
+        process.stdout.close()
+        process.wait()
+
+    try:
+        processes = [subprocess.Popen(shard_command, stdout=subprocess.PIPE, bufsize=4096 * 30)
+                     for shard_command in shard_commands]
+        threads = [threading.Thread(target=copy_output, args=(shard_index, process),
+                                    name="SbiToJson-shard-{}".format(shard_index))
+                   for shard_index, process in enumerate(processes)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for shard_command, process, (start, length), written in zip(shard_commands, processes, shards, num_written):
+            if process.returncode != 0 or written != length:
+                raise subprocess.CalledProcessError(process.returncode, shard_command)
+        temp_path = "{}.{}.tmp".format(json_path, os.getpid())
+        with open(temp_path, "wb") as json_cache:
+            for shard_path in shard_paths:
+                with open(shard_path, "rb") as shard_file:
+                    shutil.copyfileobj(shard_file, json_cache)
+        os.replace(temp_path, json_path)
+    finally:
+        for shard_path in shard_paths:
+            if os.path.isfile(shard_path):
+                os.remove(shard_path)
+    load_json_cache_index(json_path)
+
+
+def load_json_cache_index(json_path):
+    """
+    Load the byte offsets of the records of a json cache. The offsets are stored in a sidecar file next to the
+    cache (json_path + ".idx"), built on first use and rebuilt when the cache is newer than the index.
+    :return: numpy int64 array of shape (num_records, 2) with the start and end offset of each record.
+    """
+    index_path = json_path + ".idx"
+    if not os.path.isfile(index_path) or os.path.getmtime(index_path) < os.path.getmtime(json_path):
+        offsets = []
+        position = 0
+        with open(json_path, "rb") as json_cache:
+            for line in json_cache:
+                if line.lstrip().startswith(b"{"):
+                    offsets.append((position, position + len(line)))
+                position += len(line)
+        # write to a temporary file first, so that concurrent readers never see a partial index:
+        temp_path = "{}.{}.tmp".format(index_path, os.getpid())
+        numpy.array(offsets, dtype=numpy.int64).reshape(-1, 2).tofile(temp_path)
+        os.replace(temp_path, index_path)
+    return numpy.fromfile(index_path, dtype=numpy.int64).reshape(-1, 2)
+
 
 class SbiToJsonGenerator:
     def __init__(self, sbi_path, num_records=sys.maxsize, mem="3g", sort=False, include_frequencies=False,
-                 use_cache=True):
+                 use_cache=True, num_shards=1, command=SBI_TO_JSON_COMMAND):
+        """
+        :param num_shards: number of conversion processes used to create the json cache. Requires the number of
+        records of the sbi file (from its .sbip properties) and a command that supports START_INDEX_OPTION. A
+        single process is used otherwise, with a warning.
+        :param command: command that converts sbi records to json (sbi-to-json.sh or a stand-in, see
+        SbiToJsonStandIn.py).
+        """
         self.sbi_path = sbi_path
         self.num_records = num_records
         self.mem = mem
@@ -21,7 +144,10 @@ class SbiToJsonGenerator:
         self.json_path = self.sbi_path + "_json_cache.json"
         self.cache_exists = os.path.isfile(self.json_path)
         self.json_cache = None
-        self.print_json_from_sbi_command = ["sbi-to-json.sh", self.mem, "-i", self.sbi_path, "-n",
+        # random access to the cache, see record_at:
+        self.record_offsets = None
+        self.json_cache_fd = None
+        self.print_json_from_sbi_command = list(command) + [self.mem, "-i", self.sbi_path, "-n",
                                             str(self.num_records)]
         if self.sort:
             self.print_json_from_sbi_command.append("--sort")
@@ -29,14 +155,21 @@ class SbiToJsonGenerator:
             self.print_json_from_sbi_command.append("--include-frequency")
         if self.use_cache:
             if not self.cache_exists:
+                sharded = num_shards > 1 and self.supports_sharding(command)
                 try:
                     print("Caching sbi to json in progress..")
-                    subprocess.run(self.print_json_from_sbi_command + ["-o"], stdout=subprocess.DEVNULL)
+                    if sharded:
+                        extract_json_cache_sharded(self.sbi_path, self.json_path,
+                                                   num_records=min(self.num_records, sbi_num_records(sbi_path)),
+                                                   num_shards=num_shards, mem=self.mem, sort=self.sort,
+                                                   include_frequencies=self.include_frequencies, command=command)
+                    else:
+                        subprocess.run(self.print_json_from_sbi_command + ["-o"], stdout=subprocess.DEVNULL)
                     print("Caching sbi to json done.")
                     self.cache_exists = True
                     generated_cache = True
-                except subprocess.CalledProcessError:
-                    print("Unable to cache; running without cache instead")
+                except subprocess.CalledProcessError as error:
+                    print("Unable to cache ({}); running without cache instead".format(error), file=sys.stderr)
                     self.use_cache = False
                     generated_cache = False
             else:
@@ -46,9 +179,44 @@ class SbiToJsonGenerator:
         if not self.use_cache:
             self.process = subprocess.Popen(self.print_json_from_sbi_command, stdout=subprocess.PIPE, bufsize=4096*30)
 
+    def supports_sharding(self, command):
+        """Return True when the json cache can be extracted in shards, print a warning otherwise."""
+        if sbi_num_records(self.sbi_path) is None:
+            print("Warning: {} has no numRecords property, converting to json with a single process."
+                  .format(self.sbi_path), file=sys.stderr)
+            return False
+        if not command_supports_option(command, START_INDEX_OPTION, self.mem):
+            print("Warning: {} does not support {}, converting to json with a single process."
+                  .format(" ".join(command), START_INDEX_OPTION), file=sys.stderr)
+            return False
+        return True
+
     def __enter__(self):
         return self
 
+    def __len__(self):
+        """Number of records available for random access. Requires the json cache."""
+        return min(self.num_records, len(self.offsets()))
+
+    def offsets(self):
+        if self.record_offsets is None:
+            assert self.use_cache, "random access requires the json cache."
+            self.record_offsets = load_json_cache_index(self.json_path)
+        return self.record_offsets
+
+    def record_at(self, index):
+        """
+        Read and decode the record at index from the json cache. Reads use os.pread and do not move a shared file
+        position, so that threads and forked DataLoader workers can read records concurrently.
+        """
+        offsets = self.offsets()
+        assert 0 <= index < len(self), "index {} out of json cache bounds {} {}.".format(index, 0, len(self))
+        if self.json_cache_fd is None:
+            self.json_cache_fd = os.open(self.json_path, os.O_RDONLY)
+        start, end = offsets[index]
+        line = os.pread(self.json_cache_fd, int(end - start), int(start))
+        return ujson.loads(line.decode().strip(), precise_float=True)
+
     def __iter__(self):
         if not self.use_cache:
             for sbi_json_out in self.process.stdout:
@@ -73,10 +241,18 @@ class SbiToJsonGenerator:
         else:
             self.json_cache.close()
         self.closed = True
+        self.close_random_access()
+
+    def close_random_access(self):
+        if self.json_cache_fd is not None:
+            os.close(self.json_cache_fd)
+            self.json_cache_fd = None
 
     def close(self):
         if not self.closed:
             self.__exit__()
+        # record_at may have reopened the cache after the generator was closed:
+        self.close_random_access()
 
 
 def sbi_json_generator(sbi_path, num_records=sys.maxsize, mem="3g", sort=False):
@@ -0,0 +1,42 @@
+"""
+Stand-in for sbi-to-json.sh that reads "sbi" files holding one json record per line. Accepts the options used by
+SbiToJsonGenerator, so that json caching (including sharded extraction) can be tested without the Java toolchain:
+
+    SbiToJsonGenerator(sbi_path, command=[sys.executable, "SbiToJsonStandIn.py"], num_shards=4)
+"""
+import argparse
+import sys
+
+import ujson
+
+
+def sort_counts(record):
+    for sample in record["samples"]:
+        sample["counts"].sort(key=lambda count: -(count["genotypeCountForwardStrand"] +
+                                                  count["genotypeCountReverseStrand"]))
+    return record
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("mem", type=str, help="Max heap size (ignored).")
+    argparser.add_argument("-i", "--input-file", type=str, required=True, help="Input file, one json record per line.")
+    argparser.add_argument("-n", "--num-records", type=int, default=sys.maxsize, help="Number of records to export.")
+    argparser.add_argument("--start-index", type=int, default=0, help="Index of the first record to export.")
+    argparser.add_argument("--sort", action="store_true", help="Sort counts in each record by decreasing count.")
+    argparser.add_argument("--include-frequency", action="store_true", help="Ignored, records are exported as is.")
+    argparser.add_argument("-o", "--output-cache", action="store_true",
+                           help="Write the records to the json cache of the input instead of stdout.")
+    args = argparser.parse_args()
+
+    output = open(args.input_file + "_json_cache.json", "w") if args.output_cache else sys.stdout
+    with open(args.input_file) as input_file:
+        for index, line in enumerate(input_file):
+            if index >= args.start_index + args.num_records:
+                break
+            if index >= args.start_index:
+                record = ujson.loads(line)
+                if args.sort:
+                    record = sort_counts(record)
+                output.write(ujson.dumps(record) + "\n")
+    output.close()
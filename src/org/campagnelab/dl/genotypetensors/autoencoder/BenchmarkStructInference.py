@@ -0,0 +1,92 @@
+'''Compare the CPU inference throughput of a structured genotyping model, executed eagerly or traced.'''
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+from org.campagnelab.dl.genotypetensors.autoencoder.struct_genotyping_supervised_trainer import trace_struct_model
+from org.campagnelab.dl.problems.StructuredSbiProblem import StructuredSbiGenotypingProblem
+
+parser = argparse.ArgumentParser(description='Compare eager and traced CPU inference of a structured genotyping '
+                                             'model.')
+parser.add_argument('--mini-batch-size', type=int, help='Size of the mini-batch.', default=128)
+parser.add_argument('-n', type=int, help='number of examples to predict.', default=10000)
+parser.add_argument('--checkpoint-key', help='Random key to load a checkpoint model', required=True)
+parser.add_argument('--model-path', help='Path of where the models directory is located.', default=".")
+parser.add_argument('--model-label', help='Model label: best or latest.', default="best")
+parser.add_argument('--problem', default="struct_genotyping:basename", type=str,
+                    help='The problem, struct_genotyping:basename')
+parser.add_argument('--repeat', default=3, type=int, help="Number of passes over the batches for each mode.")
+parser.add_argument('--max-sequence-length', default=32, type=int,
+                    help="Number of bases of the from and to sequences of the padded batches. Batches with longer "
+                         "sequences run eagerly.")
+parser.add_argument('--export', default=None, type=str,
+                    help="Save the traced model to this file, when the installed pytorch can save traced modules.")
+
+args = parser.parse_args()
+
+print('==> Loading model from checkpoint..')
+checkpoint_filename = '{}/models/pytorch_{}_{}.t7'.format(args.model_path, args.checkpoint_key, args.model_label)
+if not os.path.isfile(checkpoint_filename):
+    print("Unable to load model {} from checkpoint".format(args.checkpoint_key))
+    exit(1)
+model = torch.load(checkpoint_filename, map_location=lambda storage, location: storage)['model']
+model.cpu()
+for module in model.modules():
+    if hasattr(module, "use_cuda"):
+        module.use_cuda = False
+model.eval()
+
+problem = StructuredSbiGenotypingProblem(args.mini_batch_size, code=args.problem, drop_last_batch=False)
+batches = []
+for _, data_map in problem.validation_loader_range(0, args.n):
+    batches.append(data_map["sbi"])
+if len(batches) == 0:
+    print("no examples, aborting")
+    exit(1)
+num_examples = sum(len(records) for records in batches)
+
+# struct models map one sample per record, batches are padded to the mini-batch size:
+traced, tensor_model = trace_struct_model(model, batches[0], max_samples=args.mini_batch_size,
+                                          max_sequence_length=args.max_sequence_length)
+mapper = model.sbi_mapper.mappers.mapper_for_type("SampleInfo")
+tensorizer = mapper.create_tensorizer()
+
+start = time.time()
+tensors = [tensorizer(records) for records in batches]
+tensorize_time = time.time() - start
+inputs = [tensor_model.inputs(batch_tensors) for batch_tensors in tensors]
+
+
+def examples_per_second(forward, batches, setup_time=0):
+    start = time.time()
+    for _ in range(args.repeat):
+        for batch in batches:
+            forward(batch)
+    return num_examples * args.repeat / (time.time() - start + setup_time)
+
+
+max_difference = max((tensor_model(*batch_inputs) - traced(batch_tensors)).abs().max().data[0]
+                     for batch_inputs, batch_tensors in zip(inputs, tensors))
+print("examples: {} in {} batches, tensorized at {:.1f} examples/s".format(num_examples, len(batches),
+                                                                          num_examples / tensorize_time))
+print("eager:  {:.1f} examples/s".format(examples_per_second(lambda batch_inputs: tensor_model(*batch_inputs),
+                                                            inputs)))
+# the traced throughput includes padding the batches and tracing the model:
+print("traced: {:.1f} examples/s, including {:.1f}s of tracing".format(
+    examples_per_second(traced, tensors, setup_time=traced.trace_time), traced.trace_time))
+print("batches that did not fit {} samples and sequences of {} bases, run eagerly: {}".format(
+    args.mini_batch_size, args.max_sequence_length, traced.eager_batches))
+print("max difference between eager and traced outputs: {:.3E}".format(max_difference))
+
+if args.export is not None:
+    if hasattr(torch.jit, "save"):
+        torch.jit.save(traced.trace, args.export)
+        print("Traced model saved to {}, it maps batches padded with SbiTensorizer.pad(tensors, {}, {}).".format(
+            args.export, args.mini_batch_size, args.max_sequence_length))
+    else:
+        print("This version of pytorch cannot save traced modules.", file=sys.stderr)
@@ -147,6 +147,32 @@ def define_train_auto_encoder_parser():
     parser.add_argument('--struct-sample-dim', type=int, default=64, help="Dimensionality of the reduced sample tensor (used with struct_genotyping only).")
     parser.add_argument("--struct-ploidy", type=int, default=2, help="Ploidy to use for structured mapping")
     parser.add_argument("--struct-extra-genotypes", type=int, default=2, help="Number of extra genotypes to use for structured mapping")
+    parser.add_argument("--checkpoint-every-n-batches", type=int, default=None,
+                        help="Save the latest model and the position of the data pipeline every n training batches, "
+                             "so that --resume continues in the middle of an interrupted epoch.")
+    parser.add_argument("--prefetch-memory-budget", type=int, default=None,
+                        help="Number of bytes the prefetched training batches may use. When set, the depth of the "
+                             "prefetch queues is adjusted at runtime from the producer and consumer rates.")
+    parser.add_argument("--sbi-extraction-shards", type=int, default=1,
+                        help="Number of processes used to convert sbi files to json when they are first read "
+                             "(used with struct_genotyping only). Values above 1 require a sbi-to-json.sh that "
+                             "supports --start-index, and the numRecords property of the sbi files, a single process "
+                             "is used otherwise.")
+    parser.add_argument("--struct-batch-budget", type=int, default=None,
+                        help="When set, batch sbi records of similar lengths together, with at most this many counts, "
+                             "NumberWithFrequency elements and bases per batch (used with struct_genotyping only).")
+    parser.add_argument("--struct-sequence-memo-size", type=int, default=100000,
+                        help="Number of mapped sequences memoized when evaluating struct_genotyping models, "
+                             "0 to disable.")
+    parser.add_argument("--struct-count-memo-size", type=int, default=0,
+                        help="Number of mapped counts memoized when evaluating struct_genotyping models, "
+                             "0 to disable.")
+    parser.add_argument("--struct-sparse-embeddings", action="store_true",
+                        help="Use sparse gradients for the embeddings of counts and NumberWithFrequency lists, "
+                             "updated with SparseAdam when the optimizer is Adam (used with struct_genotyping only).")
+    parser.add_argument("--struct-log-buckets", action="store_true",
+                        help="Embed genotype counts and the numbers of NumberWithFrequency lists by log-scale bucket, "
+                             "instead of one embedding row per value (used with struct_genotyping only).")
     return parser
 
 def configure_model_trainer(train_args, train_problem,train_use_cuda,class_frequencies=None):
@@ -51,12 +51,16 @@ if __name__ == '__main__':
     start_epoch = 0  # start from epoch 0 or last checkpoint epoch
     problem = None
     if args.problem.startswith("genotyping:"):
-        problem = SbiGenotypingProblem(args.mini_batch_size, code=args.problem, num_workers=args.num_workers)
+        problem = SbiGenotypingProblem(args.mini_batch_size, code=args.problem, num_workers=args.num_workers,
+                                       seed=args.seed)
     elif args.problem.startswith("struct_genotyping:"):
-        # struct_genotyping does not support multiprocessing data loading:
-        problem = StructuredSbiGenotypingProblem(args.mini_batch_size, code=args.problem, num_workers=1)
+        # loaders fall back to a single process when the sbi records cannot be read in random order:
+        problem = StructuredSbiGenotypingProblem(args.mini_batch_size, code=args.problem, num_workers=args.num_workers,
+                                                 seed=args.seed, extraction_shards=args.sbi_extraction_shards,
+                                                 batch_budget=args.struct_batch_budget)
     elif args.problem.startswith("somatic:"):
-        problem = SbiSomaticProblem(args.mini_batch_size, code=args.problem, num_workers=args.num_workers)
+        problem = SbiSomaticProblem(args.mini_batch_size, code=args.problem, num_workers=args.num_workers,
+                                    seed=args.seed)
     else:
         print("Unsupported problem: " + args.problem)
         exit(1)
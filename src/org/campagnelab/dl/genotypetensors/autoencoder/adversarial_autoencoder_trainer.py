@@ -4,12 +4,13 @@ from scipy.stats import norm
 from torchnet.meter import ConfusionMeter
 
 from org.campagnelab.dl.genotypetensors.autoencoder.common_trainer import CommonTrainer, recode_for_label_smoothing
-from org.campagnelab.dl.multithreading.sequential_implementation import MultiThreadedCpuGpuDataProvider
+from org.campagnelab.dl.multithreading.sequential_implementation import MultiThreadedCpuGpuDataProvider, \
+    MultiplexedDataProvider
 from org.campagnelab.dl.performance.AccuracyHelper import AccuracyHelper
 from org.campagnelab.dl.performance.FloatHelper import FloatHelper
 from org.campagnelab.dl.performance.LossHelper import LossHelper
 from org.campagnelab.dl.performance.PerformanceList import PerformanceList
-from org.campagnelab.dl.utils.utils import progress_bar, normalize_mean_std, draw_from_gaussian
+from org.campagnelab.dl.utils.utils import progress_bar, draw_from_gaussian
 
 
 class AdversarialAutoencoderTrainer(CommonTrainer):
@@ -23,7 +24,6 @@ class AdversarialAutoencoderTrainer(CommonTrainer):
         self.discriminator_cat_opt = None
         self.optimizers = []
         self.use_pdf = args.use_density_weights
-        self.normalize_inputs = None
         self.schedulers = None
 
     def get_test_metric_name(self):
@@ -79,13 +79,6 @@ class AdversarialAutoencoderTrainer(CommonTrainer):
         for optimizer in self.optimizers:
             self.schedulers += [self.create_scheduler_for_optimizer(optimizer)]
 
-        if self.args.normalize:
-            problem_mean = self.problem.load_tensor("input", "mean")
-            problem_std = self.problem.load_tensor("input", "std")
-
-        self.normalize_inputs = lambda x: normalize_mean_std(x, problem_mean=problem_mean,
-                                                             problem_std=problem_std) if self.args.normalize else x
-
     def train_one_batch(self, performance_estimators, batch_idx, input_s, target_s, meta_data, input_u):
 
         self.zero_grad_all_optimizers()
@@ -179,19 +172,19 @@ class AdversarialAutoencoderTrainer(CommonTrainer):
 
         unsupervised_loss_acc = 0
         num_batches = 0
-        train_loader_subset = self.problem.train_loader_subset_range(0, self.args.num_training)
-        unlabeled_loader = self.problem.unlabeled_loader()
+        train_loader_subset = self.problem.train_loader_subset_range(0, self.args.num_training,
+                                                                     sampler_state=self.sampler_state_for("training", epoch))
+        unlabeled_loader = self.problem.unlabeled_loader(sampler_state=self.sampler_state_for("unlabeled", epoch))
 
-        data_provider = MultiThreadedCpuGpuDataProvider(
-            iterator=zip(train_loader_subset, unlabeled_loader),
+        data_provider = MultiplexedDataProvider(
+            iterators=[train_loader_subset, unlabeled_loader],
             is_cuda=self.use_cuda,
+            memory_budget=self.prefetch_memory_budget,
+            pipeline_helper=self.training_pipeline_helper,
             batch_names=["training", "unlabeled"],
             requires_grad={"training": ["input"], "unlabeled": ["input"]},
             volatile={"training": ["metaData"], "unlabeled": []},
-            recode_functions={
-                "softmaxGenotype": lambda x: recode_for_label_smoothing(x, self.epsilon),
-                "input": self.normalize_inputs
-            })
+            transforms=self.create_transforms())
 
 
         self.reset_before_train_epoch()
@@ -204,6 +197,7 @@ class AdversarialAutoencoderTrainer(CommonTrainer):
                 num_batches += 1
                 self.train_one_batch( performance_estimators, batch_idx, input_s, target_s, meta_data, input_u)
 
+                self.checkpoint_data_pipeline_if_needed(batch_idx, data_provider, epoch)
                 if ((batch_idx + 1) * self.mini_batch_size) > self.max_training_examples:
                     break
         finally:
@@ -260,9 +254,7 @@ class AdversarialAutoencoderTrainer(CommonTrainer):
                                                         requires_grad={"validation": []},
                                                         volatile={"validation": ["input", "softmaxGenotype"],
                                                                   },
-                                                        recode_functions={
-                                                            "input": self.normalize_inputs
-                                                        })
+                                                        transforms=self.create_transforms(label_smoothing_epsilon=0))
         self.reset_before_test_epoch()
         errors=None
         try:
@@ -4,13 +4,14 @@ import torch
 from torch.autograd import Variable
 from scipy.stats import norm
 
-from org.campagnelab.dl.genotypetensors.autoencoder.common_trainer import CommonTrainer, recode_for_label_smoothing
-from org.campagnelab.dl.multithreading.sequential_implementation import MultiThreadedCpuGpuDataProvider
+from org.campagnelab.dl.genotypetensors.autoencoder.common_trainer import CommonTrainer
+from org.campagnelab.dl.multithreading.sequential_implementation import MultiThreadedCpuGpuDataProvider, \
+    MultiplexedDataProvider
 from org.campagnelab.dl.performance.AccuracyHelper import AccuracyHelper
 from org.campagnelab.dl.performance.FloatHelper import FloatHelper
 from org.campagnelab.dl.performance.LossHelper import LossHelper
 from org.campagnelab.dl.performance.PerformanceList import PerformanceList
-from org.campagnelab.dl.utils.utils import progress_bar, normalize_mean_std
+from org.campagnelab.dl.utils.utils import progress_bar
 from random import *
 
 
@@ -25,7 +26,6 @@ class AdversarialCrossencoderTrainer(CommonTrainer):
         self.discriminator_cat_opt = None
         self.optimizers = []
         self.use_pdf = args.use_density_weights
-        self.normalize_inputs = None
         self.schedulers = None
 
     def get_test_metric_name(self):
@@ -63,13 +63,6 @@ class AdversarialCrossencoderTrainer(CommonTrainer):
         for optimizer in self.optimizers:
             self.schedulers += [self.create_scheduler_for_optimizer(optimizer)]
 
-        if self.args.normalize:
-            problem_mean = self.problem.load_tensor("input", "mean")
-            problem_std = self.problem.load_tensor("input", "std")
-
-        self.normalize_inputs = lambda x: normalize_mean_std(x, problem_mean=problem_mean,
-                                                             problem_std=problem_std) if self.args.normalize else x
-
     def train_semisup_aae(self, epoch,
                           performance_estimators=None):
         if performance_estimators is None:
@@ -90,19 +83,20 @@ class AdversarialCrossencoderTrainer(CommonTrainer):
 
         unsupervised_loss_acc = 0
         num_batches = 0
-        train_loader_subset1 = self.problem.train_loader_subset_range(0, self.args.num_training)
-        train_loader_subset2 = self.problem.train_loader_subset_range(0, self.args.num_training)
+        train_loader_subset1 = self.problem.train_loader_subset_range(0, self.args.num_training,
+                                                                      sampler_state=self.sampler_state_for("training1", epoch))
+        train_loader_subset2 = self.problem.train_loader_subset_range(0, self.args.num_training,
+                                                                      sampler_state=self.sampler_state_for("training2", epoch))
 
-        data_provider = MultiThreadedCpuGpuDataProvider(
-            iterator=zip(train_loader_subset1, train_loader_subset2),
+        data_provider = MultiplexedDataProvider(
+            iterators=[train_loader_subset1, train_loader_subset2],
             is_cuda=self.use_cuda,
+            memory_budget=self.prefetch_memory_budget,
+            pipeline_helper=self.training_pipeline_helper,
             batch_names=["training1", "training2"],
             requires_grad={"training1": ["input"], "training2": ["input"]},
             volatile={"training1": ["metaData"], "training2": ["metaData"]},
-            recode_functions={
-                "softmaxGenotype": recode_for_label_smoothing,
-                "input": self.normalize_inputs
-            })
+            transforms=self.create_transforms(label_smoothing_epsilon=0.2))
 
         indel_weight = self.args.indel_weight_factor
         snp_weight = 1.0
@@ -175,6 +169,7 @@ class AdversarialCrossencoderTrainer(CommonTrainer):
                     progress_bar(batch_idx * self.mini_batch_size, self.max_training_examples,
                              performance_estimators.progress_message(
                                  ["reconstruction_loss", "discriminator_loss", "generator_loss", "semisup_loss"]))
+                self.checkpoint_data_pipeline_if_needed(batch_idx, data_provider, epoch)
                 if ((batch_idx + 1) * self.mini_batch_size) > self.max_training_examples:
                     break
         finally:
@@ -218,9 +213,7 @@ class AdversarialCrossencoderTrainer(CommonTrainer):
                                                         requires_grad={"validation": []},
                                                         volatile={"validation": ["input", "softmaxGenotype"],
                                                                   },
-                                                        recode_functions={
-                                                            "input": self.normalize_inputs
-                                                        })
+                                                        transforms=self.create_transforms(label_smoothing_epsilon=0))
         self.net.eval()
         try:
             for batch_idx, (_, data_dict) in enumerate(data_provider):
@@ -1,13 +1,17 @@
 import os
 import sys
 import threading
+import zlib
 
 import torch
 from torch.autograd import Variable
 from torch.backends import cudnn
-from torch.nn import MSELoss, CrossEntropyLoss, MultiLabelSoftMarginLoss
+from torch.nn import MSELoss, CrossEntropyLoss, MultiLabelSoftMarginLoss, Embedding
+from torch.optim import Optimizer
 
 from org.campagnelab.dl.multithreading.sequential_implementation import MultiThreadedCpuGpuDataProvider
+from org.campagnelab.dl.multithreading.transforms import TransformPipeline, Normalize, LabelSmoothing, MixupPairing
+from org.campagnelab.dl.performance.DataPipelineHelper import DataPipelineHelper
 from org.campagnelab.dl.performance.LRHelper import LearningRateHelper
 from org.campagnelab.dl.performance.PerformanceList import PerformanceList
 from org.campagnelab.dl.utils.LRSchedules import construct_scheduler
@@ -47,6 +51,45 @@ def print_params(epoch, net):
     print("epoch=" + str(epoch) + " " + " ".join(map(str, params)))
 
 
+def sparse_embedding_parameters(model):
+    """Return the weights of the embeddings of model that produce sparse gradients."""
+    return [module.weight for module in model.modules() if isinstance(module, Embedding) and module.sparse]
+
+
+class DenseSparseOptimizer(Optimizer):
+    """
+    Steps two optimizers together: one for the parameters with dense gradients, the other for the parameters
+    with sparse gradients (e.g., Adam and SparseAdam). The param_groups of both optimizers are exposed, so that
+    learning rate schedules apply to both.
+    """
+
+    def __init__(self, dense_optimizer, sparse_optimizer):
+        # Optimizer.__init__ is not called, the parameters are registered with the delegate optimizers:
+        self.optimizers = [dense_optimizer, sparse_optimizer]
+        self.defaults = dense_optimizer.defaults
+        self.param_groups = dense_optimizer.param_groups + sparse_optimizer.param_groups
+        self.state = {}
+
+    def zero_grad(self):
+        for optimizer in self.optimizers:
+            optimizer.zero_grad()
+
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            loss = closure()
+        for optimizer in self.optimizers:
+            optimizer.step()
+        return loss
+
+    def state_dict(self):
+        return {"optimizers": [optimizer.state_dict() for optimizer in self.optimizers]}
+
+    def load_state_dict(self, state_dict):
+        for optimizer, optimizer_state in zip(self.optimizers, state_dict["optimizers"]):
+            optimizer.load_state_dict(optimizer_state)
+
+
 class CommonTrainer:
     """
     Common code to train and test models and log their performance.
@@ -76,6 +119,17 @@ class CommonTrainer:
         self.best_test_loss = sys.maxsize if not self.is_better(1, 0) else -1
         self.start_epoch = 0
         self.use_cuda = use_cuda
+        self.prefetch_memory_budget = args.prefetch_memory_budget if hasattr(args, "prefetch_memory_budget") else None
+        self.checkpoint_every_n_batches = (args.checkpoint_every_n_batches
+                                           if hasattr(args, "checkpoint_every_n_batches") else None)
+        # cursor state of the data pipeline to resume from, when resuming in the middle of an epoch:
+        self.resume_data_pipeline = None
+        # sampler state used for each source of the current epoch:
+        self.epoch_sampler_states = {}
+        # normalization of the input, loaded lazily by create_transforms:
+        self.input_normalization = None
+        # time spent in each stage of the training data pipeline:
+        self.training_pipeline_helper = DataPipelineHelper(prefix="train_")
         self.mini_batch_size = problem.mini_batch_size()
         self.net = None
         self.optimizer_training = None
@@ -144,6 +198,19 @@ class CommonTrainer:
             else:
                 print("Could not load model checkpoint, unable to --resume.")
                 model_built = False
+            latest = None
+            try:
+                latest = torch.load('./models/pytorch_{}_{}.t7'.format(args.checkpoint_key, "latest"))
+            except FileNotFoundError:
+                pass
+            if latest is not None and latest.get('data_pipeline') is not None:
+                # training was interrupted in the middle of an epoch, continue from where it stopped:
+                self.net = latest['model']
+                self.resume_data_pipeline = latest['data_pipeline']
+                self.start_epoch = self.resume_data_pipeline['epoch']
+                print("Resuming epoch {} after examples {}".format(self.start_epoch,
+                                                                   self.resume_data_pipeline['positions']))
+                model_built = True
 
         if not model_built:
             print('==> Building model...')
@@ -163,6 +230,9 @@ class CommonTrainer:
         self.scheduler_train = self.create_scheduler_for_optimizer(self.optimizer_training)
 
     def get_default_optimizer_training(self, model, optimizer_name, opt_args):
+        sparse_parameters = sparse_embedding_parameters(model)
+        if len(sparse_parameters) > 0:
+            return self.get_dense_sparse_optimizer(model, sparse_parameters, optimizer_name, opt_args)
         if optimizer_name == "SGD":
             return torch.optim.SGD(model.parameters(), lr=opt_args.lr, momentum=opt_args.momentum,
                                    weight_decay=opt_args.L2)
@@ -173,6 +243,27 @@ class CommonTrainer:
         else:
             raise Exception("Unknown optimizer name: {}".format(optimizer_name))
 
+    def get_dense_sparse_optimizer(self, model, sparse_parameters, optimizer_name, opt_args):
+        """
+        Return an optimizer for a model with sparse embeddings. Weight decay, and momentum for SGD, only apply to
+        the dense parameters, since they would make the updates of the sparse parameters dense.
+        """
+        sparse_ids = set(id(parameter) for parameter in sparse_parameters)
+        dense_parameters = [parameter for parameter in model.parameters() if id(parameter) not in sparse_ids]
+        if optimizer_name == "SGD":
+            return torch.optim.SGD([{"params": dense_parameters},
+                                    {"params": sparse_parameters, "momentum": 0, "weight_decay": 0}],
+                                   lr=opt_args.lr, momentum=opt_args.momentum, weight_decay=opt_args.L2)
+        elif optimizer_name == "adagrad":
+            return torch.optim.Adagrad([{"params": dense_parameters},
+                                        {"params": sparse_parameters, "weight_decay": 0}],
+                                       lr=opt_args.lr, weight_decay=opt_args.L2)
+        elif optimizer_name == "Adam":
+            return DenseSparseOptimizer(torch.optim.Adam(dense_parameters, lr=opt_args.lr, weight_decay=opt_args.L2),
+                                        torch.optim.SparseAdam(sparse_parameters, lr=opt_args.lr))
+        else:
+            raise Exception("Unknown optimizer name: {}".format(optimizer_name))
+
     def set_common_lock(self, common_lock=None):
         self.lock=common_lock
 
@@ -263,13 +354,14 @@ class CommonTrainer:
                 self.save_model(test_loss, epoch, self.net, "latest")
 
 
-    def save_model(self, best_test_loss, epoch, model, model_label):
+    def save_model(self, best_test_loss, epoch, model, model_label, data_pipeline=None):
         model.eval()
         state = {
             'model': model.module if self.is_parallel else model,
             'confusion-matrix': self.best_model_confusion_matrix,
             'best_test_loss': best_test_loss,
             'epoch': epoch,
+            'data_pipeline': data_pipeline,
         }
         additional_attrs = self.problem.model_attrs()
         if isinstance(additional_attrs, dict):
@@ -281,6 +373,64 @@ class CommonTrainer:
             os.mkdir('models')
         torch.save(state, './models/pytorch_{}_{}.t7'.format(self.args.checkpoint_key, model_label))
 
+    def create_transforms(self, normalize_input=True, label_smoothing_epsilon=None, mixup_sources=None):
+        """
+        Create the transforms the data providers apply to the batches of this trainer.
+        :param normalize_input: when True and --normalize is set, normalize the input by its mean and std.
+        :param label_smoothing_epsilon: epsilon to smooth softmaxGenotype labels with (defaults to
+        --epsilon-label-smoothing). Labels are kept unchanged when zero.
+        :param mixup_sources: optional pair of source names whose input and labels are mixed into a "mixup" source.
+        :return: a TransformPipeline.
+        """
+        column_transforms = {}
+        if normalize_input and hasattr(self.args, "normalize") and self.args.normalize:
+            if self.input_normalization is None:
+                self.input_normalization = Normalize(self.problem.load_tensor("input", "mean"),
+                                                     self.problem.load_tensor("input", "std"))
+            column_transforms["input"] = self.input_normalization
+        epsilon = self.epsilon if label_smoothing_epsilon is None else label_smoothing_epsilon
+        # registered even when epsilon is zero, so that providers keep the labels:
+        column_transforms["softmaxGenotype"] = LabelSmoothing(epsilon)
+        batch_transforms = []
+        if mixup_sources is not None:
+            batch_transforms += [MixupPairing(mixup_sources[0], mixup_sources[1], alpha=self.args.mixup_alpha)]
+        return TransformPipeline(column_transforms, batch_transforms)
+
+    def sampler_state_for(self, source_name, epoch):
+        """
+        Return the sampler state to use for a source of training examples in this epoch. The order of the
+        examples is determined by the seed, the source name and the epoch. When resuming in the middle of this
+        epoch, iteration starts right after the last example consumed before the checkpoint.
+        :param source_name: name of the source, as in the batch_names of the data provider.
+        :param epoch: current epoch.
+        :return: dictionary with keys seed, epoch and position.
+        """
+        seed = (self.args.seed if hasattr(self.args, "seed") else 0) + zlib.crc32(source_name.encode())
+        position = 0
+        if self.resume_data_pipeline is not None and self.resume_data_pipeline["epoch"] == epoch:
+            position = self.resume_data_pipeline["positions"].get(source_name, 0)
+        state = {"seed": seed, "epoch": epoch, "position": position}
+        self.epoch_sampler_states[source_name] = state
+        return state
+
+    def checkpoint_data_pipeline(self, data_provider, epoch):
+        """
+        Save the latest model together with the position of the data pipeline in the current epoch.
+        """
+        consumed = data_provider.state_dict()["examples_consumed"]
+        positions = {}
+        for source_name, num_examples in consumed.items():
+            if source_name in self.epoch_sampler_states:
+                positions[source_name] = self.epoch_sampler_states[source_name]["position"] + num_examples
+        self.save_model(self.best_test_loss, epoch, self.net, "latest",
+                        data_pipeline={"epoch": epoch, "positions": positions})
+        # save_model switches the model to eval mode:
+        self.net.train()
+
+    def checkpoint_data_pipeline_if_needed(self, batch_idx, data_provider, epoch):
+        if self.checkpoint_every_n_batches is not None and (batch_idx + 1) % self.checkpoint_every_n_batches == 0:
+            self.checkpoint_data_pipeline(data_provider, epoch)
+
     def load_checkpoint(self, model_label="best"):
 
         if not os.path.isdir('models'):
@@ -317,7 +467,9 @@ class CommonTrainer:
 
         for epoch in range(self.start_epoch, self.start_epoch + self.args.num_epochs):
             perfs = PerformanceList()
+            self.training_pipeline_helper.init_performance_metrics()
             perfs += training_loop_method(epoch)
+            perfs += [self.training_pipeline_helper]
 
             perfs += [lr_train_helper]
             if previous_test_perfs is None or self.epoch_is_test_epoch(epoch):
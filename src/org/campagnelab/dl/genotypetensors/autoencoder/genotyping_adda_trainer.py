@@ -10,7 +10,8 @@ from org.campagnelab.dl.performance.FloatHelper import FloatHelper
 from org.campagnelab.dl.performance.LossHelper import LossHelper
 from org.campagnelab.dl.genotypetensors.autoencoder.common_trainer import CommonTrainer
 from org.campagnelab.dl.genotypetensors.autoencoder.genotype_softmax_classifier import GenotypeSoftmaxClassifer
-from org.campagnelab.dl.multithreading.sequential_implementation import MultiThreadedCpuGpuDataProvider
+from org.campagnelab.dl.multithreading.sequential_implementation import MultiThreadedCpuGpuDataProvider, \
+    MultiplexedDataProvider
 from org.campagnelab.dl.performance.FloatHelper import FloatHelper
 from org.campagnelab.dl.performance.PerformanceList import PerformanceList
 from org.campagnelab.dl.utils.utils import progress_bar
@@ -137,11 +138,14 @@ class GenotypingADDATrainer(CommonTrainer):
         unsupervised_loss_acc = 0
         num_batches = 0
         # Use the entire training set to draw examples, even num_training is limiting the length of an epoch.
-        train_loader_subset = self.problem.train_loader_subset_range(0, len(self.problem.train_set()))
-        unlabeled_loader_subset = self.problem.unlabeled_loader()
-        data_provider = MultiThreadedCpuGpuDataProvider(
-            iterator=zip(train_loader_subset, unlabeled_loader_subset),
+        train_loader_subset = self.problem.train_loader_subset_range(0, len(self.problem.train_set()),
+                                                                     sampler_state=self.sampler_state_for("training", epoch))
+        unlabeled_loader_subset = self.problem.unlabeled_loader(sampler_state=self.sampler_state_for("unlabeled", epoch))
+        data_provider = MultiplexedDataProvider(
+            iterators=[train_loader_subset, unlabeled_loader_subset],
             is_cuda=self.use_cuda,
+            memory_budget=self.prefetch_memory_budget,
+            pipeline_helper=self.training_pipeline_helper,
             batch_names=["training", "unlabeled"],
             requires_grad={"training": ["input"], "unlabeled": ["input"]},
             volatile={"training": ["metaData"], "unlabeled": ["metaData"]},
@@ -158,6 +162,7 @@ class GenotypingADDATrainer(CommonTrainer):
 
                 self.train_one_batch(performance_estimators, batch_idx, input_s_1, input_u_2)
 
+                self.checkpoint_data_pipeline_if_needed(batch_idx, data_provider, epoch)
                 if (batch_idx + 1) * self.mini_batch_size > self.max_training_examples:
                     break
         finally:
@@ -2,8 +2,9 @@ import torch
 from torch.autograd import Variable
 from torch.nn import MSELoss, MultiLabelSoftMarginLoss
 
-from org.campagnelab.dl.genotypetensors.autoencoder.common_trainer import CommonTrainer, recode_for_label_smoothing
-from org.campagnelab.dl.multithreading.sequential_implementation import MultiThreadedCpuGpuDataProvider
+from org.campagnelab.dl.genotypetensors.autoencoder.common_trainer import CommonTrainer
+from org.campagnelab.dl.multithreading.sequential_implementation import MultiThreadedCpuGpuDataProvider, \
+    MultiplexedDataProvider
 from org.campagnelab.dl.performance.AccuracyHelper import AccuracyHelper
 from org.campagnelab.dl.performance.FloatHelper import FloatHelper
 from org.campagnelab.dl.performance.LossHelper import LossHelper
@@ -45,13 +46,16 @@ class GenotypingSemiSupTrainer(CommonTrainer):
 
         unsupervised_loss_acc = 0
         num_batches = 0
-        train_loader_subset = self.problem.train_loader_subset_range(0, self.args.num_training)
-        unlabeled_loader = self.problem.unlabeled_loader()
-        data_provider = MultiThreadedCpuGpuDataProvider(iterator=zip(train_loader_subset, unlabeled_loader),is_cuda=self.use_cuda,
+        train_loader_subset = self.problem.train_loader_subset_range(0, self.args.num_training,
+                                                                     sampler_state=self.sampler_state_for("training", epoch))
+        unlabeled_loader = self.problem.unlabeled_loader(sampler_state=self.sampler_state_for("unlabeled", epoch))
+        data_provider = MultiplexedDataProvider(iterators=[train_loader_subset, unlabeled_loader],is_cuda=self.use_cuda,
+                                     memory_budget=self.prefetch_memory_budget,
+                                     pipeline_helper=self.training_pipeline_helper,
                                      batch_names=["training", "unlabeled"],
                                      requires_grad={"training": ["input"], "unlabeled": ["input"]},
                                      volatile={"training": ["metaData"], "unlabeled": []},
-                                     recode_functions={"softmaxGenotype": lambda x: recode_for_label_smoothing(x,self.epsilon)})
+                                     transforms=self.create_transforms(normalize_input=False))
         self.net.autoencoder.train()
         try:
             for batch_idx, (_, data_dict) in enumerate(data_provider):
@@ -96,6 +100,7 @@ class GenotypingSemiSupTrainer(CommonTrainer):
                              performance_estimators.progress_message(["supervised_loss", "reconstruction_loss",
                                                                       "train_accuracy"]))
 
+                self.checkpoint_data_pipeline_if_needed(batch_idx, data_provider, epoch)
                 if (batch_idx + 1) * self.mini_batch_size > self.max_training_examples:
                     break
         finally:
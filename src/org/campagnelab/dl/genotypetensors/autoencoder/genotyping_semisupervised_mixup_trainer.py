@@ -3,13 +3,14 @@ from torch.autograd import Variable
 from torch.nn import MultiLabelSoftMarginLoss
 from torchnet.meter import ConfusionMeter
 
-from org.campagnelab.dl.genotypetensors.autoencoder.common_trainer import CommonTrainer, recode_for_label_smoothing
-from org.campagnelab.dl.multithreading.sequential_implementation import MultiThreadedCpuGpuDataProvider
+from org.campagnelab.dl.genotypetensors.autoencoder.common_trainer import CommonTrainer
+from org.campagnelab.dl.multithreading.sequential_implementation import MultiThreadedCpuGpuDataProvider, \
+    MultiplexedDataProvider
 from org.campagnelab.dl.performance.AccuracyHelper import AccuracyHelper
 from org.campagnelab.dl.performance.FloatHelper import FloatHelper
 from org.campagnelab.dl.performance.LossHelper import LossHelper
 from org.campagnelab.dl.performance.PerformanceList import PerformanceList
-from org.campagnelab.dl.utils.utils import progress_bar, normalize_mean_std
+from org.campagnelab.dl.utils.utils import progress_bar
 
 
 def to_binary(n, max_value):
@@ -40,14 +41,7 @@ class GenotypingSemisupervisedMixupTrainer(CommonTrainer):
         super().__init__(args, problem, use_cuda)
         self.criterion_classifier = None
         self.cm=None
-        if self.args.normalize:
-            problem_mean = self.problem.load_tensor("input", "mean")
-            problem_std = self.problem.load_tensor("input", "std")
         self.categorical_distribution=None
-        self.normalize_inputs = lambda x: (normalize_mean_std(x, problem_mean=problem_mean,
-                                                              problem_std=problem_std)
-                                           if self.args.normalize
-                                           else x)
 
 
 
@@ -88,18 +82,18 @@ class GenotypingSemisupervisedMixupTrainer(CommonTrainer):
         unsupervised_loss_acc = 0
         num_batches = 0
 
-        train_loader_subset = self.problem.train_loader_subset_range(0, self.args.num_training)
-        unlabeled_loader_subset = self.problem.unlabeled_loader()
-        data_provider = MultiThreadedCpuGpuDataProvider(
-            iterator=zip(train_loader_subset, unlabeled_loader_subset),
+        train_loader_subset = self.problem.train_loader_subset_range(0, self.args.num_training,
+                                                                     sampler_state=self.sampler_state_for("training", epoch))
+        unlabeled_loader_subset = self.problem.unlabeled_loader(sampler_state=self.sampler_state_for("unlabeled", epoch))
+        data_provider = MultiplexedDataProvider(
+            iterators=[train_loader_subset, unlabeled_loader_subset],
             is_cuda=self.use_cuda,
+            memory_budget=self.prefetch_memory_budget,
+            pipeline_helper=self.training_pipeline_helper,
             batch_names=["training", "unlabeled"],
             requires_grad={"training": ["input"], "unlabeled": ["input"]},
             volatile={"training": ["metaData"], "unlabeled": ["metaData"]},
-            recode_functions={
-                "softmaxGenotype": lambda x: recode_for_label_smoothing(x, self.epsilon),
-                "input": self.normalize_inputs
-            }
+            transforms=self.create_transforms()
         )
 
         try:
@@ -113,6 +107,7 @@ class GenotypingSemisupervisedMixupTrainer(CommonTrainer):
 
                 self.train_one_batch(performance_estimators, batch_idx, input_s_1, target_s_1, metadata_1, input_u_2)
 
+                self.checkpoint_data_pipeline_if_needed(batch_idx, data_provider, epoch)
                 if (batch_idx + 1) * self.mini_batch_size > self.max_training_examples:
                     break
         finally:
@@ -207,9 +202,7 @@ class GenotypingSemisupervisedMixupTrainer(CommonTrainer):
             volatile={
                 "validation": ["input", "softmaxGenotype"]
             },
-            recode_functions={
-                "input": self.normalize_inputs
-            }
+            transforms=self.create_transforms(label_smoothing_epsilon=0)
         )
         if self.best_model is None:
             self.best_model=self.net
@@ -4,13 +4,14 @@ from torch.nn import MultiLabelSoftMarginLoss
 
 import numpy as np
 
-from org.campagnelab.dl.genotypetensors.autoencoder.common_trainer import CommonTrainer, recode_for_label_smoothing
-from org.campagnelab.dl.multithreading.sequential_implementation import MultiThreadedCpuGpuDataProvider
+from org.campagnelab.dl.genotypetensors.autoencoder.common_trainer import CommonTrainer
+from org.campagnelab.dl.multithreading.sequential_implementation import MultiThreadedCpuGpuDataProvider, \
+    MultiplexedDataProvider
 from org.campagnelab.dl.performance.AccuracyHelper import AccuracyHelper
 from org.campagnelab.dl.performance.FloatHelper import FloatHelper
 from org.campagnelab.dl.performance.LossHelper import LossHelper
 from org.campagnelab.dl.performance.PerformanceList import PerformanceList
-from org.campagnelab.dl.utils.utils import progress_bar, normalize_mean_std
+from org.campagnelab.dl.utils.utils import progress_bar
 
 
 def to_binary(n, max_value):
@@ -39,13 +40,7 @@ class GenotypingSupervisedMixupTrainer(CommonTrainer):
     def __init__(self, args, problem, use_cuda):
         super().__init__(args, problem, use_cuda)
         self.criterion_classifier = None
-        if self.args.normalize:
-            problem_mean = self.problem.load_tensor("input", "mean")
-            problem_std = self.problem.load_tensor("input", "std")
-        self.normalize_inputs = lambda x: (normalize_mean_std(x, problem_mean=problem_mean,
-                                                              problem_std=problem_std)
-                                           if self.args.normalize
-                                           else x)
+
     def create_training_performance_estimators(self):
         performance_estimators =PerformanceList()
         performance_estimators += [FloatHelper("supervised_loss")]
@@ -96,33 +91,34 @@ class GenotypingSupervisedMixupTrainer(CommonTrainer):
         unsupervised_loss_acc = 0
         num_batches = 0
 
-        train_loader_subset_1 = self.problem.train_loader_subset_range(0, self.args.num_training)
-        train_loader_subset_2 = self.problem.train_loader_subset_range(0, self.args.num_training)
-        data_provider = MultiThreadedCpuGpuDataProvider(
-            iterator=zip(train_loader_subset_1, train_loader_subset_2),
+        train_loader_subset_1 = self.problem.train_loader_subset_range(0, self.args.num_training,
+                                                                       sampler_state=self.sampler_state_for("training_1", epoch))
+        train_loader_subset_2 = self.problem.train_loader_subset_range(0, self.args.num_training,
+                                                                       sampler_state=self.sampler_state_for("training_2", epoch))
+        data_provider = MultiplexedDataProvider(
+            iterators=[train_loader_subset_1, train_loader_subset_2],
             is_cuda=self.use_cuda,
+            memory_budget=self.prefetch_memory_budget,
+            pipeline_helper=self.training_pipeline_helper,
             batch_names=["training_1", "training_2"],
             requires_grad={"training_1": ["input"], "training_2": ["input"]},
             volatile={"training_1": ["metaData"], "training_2": ["metaData"]},
-            recode_functions={
-                "softmaxGenotype": lambda x: recode_for_label_smoothing(x, self.epsilon),
-                "input": self.normalize_inputs
-            }
+            transforms=self.create_transforms(mixup_sources=("training_1", "training_2"))
         )
 
 
         try:
             for batch_idx, (_, data_dict) in enumerate(data_provider):
-                input_s_1 = data_dict["training_1"]["input"]
-                target_s_1 = data_dict["training_1"]["softmaxGenotype"]
-                input_s_2 = data_dict["training_2"]["input"]
-                target_s_2 = data_dict["training_2"]["softmaxGenotype"]
+                input_s_mixup = data_dict["mixup"]["input"]
+                target_s_mixup = data_dict["mixup"]["softmaxGenotype"]
                 metadata_1 = data_dict["training_1"]["metaData"]
                 metadata_2 = data_dict["training_2"]["metaData"]
                 num_batches += 1
 
-                self.train_one_batch(performance_estimators, batch_idx, input_s_1, input_s_2, target_s_1,target_s_2, metadata_1,metadata_2)
+                self.train_one_mixed_batch(performance_estimators, batch_idx, input_s_mixup, target_s_mixup,
+                                           metadata_1, metadata_2)
 
+                self.checkpoint_data_pipeline_if_needed(batch_idx, data_provider, epoch)
                 if (batch_idx + 1) * self.mini_batch_size > self.max_training_examples:
                     break
         finally:
@@ -133,6 +129,11 @@ class GenotypingSupervisedMixupTrainer(CommonTrainer):
     def train_one_batch(self, performance_estimators, batch_idx, input_s_1, input_s_2,
                         target_s_1,target_s_2, metadata_1,metadata_2):
         input_s_mixup, target_s_mixup = self._recreate_mixup_batch(input_s_1, input_s_2, target_s_1, target_s_2)
+        self.train_one_mixed_batch(performance_estimators, batch_idx, input_s_mixup, target_s_mixup,
+                                   metadata_1, metadata_2)
+
+    def train_one_mixed_batch(self, performance_estimators, batch_idx, input_s_mixup, target_s_mixup,
+                              metadata_1, metadata_2):
         self.net.train()
         # outputs used to calculate the loss of the supervised model
         # must be done with the model prior to regularization:
@@ -184,9 +185,7 @@ class GenotypingSupervisedMixupTrainer(CommonTrainer):
             volatile={
                 "validation": ["input", "softmaxGenotype"]
             },
-            recode_functions={
-                "input": self.normalize_inputs
-            }
+            transforms=self.create_transforms(label_smoothing_epsilon=0)
         )
         try:
             for batch_idx, (_, data_dict) in enumerate(data_provider):
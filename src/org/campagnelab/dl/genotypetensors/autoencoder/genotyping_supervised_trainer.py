@@ -1,13 +1,13 @@
 import torch
 from torch.nn import MultiLabelSoftMarginLoss
 
-from org.campagnelab.dl.genotypetensors.autoencoder.common_trainer import CommonTrainer, recode_for_label_smoothing
+from org.campagnelab.dl.genotypetensors.autoencoder.common_trainer import CommonTrainer
 from org.campagnelab.dl.multithreading.sequential_implementation import MultiThreadedCpuGpuDataProvider
 from org.campagnelab.dl.performance.AccuracyHelper import AccuracyHelper
 from org.campagnelab.dl.performance.FloatHelper import FloatHelper
 from org.campagnelab.dl.performance.LossHelper import LossHelper
 from org.campagnelab.dl.performance.PerformanceList import PerformanceList
-from org.campagnelab.dl.utils.utils import progress_bar, normalize_mean_std
+from org.campagnelab.dl.utils.utils import progress_bar
 
 
 def to_binary(n, max_value):
@@ -36,14 +36,6 @@ class GenotypingSupervisedTrainer(CommonTrainer):
     def __init__(self, args, problem, use_cuda):
         super().__init__(args, problem, use_cuda)
         self.criterion_classifier = None
-        if self.args.normalize:
-            problem_mean = self.problem.load_tensor("input", "mean")
-            problem_std = self.problem.load_tensor("input", "std")
-
-        self.normalize_inputs = lambda x: (normalize_mean_std(x, problem_mean=problem_mean,
-                                                              problem_std=problem_std)
-                                           if self.args.normalize
-                                           else x)
 
     def rebuild_criterions(self, output_name, weights=None):
         if output_name == "softmaxGenotype":
@@ -69,17 +61,17 @@ class GenotypingSupervisedTrainer(CommonTrainer):
 
         unsupervised_loss_acc = 0
         num_batches = 0
-        train_loader_subset = self.problem.train_loader_subset_range(0, self.args.num_training)
+        train_loader_subset = self.problem.train_loader_subset_range(0, self.args.num_training,
+                                                                     sampler_state=self.sampler_state_for("training", epoch))
         data_provider = MultiThreadedCpuGpuDataProvider(
             iterator=zip(train_loader_subset),
             is_cuda=self.use_cuda,
+            memory_budget=self.prefetch_memory_budget,
+            pipeline_helper=self.training_pipeline_helper,
             batch_names=["training"],
             requires_grad={"training": ["input"]},
             volatile={"training": ["metaData"]},
-            recode_functions={
-                "softmaxGenotype": lambda x: recode_for_label_smoothing(x, self.epsilon),
-                "input": self.normalize_inputs
-            }
+            transforms=self.create_transforms()
         )
         try:
 
@@ -90,6 +82,7 @@ class GenotypingSupervisedTrainer(CommonTrainer):
 
                 self.train_one_batch(performance_estimators,batch_idx, input_s,target_s,metadata)
 
+                self.checkpoint_data_pipeline_if_needed(batch_idx, data_provider, epoch)
                 if (batch_idx + 1) * self.mini_batch_size > self.max_training_examples:
                     break
         finally:
@@ -151,9 +144,7 @@ class GenotypingSupervisedTrainer(CommonTrainer):
             volatile={
                 "validation": ["input", "softmaxGenotype"]
             },
-            recode_functions={
-                "input": self.normalize_inputs
-            }
+            transforms=self.create_transforms(label_smoothing_epsilon=0)
         )
         try:
             for batch_idx, (_, data_dict) in enumerate(data_provider):
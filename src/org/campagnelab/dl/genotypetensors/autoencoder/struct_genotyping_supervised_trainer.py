@@ -1,13 +1,12 @@
-import concurrent
-from concurrent.futures import ThreadPoolExecutor
+import time
 
 import torch
+from torch.autograd import Variable
 from torch.backends import cudnn
 from torch.nn import MultiLabelSoftMarginLoss, Module
 
-from org.campagnelab.dl.genotypetensors.autoencoder.common_trainer import CommonTrainer, recode_for_label_smoothing
+from org.campagnelab.dl.genotypetensors.autoencoder.common_trainer import CommonTrainer
 from org.campagnelab.dl.genotypetensors.autoencoder.genotype_softmax_classifier import GenotypeSoftmaxClassifer
-from org.campagnelab.dl.genotypetensors.structured.Batcher import Batcher
 from org.campagnelab.dl.genotypetensors.structured.Models import BatchOfInstances, NoCache, TensorCache
 from org.campagnelab.dl.genotypetensors.structured.SbiMappers import configure_mappers
 from org.campagnelab.dl.multithreading.sequential_implementation import MultiThreadedCpuGpuDataProvider, DataProvider
@@ -15,16 +14,7 @@ from org.campagnelab.dl.performance.AccuracyHelper import AccuracyHelper
 from org.campagnelab.dl.performance.FloatHelper import FloatHelper
 from org.campagnelab.dl.performance.LossHelper import LossHelper
 from org.campagnelab.dl.performance.PerformanceList import PerformanceList
-from org.campagnelab.dl.utils.utils import progress_bar, normalize_mean_std
-
-
-def chunks(l, n):
-    """Yield successive n-sized chunks from list l.
-    example:
-    list(chunks([1,2,3,4,5,6,7],2)) returns:            [[1, 2], [3, 4], [5, 6], [7]]
-    """
-    for i in range(0, len(l), n):
-        yield l[i:i + n]
+from org.campagnelab.dl.utils.utils import progress_bar
 
 
 def to_binary(n, max_value):
@@ -41,6 +31,8 @@ class StructGenotypingModel(Module):
         self.sbi_mapper = sbi_mapper
         self.use_cuda = use_cuda
         self.use_batching = use_batching
+        # maps lists of records to the tensors used by the batched mappers:
+        self.tensorizer = None
         self.classifier = GenotypeSoftmaxClassifer(num_inputs=mapped_features_size, target_size=output_size[0],
                                                    num_layers=args.num_layers,
                                                    reduction_rate=args.reduction_rate,
@@ -48,28 +40,134 @@ class StructGenotypingModel(Module):
                                                    dropout_p=args.dropout_probability, ngpus=1, use_selu=args.use_selu,
                                                    skip_batch_norm=args.skip_batch_norm)
 
-    def map_sbi_messages(self, sbi_records, tensor_cache=NoCache(), cuda=None):
-        batcher = Batcher()
+    def map_sbi_messages(self, sbi_records, tensor_cache=None, cuda=None):
         mapper = self.sbi_mapper.mappers.mapper_for_type("SampleInfo")
-        if self.use_batching:
-            features = None
-            for phase in [0, 1, 2]:
-                # print("Mapping phase "+str(phase))
-                for record in sbi_records:
-                    for sample in record['samples']:
-                        batcher.collect_inputs(mapper=mapper, example=sample, phase=phase,
-                                               cuda=cuda, tensor_cache=tensor_cache)
-                features = batcher.forward_batch(mapper=mapper, phase=phase)
-
-
+        if not isinstance(sbi_records, dict) and self.use_batching:
+            # extract the gather indices of the batch once, instead of walking the records in each phase of a
+            # Batcher. Models saved before the tensorizer was introduced do not have one:
+            if not hasattr(self, "tensorizer") or self.tensorizer is None:
+                self.tensorizer = mapper.create_tensorizer()
+            sbi_records = self.tensorizer(sbi_records)
+        if isinstance(sbi_records, dict):
+            # records were tensorized by the data loader or above (see SbiTensorizer):
+            features = mapper.forward_tensors(self.tensor_variables(sbi_records))
         else:
-            # Create a new cache for each mini-batch because we cache embeddings:
-            tensor_cache=TensorCache()
+            # without a cache shared across batches (see StructGenotypingSupervisedTrainer), create a new cache for
+            # each mini-batch because we cache embeddings:
+            if tensor_cache is None:
+                tensor_cache = TensorCache()
             features = self.sbi_mapper(sbi_records, tensor_cache=tensor_cache, cuda=self.use_cuda)
         return features
 
-    def forward(self, sbi_records):
-        return self.classifier(self.map_sbi_messages(sbi_records,cuda=self.use_cuda))
+    def forward(self, sbi_records, tensor_cache=None):
+        return self.classifier(self.map_sbi_messages(sbi_records, tensor_cache=tensor_cache, cuda=self.use_cuda))
+
+    def tensor_variables(self, tensors):
+        """Wrap the tensors extracted by SbiTensorizer in Variables, on the device of the model."""
+        variables = {}
+        for key, value in tensors.items():
+            if not isinstance(value, Variable):
+                value = Variable(value)
+            if self.use_cuda and not value.is_cuda:
+                value = value.cuda(async=True)
+            variables[key] = value
+        return variables
+
+
+class StructGenotypingTensorModel(Module):
+    """
+    The tensor compute of a StructGenotypingModel: maps a batch tensorized by SbiTensorizer to the classifier
+    output, without walking sbi records. The tensors are positional arguments, in the order of keys, so that
+    the module can be traced (see trace_struct_model).
+    """
+
+    def __init__(self, model, keys):
+        super().__init__()
+        self.model = model
+        self.keys = list(keys)
+
+    def inputs(self, tensors):
+        """Return the positional inputs of forward for a dictionary of tensors extracted by SbiTensorizer."""
+        variables = self.model.tensor_variables(tensors)
+        return tuple(variables[key] for key in self.keys)
+
+    def forward(self, *inputs):
+        mapper = self.model.sbi_mapper.mappers.mapper_for_type("SampleInfo")
+        return self.model.classifier(mapper.forward_tensors(dict(zip(self.keys, inputs))))
+
+
+def trace_module(module, inputs):
+    """Trace module with the example inputs, with the torch.jit.trace API of the installed pytorch."""
+    if hasattr(torch.jit, "script"):
+        return torch.jit.trace(module, inputs)
+    # earlier versions of torch.jit.trace take the inputs and return a decorator:
+    return torch.jit.trace(*inputs)(module)
+
+
+class TracedStructModel:
+    """
+    Trace of a StructGenotypingTensorModel. torch.jit.trace records sizes read from the example inputs as constants
+    (e.g. the number of samples reshaped in MapSampleInfo.forward_tensors), so batches are padded to static sizes
+    (see SbiTensorizer.pad) and a single trace maps every batch. Batches that do not fit the static sizes run
+    eagerly.
+    """
+
+    def __init__(self, tensor_model, tensorizer, max_samples, max_sequence_length):
+        """
+        :param max_samples: number of samples of the padded batches.
+        :param max_sequence_length: number of bases of the padded from and to sequences.
+        """
+        self.tensor_model = tensor_model
+        self.tensorizer = tensorizer
+        self.max_samples = max_samples
+        self.max_sequence_length = max_sequence_length
+        self.trace = None
+        # seconds spent tracing, and number of batches that ran eagerly:
+        self.trace_time = 0
+        self.eager_batches = 0
+
+    def __call__(self, tensors):
+        """
+        Map a batch tensorized by SbiTensorizer, traced on first use.
+        :return: the classifier output, one row per sample of the batch.
+        """
+        padded = self.tensorizer.pad(tensors, self.max_samples, self.max_sequence_length)
+        if padded is None:
+            self.eager_batches += 1
+            return self.tensor_model(*self.tensor_model.inputs(tensors))
+        inputs = self.tensor_model.inputs(padded)
+        if self.trace is None:
+            start = time.time()
+            self.trace = trace_module(self.tensor_model, inputs)
+            self.trace_time = time.time() - start
+        return self.trace(*inputs)[0:tensors["sample.counts"].size(0)]
+
+
+def trace_struct_model(model, sbi_records, max_samples, max_sequence_length=32):
+    """
+    Trace the tensor compute of a model (embeddings, sequence LSTM, Reduce layers and classifier) for inference.
+    The model is put in eval mode first.
+    :param model: a StructGenotypingModel.
+    :param sbi_records: example records used to trace the model.
+    :param max_samples: number of samples of the padded batches, the mini-batch size for models that map one sample
+    per record.
+    :param max_sequence_length: number of bases of the padded from and to sequences.
+    :return: a tuple (TracedStructModel, StructGenotypingTensorModel). Both map tensorized batches, use the inputs
+    method of the second element to obtain its arguments.
+    """
+    if not (hasattr(torch, "jit") and hasattr(torch.jit, "trace")):
+        raise ValueError("Tracing requires a version of pytorch that provides torch.jit.trace.")
+    model.eval()
+    mapper = model.sbi_mapper.mappers.mapper_for_type("SampleInfo")
+    tensorizer = mapper.create_tensorizer()
+    tensors = tensorizer(sbi_records)
+    tensor_model = StructGenotypingTensorModel(model, keys=sorted(tensors.keys()))
+    traced = TracedStructModel(tensor_model, tensorizer, max_samples, max_sequence_length)
+    traced(tensors)
+    if traced.trace is None:
+        raise ValueError("The example records do not fit in {} samples with sequences of {} bases.".format(
+            max_samples, max_sequence_length))
+    return traced, tensor_model
 
 
 class StructGenotypingSupervisedTrainer(CommonTrainer):
@@ -78,8 +176,6 @@ class StructGenotypingSupervisedTrainer(CommonTrainer):
     def __init__(self, args, problem, use_cuda):
         super().__init__(args, problem, use_cuda)
         self.criterion_classifier = None
-        self.thread_executor = ThreadPoolExecutor(max_workers=args.num_workers) if args.num_workers > 1 \
-            else None
         self.tensor_cache = TensorCache()
 
     def rebuild_criterions(self, output_name, weights=None):
@@ -96,8 +192,11 @@ class StructGenotypingSupervisedTrainer(CommonTrainer):
         performance_estimators = PerformanceList()
         performance_estimators += [FloatHelper("supervised_loss")]
         performance_estimators += [AccuracyHelper("train_")]
+        performance_estimators += [FloatHelper("train_step_time")]
         if self.use_cuda:
             self.tensor_cache.cuda()
+        # tensors cached during evaluation were computed without gradients:
+        self.tensor_cache.invalidate()
         print('\nTraining, epoch: %d' % epoch)
 
         for performance_estimator in performance_estimators:
@@ -105,16 +204,17 @@ class StructGenotypingSupervisedTrainer(CommonTrainer):
 
         unsupervised_loss_acc = 0
         num_batches = 0
-        train_loader_subset = self.problem.train_loader_subset_range(0, self.args.num_training)
+        train_loader_subset = self.problem.train_loader_subset_range(0, self.args.num_training,
+                                                                     sampler_state=self.sampler_state_for("training", epoch))
         data_provider = MultiThreadedCpuGpuDataProvider(
             iterator=zip(train_loader_subset),
             is_cuda=self.use_cuda,
+            memory_budget=self.prefetch_memory_budget,
+            pipeline_helper=self.training_pipeline_helper,
             batch_names=["training"],
             requires_grad={"training": ["sbi"]},
             volatile={"training": ["metaData"]},
-            recode_functions={
-                "softmaxGenotype": lambda x: recode_for_label_smoothing(x, self.epsilon),
-            }
+            transforms=self.create_transforms(normalize_input=False)
         )
         cudnn.benchmark = False
         try:
@@ -124,15 +224,23 @@ class StructGenotypingSupervisedTrainer(CommonTrainer):
                 target_s = data_dict["training"]["softmaxGenotype"]
                 metadata = data_dict["training"]["metaData"]
 
-                self.train_one_batch(performance_estimators, batch_idx, sbi, target_s, metadata)
-                if (batch_idx + 1) * self.mini_batch_size > self.max_training_examples:
+                # batches hold fewer than mini_batch_size examples with --struct-batch-budget, count the examples:
+                examples_consumed = data_provider.examples_consumed["training"]
+                self.train_one_batch(performance_estimators, batch_idx, sbi, target_s, metadata,
+                                     examples_consumed=examples_consumed)
+                self.checkpoint_data_pipeline_if_needed(batch_idx, data_provider, epoch)
+                if examples_consumed > self.max_training_examples:
                     break
         finally:
             data_provider.close()
 
         return performance_estimators
 
-    def train_one_batch(self, performance_estimators, batch_idx, sbi, target_s, metadata):
+    def train_one_batch(self, performance_estimators, batch_idx, sbi, target_s, metadata, examples_consumed=None):
+        """
+        :param examples_consumed: number of training examples read in the epoch, including this batch. Estimated
+        from mini_batch_size when None.
+        """
         # outputs used to calculate the loss of the supervised model
         # must be done with the model prior to regularization:
         self.net.train()
@@ -141,7 +249,7 @@ class StructGenotypingSupervisedTrainer(CommonTrainer):
         self.optimizer_training.zero_grad()
         self.net.zero_grad()
 
-        output_s = self.net(sbi)
+        output_s = self.net(sbi, self.tensor_cache)
         output_s_p = self.get_p(output_s)
         _, target_index = torch.max(target_s, dim=1)
         supervised_loss = self.criterion_classifier(output_s, target_s)
@@ -152,35 +260,23 @@ class StructGenotypingSupervisedTrainer(CommonTrainer):
         weighted_supervised_loss = supervised_loss * batch_weight
         optimized_loss = weighted_supervised_loss
         optimized_loss.backward()
+        step_start = time.time()
         self.optimizer_training.step()
+        if self.use_cuda:
+            torch.cuda.synchronize()
+        step_time = time.time() - step_start
+        # cached embeddings are stale once the parameters changed:
+        self.tensor_cache.invalidate()
         performance_estimators.set_metric(batch_idx, "supervised_loss", supervised_loss.data[0])
+        performance_estimators.set_metric(batch_idx, "train_step_time", step_time)
         performance_estimators.set_metric_with_outputs(batch_idx, "train_accuracy", supervised_loss.data[0],
                                                        output_s_p, targets=target_index)
         if not self.args.no_progress:
-            progress_bar(batch_idx * self.mini_batch_size,
+            progress_bar(batch_idx * self.mini_batch_size if examples_consumed is None else examples_consumed,
                          self.max_training_examples,
                          performance_estimators.progress_message(
                              ["supervised_loss", "reconstruction_loss", "train_accuracy"]))
 
-    def map_sbi(self, sbi):
-        # process mapping of sbi messages in parallel:
-        if self.thread_executor is not None:
-            def todo(net, records, tensor_cache, cuda):
-                # print("processing batch")
-                features = net.map_sbi_messages(records, tensor_cache=tensor_cache, cuda=cuda)
-                return features
-
-            futures = []
-            records_per_worker = self.args.mini_batch_size // self.args.num_workers
-            for record in chunks(sbi, records_per_worker):
-                futures += [self.thread_executor.submit(todo, self.net, record,
-                                                        tensor_cache=self.tensor_cache, cuda=self.use_cuda)]
-            concurrent.futures.wait(futures)
-            input_s = torch.cat([future.result() for future in futures], dim=0)
-        else:
-            input_s = self.net.map_sbi_messages(sbi, self.tensor_cache, cuda=self.use_cuda)
-        return input_s
-
     def get_p(self, output_s):
         # Pytorch tensors output logits, inverse of logistic function (1 / 1 + exp(-z))
         # Take inverse of logit (exp(logit(z)) / (exp(logit(z) + 1)) to get logistic fn value back
@@ -210,14 +306,23 @@ class StructGenotypingSupervisedTrainer(CommonTrainer):
                 sbi = data_dict["validation"]["sbi"]
                 target_s = data_dict["validation"]["softmaxGenotype"]
                 self.net.eval()
-                self.test_one_batch(performance_estimators, batch_idx, sbi, target_s, errors=errors)
+                examples_consumed = data_provider.examples_consumed["validation"]
+                self.test_one_batch(performance_estimators, batch_idx, sbi, target_s, errors=errors,
+                                    examples_consumed=examples_consumed)
 
-                if ((batch_idx + 1) * self.mini_batch_size) > self.max_validation_examples:
+                if examples_consumed > self.max_validation_examples:
                     break
             # print()
         finally:
             data_provider.close()
         print("test errors by class: ", str(errors))
+        count_mapper = self.net.sbi_mapper.mappers.mapper_for_type("CountInfo")
+        if hasattr(count_mapper.map_sequence, "memo") and count_mapper.map_sequence.memo is not None:
+            print("sequence memo: " + count_mapper.map_sequence.memo.statistics_message())
+        if hasattr(count_mapper, "memo") and count_mapper.memo is not None:
+            print("count memo: " + count_mapper.memo.statistics_message())
+        if not self.net.use_batching:
+            print("tensor cache: " + self.tensor_cache.statistics_message())
         if self.reweight_by_validation_error:
             self.reweight_by_val_errors(errors)
         # Apply learning rate schedule:
@@ -242,11 +347,12 @@ class StructGenotypingSupervisedTrainer(CommonTrainer):
         self.test_performance_estimators = performance_estimators
         return performance_estimators
 
-    def test_one_batch(self, performance_estimators, batch_idx, sbi, target_s, metadata=None, errors=None):
+    def test_one_batch(self, performance_estimators, batch_idx, sbi, target_s, metadata=None, errors=None,
+                       examples_consumed=None):
         if errors is None:
             errors = torch.zeros(target_s[0].size())
 
-        output_s = self.net(sbi)
+        output_s = self.net(sbi, self.tensor_cache)
         output_s_p = self.get_p(output_s)
 
         supervised_loss = self.criterion_classifier(output_s, target_s)
@@ -257,7 +363,8 @@ class StructGenotypingSupervisedTrainer(CommonTrainer):
         performance_estimators.set_metric_with_outputs(batch_idx, "test_accuracy", supervised_loss.data[0],
                                                        output_s_p, targets=target_index)
         if not self.args.no_progress:
-            progress_bar(batch_idx * self.mini_batch_size, self.max_validation_examples,
+            progress_bar(batch_idx * self.mini_batch_size if examples_consumed is None else examples_consumed,
+                         self.max_validation_examples,
                          performance_estimators.progress_message(["test_supervised_loss", "test_reconstruction_loss",
                                                                   "test_accuracy"]))
 
@@ -266,7 +373,11 @@ class StructGenotypingSupervisedTrainer(CommonTrainer):
         sbi_mappers_configuration = configure_mappers(ploidy=args.struct_ploidy,
                                                       extra_genotypes=args.struct_extra_genotypes,
                                                       num_samples=1, count_dim=args.struct_count_dim,
-                                                      sample_dim=args.struct_sample_dim,use_cuda=use_cuda)
+                                                      sample_dim=args.struct_sample_dim,use_cuda=use_cuda,
+                                                      sparse_embeddings=(hasattr(args, "struct_sparse_embeddings") and
+                                                                         args.struct_sparse_embeddings),
+                                                      log_buckets=(hasattr(args, "struct_log_buckets") and
+                                                                   args.struct_log_buckets))
         sbi_mapper = BatchOfInstances(*sbi_mappers_configuration)
         # determine feature size:
 
@@ -280,6 +391,15 @@ class StructGenotypingSupervisedTrainer(CommonTrainer):
         output_size = problem.output_size("softmaxGenotype")
         model = StructGenotypingModel(args, sbi_mapper, mapped_features_size, output_size, self.use_cuda,
                                       args.use_batching)
+        if args.use_batching:
+            # extract the fields of the sbi records in the data loaders, the model then maps batches of tensors:
+            problem.tensorizer = sbi_mappers_configuration[0]["SampleInfo"].create_tensorizer()
+        if hasattr(args, "struct_sequence_memo_size") and args.struct_sequence_memo_size > 0:
+            # sequences repeat across sites, map each once when evaluating:
+            sbi_mappers_configuration[0]["CountInfo"].map_sequence.enable_memo(args.struct_sequence_memo_size)
+        if hasattr(args, "struct_count_memo_size") and args.struct_count_memo_size > 0:
+            # identical counts are mapped once when evaluating:
+            sbi_mappers_configuration[0]["CountInfo"].enable_memo(args.struct_count_memo_size)
         print(model)
         return model
 
@@ -1,10 +1,13 @@
 import os
 import sys
+import threading
+import time
 from multiprocessing import Lock
 from pathlib import Path
 
 import numpy
 import torch
+from torch.utils.data.sampler import Sampler
 from torchnet.dataset import ConcatDataset
 from torchnet.dataset.dataset import Dataset
 
@@ -19,6 +22,126 @@ def _ceiling_partition(n, s):
         return n
     return -(-n // s)
 
+class ResumableSampler(Sampler):
+    """ A sampler whose order is fully determined by a seed and an epoch number, and that can start iterating
+    from a position in that order. Used to resume training in the middle of an epoch without re-reading the
+    examples that were already consumed.
+    """
+    def __init__(self, length, shuffle=False, seed=0, epoch=0, position=0):
+        self.length = length
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = epoch
+        self.position = position
+
+    def order(self):
+        if self.shuffle:
+            return numpy.random.RandomState((self.seed + self.epoch) % 2 ** 32).permutation(self.length)
+        else:
+            return range(self.length)
+
+    def __iter__(self):
+        order = self.order()
+        for index in range(self.position, self.length):
+            yield int(order[index])
+
+    def __len__(self):
+        return max(0, self.length - self.position)
+
+    def state_dict(self):
+        return {"seed": self.seed, "epoch": self.epoch, "position": self.position}
+
+    def load_state_dict(self, state):
+        self.seed = state["seed"]
+        self.epoch = state["epoch"]
+        self.position = state["position"]
+
+
+class BucketingBatchSampler(ResumableSampler):
+    """ A batch sampler that groups examples of similar lengths in the same mini-batches, to reduce the padding of
+    variable length inputs. Examples whose lengths have the same power-of-two magnitude in every column of lengths
+    share a bucket. Batches are filled from the examples of a bucket in the order of ResumableSampler, and hold at
+    most batch_size examples and at most example_budget length units (the sum of the lengths of an example), so that
+    batches of long examples are smaller. Examples left in partially filled buckets at the end of the epoch are
+    sorted by length and batched together. Positions (see ResumableSampler) count examples, not batches.
+    """
+    def __init__(self, lengths, batch_size, example_budget=None, drop_last=False, shuffle=False, seed=0, epoch=0,
+                 position=0):
+        """
+        :param lengths: numpy array with one row of lengths per example (e.g., SbiRecordCache.record_lengths()).
+        :param batch_size: maximum number of examples in a batch.
+        :param example_budget: maximum sum of the lengths of the examples of a batch, or None for no limit. A batch
+        always holds at least one example.
+        :param drop_last: drop the last batch of leftover examples when it is not full.
+        """
+        lengths = numpy.asarray(lengths).reshape(len(lengths), -1)
+        super().__init__(len(lengths), shuffle=shuffle, seed=seed, epoch=epoch, position=position)
+        self.batch_size = batch_size
+        self.example_budget = example_budget
+        self.drop_last = drop_last
+        self.costs = lengths.sum(axis=1)
+        magnitudes = numpy.floor(numpy.log2(1 + numpy.maximum(lengths, 0))).astype(numpy.int64)
+        if self.length > 0:
+            _, self.buckets = numpy.unique(magnitudes, axis=0, return_inverse=True)
+        else:
+            self.buckets = numpy.zeros(0, dtype=numpy.int64)
+        self.buckets = self.buckets.reshape(-1)
+        self.bucket_batch_sizes = [self.examples_per_batch(self.costs[self.buckets == bucket].max())
+                                   for bucket in range(int(self.buckets.max()) + 1 if self.length > 0 else 0)]
+        self.cached_batches = (None, None)
+
+    def examples_per_batch(self, cost):
+        if self.example_budget is None:
+            return self.batch_size
+        return max(1, min(self.batch_size, int(self.example_budget // max(1, cost))))
+
+    def batches(self):
+        """Return the batches of the epoch, as lists of example indices."""
+        key = (self.seed, self.epoch, self.shuffle)
+        if self.cached_batches[0] == key:
+            return self.cached_batches[1]
+        batches = []
+        pending = {}
+        for index in self.order():
+            index = int(index)
+            bucket = self.buckets[index]
+            pending.setdefault(bucket, []).append(index)
+            if len(pending[bucket]) == self.bucket_batch_sizes[bucket]:
+                batches.append(pending.pop(bucket))
+        leftovers = sorted([index for bucket in sorted(pending.keys()) for index in pending[bucket]],
+                           key=lambda index: self.costs[index])
+        batch = []
+        for index in leftovers:
+            if len(batch) > 0 and len(batch) >= self.examples_per_batch(self.costs[index]):
+                batches.append(batch)
+                batch = []
+            batch.append(index)
+        if len(batch) > 0 and not (self.drop_last and len(batch) < self.examples_per_batch(self.costs[batch[-1]])):
+            batches.append(batch)
+        if self.shuffle:
+            # interleave the buckets:
+            permutation = numpy.random.RandomState((self.seed + self.epoch + 1) % 2 ** 32).permutation(len(batches))
+            batches = [batches[batch_index] for batch_index in permutation]
+        self.cached_batches = (key, batches)
+        return batches
+
+    def remaining_batches(self):
+        batches = self.batches()
+        consumed = 0
+        for batch_index, batch in enumerate(batches):
+            if consumed >= self.position:
+                return batches[batch_index:]
+            consumed += len(batch)
+        return []
+
+    def __iter__(self):
+        for batch in self.remaining_batches():
+            yield batch
+
+    def __len__(self):
+        return len(self.remaining_batches())
+
+
 class ListDataset(Dataset):
     def __init__(self,basename,postfix,vector_names):
         self.basename=basename
@@ -72,6 +195,46 @@ class EmptyDataset(Dataset):
         pass
 
 
+# key under which TimedCollate stores the read and collate times of a batch in the batch data dictionary:
+PIPELINE_TIMINGS = "__pipeline_timings__"
+# time spent reading examples in the current thread (or worker process) since the last collate:
+_read_time = threading.local()
+
+
+class TimedDataset(Dataset):
+    """ A dataset that measures the time spent reading examples from its delegate. Use with TimedCollate."""
+    def __init__(self, delegate):
+        super().__init__()
+        self.delegate = delegate
+
+    def __len__(self):
+        return len(self.delegate)
+
+    def __getitem__(self, idx):
+        start = time.time()
+        value = self.delegate[idx]
+        _read_time.seconds = getattr(_read_time, "seconds", 0.0) + time.time() - start
+        return value
+
+
+class TimedCollate:
+    """ Wraps a collate function and stores the time spent reading (see TimedDataset) and collating the examples of
+    each batch in the batch data dictionary, under the PIPELINE_TIMINGS key. Timings are computed where the batch is
+    assembled, so they travel with the batch from DataLoader worker processes."""
+    def __init__(self, collate_fn):
+        self.collate_fn = collate_fn
+
+    def __call__(self, batch):
+        start = time.time()
+        collated = self.collate_fn(batch)
+        collate_time = time.time() - start
+        read_time = getattr(_read_time, "seconds", 0.0)
+        _read_time.seconds = 0.0
+        if len(collated) == 2 and isinstance(collated[1], dict):
+            collated[1][PIPELINE_TIMINGS] = {"read": read_time, "collate": collate_time}
+        return collated
+
+
 class InterleavedReaderIndex:
     def __init__(self, reader_index, dataset):
         self.reader_index = reader_index
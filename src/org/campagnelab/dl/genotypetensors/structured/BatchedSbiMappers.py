@@ -3,6 +3,9 @@ from math import log2, log10, log
 import torch
 from torch.autograd import Variable
 from torch.nn import Module, Embedding, LSTM, Linear
+from torch.nn.utils.rnn import pack_padded_sequence
+
+from org.campagnelab.dl.genotypetensors.structured.Models import LogBuckets
 
 sbi_json_string = '{"type":"BaseInformation","referenceBase":"A","genomicSequenceContext":"GCAGATATACTTCACAGCCCACGCTGACTCTGCCAAGCACA","samples":[{"type":"SampleInfo","counts":[{"type":"CountInfo","matchesReference":true,"isCalled":true,"isIndel":false,"fromSequence":"A","toSequence":"A","genotypeCountForwardStrand":7,"genotypeCountReverseStrand":32,"gobyGenotypeIndex":0,"qualityScoresForwardStrand":[{"type":"NumberWithFrequency","frequency":7,"number":40}],"qualityScoresReverseStrand":[{"type":"NumberWithFrequency","frequency":32,"number":40}],"readIndicesForwardStrand":[{"type":"NumberWithFrequency","frequency":1,"number":23},{"type":"NumberWithFrequency","frequency":1,"number":30},{"type":"NumberWithFrequency","frequency":5,"number":34}],"readIndicesReverseStrand":[{"type":"NumberWithFrequency","frequency":1,"number":6},{"type":"NumberWithFrequency","frequency":1,"number":22},{"type":"NumberWithFrequency","frequency":1,"number":28},{"type":"NumberWithFrequency","frequency":1,"number":31},{"type":"NumberWithFrequency","frequency":1,"number":34},{"type":"NumberWithFrequency","frequency":1,"number":35},{"type":"NumberWithFrequency","frequency":1,"number":44},{"type":"NumberWithFrequency","frequency":1,"number":50},{"type":"NumberWithFrequency","frequency":1,"number":62},{"type":"NumberWithFrequency","frequency":1,"number":63},{"type":"NumberWithFrequency","frequency":1,"number":68},{"type":"NumberWithFrequency","frequency":2,"number":75},{"type":"NumberWithFrequency","frequency":2,"number":76},{"type":"NumberWithFrequency","frequency":1,"number":81},{"type":"NumberWithFrequency","frequency":1,"number":83},{"type":"NumberWithFrequency","frequency":1,"number":88},{"type":"NumberWithFrequency","frequency":1,"number":89},{"type":"NumberWithFrequency","frequency":1,"number":100},{"type":"NumberWithFrequency","frequency":1,"number":104},{"type":"NumberWithFrequency","frequency":1,"number":109},{"type":"NumberWithFrequency","frequency":1,"number":117},{"type":"NumberWithFrequency","frequency":1,"number":118},{"type":"NumberWithFrequency","frequency":1,"number":125},{"type":"NumberWithFrequency","frequency":1,"number":133},{"type":"NumberWithFrequency","frequency":2,"number":138},{"type":"NumberWithFrequency","frequency":4,"number":139}],"readMappingQualityForwardStrand":[{"type":"NumberWithFrequency","frequency":7,"number":60}],"readMappingQualityReverseStrand":[{"type":"NumberWithFrequency","frequency":32,"number":60}],"numVariationsInReads":[{"type":"NumberWithFrequency","frequency":15,"number":0},{"type":"NumberWithFrequency","frequency":12,"number":1},{"type":"NumberWithFrequency","frequency":8,"number":2},{"type":"NumberWithFrequency","frequency":4,"number":3}],"insertSizes":[{"type":"NumberWithFrequency","frequency":1,"number":-520},{"type":"NumberWithFrequency","frequency":1,"number":-488},{"type":"NumberWithFrequency","frequency":1,"number":-481},{"type":"NumberWithFrequency","frequency":1,"number":-469},{"type":"NumberWithFrequency","frequency":1,"number":-467},{"type":"NumberWithFrequency","frequency":1,"number":-450},{"type":"NumberWithFrequency","frequency":1,"number":-441},{"type":"NumberWithFrequency","frequency":1,"number":-429},{"type":"NumberWithFrequency","frequency":1,"number":-427},{"type":"NumberWithFrequency","frequency":1,"number":-412},{"type":"NumberWithFrequency","frequency":1,"number":-411},{"type":"NumberWithFrequency","frequency":1,"number":-382},{"type":"NumberWithFrequency","frequency":1,"number":-375},{"type":"NumberWithFrequency","frequency":1,"number":-367},{"type":"NumberWithFrequency","frequency":1,"number":-361},{"type":"NumberWithFrequency","frequency":1,"number":-356},{"type":"NumberWithFrequency","frequency":1,"number":-349},{"type":"NumberWithFrequency","frequency":1,"number":-342},{"type":"NumberWithFrequency","frequency":1,"number":-339},{"type":"NumberWithFrequency","frequency":2,"number":-337},{"type":"NumberWithFrequency","frequency":1,"number":-310},{"type":"NumberWithFrequency","frequency":1,"number":-301},{"type":"NumberWithFrequency","frequency":1,"number":-294},{"type":"NumberWithFrequency","frequency":1,"number":-292},{"type":"NumberWithFrequency","frequency":1,"number":-274},{"type":"NumberWithFrequency","frequency":6,"number":0},{"type":"NumberWithFrequency","frequency":1,"number":318},{"type":"NumberWithFrequency","frequency":1,"number":339},{"type":"NumberWithFrequency","frequency":1,"number":397},{"type":"NumberWithFrequency","frequency":1,"number":398},{"type":"NumberWithFrequency","frequency":1,"number":410},{"type":"NumberWithFrequency","frequency":1,"number":426},{"type":"NumberWithFrequency","frequency":1,"number":511}],"targetAlignedLengths":[{"type":"NumberWithFrequency","frequency":2,"number":39},{"type":"NumberWithFrequency","frequency":2,"number":55},{"type":"NumberWithFrequency","frequency":2,"number":61},{"type":"NumberWithFrequency","frequency":2,"number":64},{"type":"NumberWithFrequency","frequency":2,"number":67},{"type":"NumberWithFrequency","frequency":2,"number":68},{"type":"NumberWithFrequency","frequency":2,"number":69},{"type":"NumberWithFrequency","frequency":2,"number":77},{"type":"NumberWithFrequency","frequency":2,"number":82},{"type":"NumberWithFrequency","frequency":4,"number":83},{"type":"NumberWithFrequency","frequency":2,"number":86},{"type":"NumberWithFrequency","frequency":2,"number":95},{"type":"NumberWithFrequency","frequency":2,"number":96},{"type":"NumberWithFrequency","frequency":2,"number":101},{"type":"NumberWithFrequency","frequency":4,"number":108},{"type":"NumberWithFrequency","frequency":4,"number":109},{"type":"NumberWithFrequency","frequency":2,"number":114},{"type":"NumberWithFrequency","frequency":2,"number":116},{"type":"NumberWithFrequency","frequency":4,"number":121},{"type":"NumberWithFrequency","frequency":2,"number":132},{"type":"NumberWithFrequency","frequency":2,"number":136},{"type":"NumberWithFrequency","frequency":2,"number":142},{"type":"NumberWithFrequency","frequency":2,"number":144},{"type":"NumberWithFrequency","frequency":8,"number":150},{"type":"NumberWithFrequency","frequency":4,"number":151},{"type":"NumberWithFrequency","frequency":12,"number":171}],"queryAlignedLengths":[{"type":"NumberWithFrequency","frequency":1,"number":39},{"type":"NumberWithFrequency","frequency":1,"number":55},{"type":"NumberWithFrequency","frequency":1,"number":61},{"type":"NumberWithFrequency","frequency":1,"number":64},{"type":"NumberWithFrequency","frequency":1,"number":67},{"type":"NumberWithFrequency","frequency":1,"number":68},{"type":"NumberWithFrequency","frequency":1,"number":69},{"type":"NumberWithFrequency","frequency":1,"number":77},{"type":"NumberWithFrequency","frequency":1,"number":82},{"type":"NumberWithFrequency","frequency":2,"number":83},{"type":"NumberWithFrequency","frequency":1,"number":86},{"type":"NumberWithFrequency","frequency":1,"number":95},{"type":"NumberWithFrequency","frequency":1,"number":96},{"type":"NumberWithFrequency","frequency":1,"number":101},{"type":"NumberWithFrequency","frequency":2,"number":108},{"type":"NumberWithFrequency","frequency":2,"number":109},{"type":"NumberWithFrequency","frequency":1,"number":114},{"type":"NumberWithFrequency","frequency":1,"number":116},{"type":"NumberWithFrequency","frequency":1,"number":121},{"type":"NumberWithFrequency","frequency":1,"number":122},{"type":"NumberWithFrequency","frequency":1,"number":133},{"type":"NumberWithFrequency","frequency":1,"number":137},{"type":"NumberWithFrequency","frequency":1,"number":142},{"type":"NumberWithFrequency","frequency":1,"number":145},{"type":"NumberWithFrequency","frequency":1,"number":150},{"type":"NumberWithFrequency","frequency":5,"number":151},{"type":"NumberWithFrequency","frequency":2,"number":171},{"type":"NumberWithFrequency","frequency":4,"number":172}],"queryPositions":[{"type":"NumberWithFrequency","frequency":39,"number":0}],"pairFlags":[{"type":"NumberWithFrequency","frequency":6,"number":16},{"type":"NumberWithFrequency","frequency":14,"number":83},{"type":"NumberWithFrequency","frequency":6,"number":99},{"type":"NumberWithFrequency","frequency":12,"number":147},{"type":"NumberWithFrequency","frequency":1,"number":163}],"distancesToReadVariationsForwardStrand":[{"type":"NumberWithFrequency","frequency":2,"number":-70},{"type":"NumberWithFrequency","frequency":4,"number":-29}],"distancesToReadVariationsReverseStrand":[{"type":"NumberWithFrequency","frequency":2,"number":-24},{"type":"NumberWithFrequency","frequency":1,"number":-15},{"type":"NumberWithFrequency","frequency":1,"number":-2},{"type":"NumberWithFrequency","frequency":1,"number":12},{"type":"NumberWithFrequency","frequency":1,"number":13},{"type":"NumberWithFrequency","frequency":1,"number":15},{"type":"NumberWithFrequency","frequency":13,"number":29},{"type":"NumberWithFrequency","frequency":1,"number":49},{"type":"NumberWithFrequency","frequency":3,"number":62},{"type":"NumberWithFrequency","frequency":9,"number":70},{"type":"NumberWithFrequency","frequency":1,"number":73}],"distanceToStartOfRead":[{"type":"NumberWithFrequency","frequency":1,"number":18},{"type":"NumberWithFrequency","frequency":1,"number":23},{"type":"NumberWithFrequency","frequency":1,"number":26},{"type":"NumberWithFrequency","frequency":1,"number":30},{"type":"NumberWithFrequency","frequency":30,"number":33},{"type":"NumberWithFrequency","frequency":5,"number":34}],"distanceToEndOfRead":[{"type":"NumberWithFrequency","frequency":1,"number":6},{"type":"NumberWithFrequency","frequency":1,"number":22},{"type":"NumberWithFrequency","frequency":1,"number":28},{"type":"NumberWithFrequency","frequency":1,"number":31},{"type":"NumberWithFrequency","frequency":1,"number":34},{"type":"NumberWithFrequency","frequency":2,"number":35},{"type":"NumberWithFrequency","frequency":1,"number":44},{"type":"NumberWithFrequency","frequency":1,"number":48},{"type":"NumberWithFrequency","frequency":1,"number":49},{"type":"NumberWithFrequency","frequency":1,"number":50},{"type":"NumberWithFrequency","frequency":1,"number":52},{"type":"NumberWithFrequency","frequency":1,"number":62},{"type":"NumberWithFrequency","frequency":1,"number":63},{"type":"NumberWithFrequency","frequency":1,"number":68},{"type":"NumberWithFrequency","frequency":2,"number":75},{"type":"NumberWithFrequency","frequency":2,"number":76},{"type":"NumberWithFrequency","frequency":1,"number":81},{"type":"NumberWithFrequency","frequency":1,"number":83},{"type":"NumberWithFrequency","frequency":1,"number":88},{"type":"NumberWithFrequency","frequency":1,"number":89},{"type":"NumberWithFrequency","frequency":1,"number":100},{"type":"NumberWithFrequency","frequency":1,"number":104},{"type":"NumberWithFrequency","frequency":1,"number":109},{"type":"NumberWithFrequency","frequency":1,"number":111},{"type":"NumberWithFrequency","frequency":1,"number":117},{"type":"NumberWithFrequency","frequency":1,"number":118},{"type":"NumberWithFrequency","frequency":1,"number":121},{"type":"NumberWithFrequency","frequency":1,"number":125},{"type":"NumberWithFrequency","frequency":1,"number":128},{"type":"NumberWithFrequency","frequency":1,"number":133},{"type":"NumberWithFrequency","frequency":2,"number":138},{"type":"NumberWithFrequency","frequency":4,"number":139}]},{"type":"CountInfo","matchesReference":false,"isCalled":false,"isIndel":false,"fromSequence":"A","toSequence":"C","genotypeCountForwardStrand":0,"genotypeCountReverseStrand":1,"gobyGenotypeIndex":2,"qualityScoresForwardStrand":[],"qualityScoresReverseStrand":[{"type":"NumberWithFrequency","frequency":1,"number":7}],"readIndicesForwardStrand":[],"readIndicesReverseStrand":[{"type":"NumberWithFrequency","frequency":1,"number":115}],"readMappingQualityForwardStrand":[],"readMappingQualityReverseStrand":[{"type":"NumberWithFrequency","frequency":1,"number":60}],"numVariationsInReads":[{"type":"NumberWithFrequency","frequency":1,"number":2}],"insertSizes":[{"type":"NumberWithFrequency","frequency":1,"number":-301}],"targetAlignedLengths":[{"type":"NumberWithFrequency","frequency":2,"number":148}],"queryAlignedLengths":[{"type":"NumberWithFrequency","frequency":1,"number":148}],"queryPositions":[{"type":"NumberWithFrequency","frequency":1,"number":0}],"pairFlags":[{"type":"NumberWithFrequency","frequency":1,"number":147}],"distancesToReadVariationsForwardStrand":[],"distancesToReadVariationsReverseStrand":[{"type":"NumberWithFrequency","frequency":1,"number":-29},{"type":"NumberWithFrequency","frequency":1,"number":0}],"distanceToStartOfRead":[{"type":"NumberWithFrequency","frequency":1,"number":33}],"distanceToEndOfRead":[{"type":"NumberWithFrequency","frequency":1,"number":115}]},{"type":"CountInfo","matchesReference":false,"isCalled":false,"isIndel":false,"fromSequence":"A","toSequence":"T","genotypeCountForwardStrand":0,"genotypeCountReverseStrand":0,"gobyGenotypeIndex":1,"qualityScoresForwardStrand":[],"qualityScoresReverseStrand":[],"readIndicesForwardStrand":[],"readIndicesReverseStrand":[],"readMappingQualityForwardStrand":[],"readMappingQualityReverseStrand":[],"numVariationsInReads":[],"insertSizes":[],"targetAlignedLengths":[],"queryAlignedLengths":[],"queryPositions":[],"pairFlags":[],"distancesToReadVariationsForwardStrand":[],"distancesToReadVariationsReverseStrand":[],"distanceToStartOfRead":[],"distanceToEndOfRead":[]},{"type":"CountInfo","matchesReference":false,"isCalled":false,"isIndel":false,"fromSequence":"A","toSequence":"G","genotypeCountForwardStrand":0,"genotypeCountReverseStrand":0,"gobyGenotypeIndex":3,"qualityScoresForwardStrand":[],"qualityScoresReverseStrand":[],"readIndicesForwardStrand":[],"readIndicesReverseStrand":[],"readMappingQualityForwardStrand":[],"readMappingQualityReverseStrand":[],"numVariationsInReads":[],"insertSizes":[],"targetAlignedLengths":[],"queryAlignedLengths":[],"queryPositions":[],"pairFlags":[],"distancesToReadVariationsForwardStrand":[],"distancesToReadVariationsReverseStrand":[],"distanceToStartOfRead":[],"distanceToEndOfRead":[]},{"type":"CountInfo","matchesReference":false,"isCalled":false,"isIndel":false,"fromSequence":"A","toSequence":"N","genotypeCountForwardStrand":0,"genotypeCountReverseStrand":0,"gobyGenotypeIndex":4,"qualityScoresForwardStrand":[],"qualityScoresReverseStrand":[],"readIndicesForwardStrand":[],"readIndicesReverseStrand":[],"readMappingQualityForwardStrand":[],"readMappingQualityReverseStrand":[],"numVariationsInReads":[],"insertSizes":[],"targetAlignedLengths":[],"queryAlignedLengths":[],"queryPositions":[],"pairFlags":[],"distancesToReadVariationsForwardStrand":[],"distancesToReadVariationsReverseStrand":[],"distanceToStartOfRead":[],"distanceToEndOfRead":[]}]}]}'
 
@@ -125,8 +128,13 @@ class BooleanMapper(BatchedStructuredEmbedding):
         super().forward_batch(elements, field_prefix, tensors, index_maps)
 
         self.create_tensor_holder(tensors, field_prefix)
-        tensor_list = tensors[field_prefix]
-        result = torch.cat(tensor_list, dim=0)
+        # the predicates collected for the batch are encoded in a single tensor:
+        predicates = tensors[field_prefix]
+        if len(predicates) == 0:
+            return self.create_empty()
+        result = Variable(torch.FloatTensor([[1, 0] if predicate else [0, 1] for predicate in predicates]))
+        if self.use_cuda:
+            result = result.cuda(async=True)
         tensors[field_prefix] = result
         return result
 
@@ -136,54 +144,46 @@ class BooleanMapper(BatchedStructuredEmbedding):
 
         if field_prefix not in index_maps.keys():
             index_maps[field_prefix] = []
-        if field_prefix not in tensors:
-            tensors[field_prefix] = []
         start_index = self.get_start_offset(field_prefix)
-        if isinstance(elements, list):
-
-            end = start_index + len(elements)
-            index_maps[field_prefix] += range(start_index, end)
-
-            tensor = torch.cat(
-                [torch.FloatTensor([[1, 0]]) if value else torch.FloatTensor([[1, 0]]) for value in list])
-            tensor = Variable(tensor, requires_grad=True)
-            if self.use_cuda:
-                tensor=tensor.cuda()
-            tensors[field_prefix].append(tensor)
-        else:
-            index_maps[field_prefix].append(start_index)
-            end = start_index + 1
-            tensor = torch.FloatTensor([[1, 0]]) if elements else torch.FloatTensor([[1, 0]])
-            if self.use_cuda:
-                tensor=tensor.cuda()
-            tensors[field_prefix].append(Variable(tensor, requires_grad=True))
+        if not isinstance(elements, list):
+            elements = [elements]
+        end = start_index + len(elements)
+        index_maps[field_prefix] += range(start_index, end)
+        # collect the predicates, the tensor is created by forward_batch:
+        tensors[field_prefix] += elements
         self.set_start_offset(field_prefix, end)
 
 
 class IntegerMapper(BatchedStructuredEmbedding):
-    def __init__(self, distinct_numbers, embedding_size,use_cuda):
+    def __init__(self, distinct_numbers, embedding_size,use_cuda, sparse=False, buckets=None):
         super().__init__(embedding_size,use_cuda=use_cuda)
-        self.distinct_numbers = distinct_numbers
-        self.embedding = Embedding(distinct_numbers, embedding_size)
+        # when buckets are given (see LogBuckets), values are embedded by bucket:
+        self.buckets = buckets
+        self.distinct_numbers = distinct_numbers if buckets is None else buckets.num_buckets
+        # sparse embeddings produce gradients for the rows used in a batch only:
+        self.embedding = Embedding(self.distinct_numbers, embedding_size, sparse=sparse)
         self.embedding.requires_grad = True
         if use_cuda:
             self.embedding=self.embedding.cuda()
 
+    def embed_values(self, values):
+        variable = self.define_long_variable(values)
+        # models saved before buckets were introduced do not have the attribute:
+        if hasattr(self, "buckets") and self.buckets is not None:
+            variable = Variable(self.buckets.bucket_tensor(variable.data), requires_grad=False)
+        return self.embedding(variable)
+
     def forward(self, values):
         """Accepts a list of integer values and produces a batch of batch x embedded-value. """
 
         assert isinstance(values, list), "values must be a list of integers."
-        for value in values:
-            assert value < self.distinct_numbers, "A value is larger than the embedding input allow: " + str(value)
+        if not hasattr(self, "buckets") or self.buckets is None:
+            for value in values:
+                assert value < self.distinct_numbers, "A value is larger than the embedding input allow: " + str(value)
 
-        # cache the embedded values:
-        cached_values = []
-        for value in values:
-            cached_values.append(self.embedding(self.define_long_variable([value])))
         if len(values) == 0:
             return self.create_empty()
-        values = torch.cat(cached_values, dim=0)
-        return values
+        return self.embed_values(values)
 
     def collect_tensors(self, bases, field_name, tensors, index_maps={}):
         if isinstance(bases, int):
@@ -198,9 +198,8 @@ class IntegerMapper(BatchedStructuredEmbedding):
         end = index + len(bases)
         index_maps[field_name] += list(range(index, end))
 
-        if field_name not in tensors:
-            tensors[field_name] = []
-        tensors[field_name].append(self.define_long_variable(bases))
+        # collect the integers, the tensor is created by forward_batch:
+        tensors[field_name] += bases
         self.set_start_offset(field_name, end)
 
     def forward_batch(self, elements, field_prefix, tensors, index_maps=[]):
@@ -208,10 +207,10 @@ class IntegerMapper(BatchedStructuredEmbedding):
 
         self.create_tensor_holder(tensors, field_prefix)
 
-        tensor_list = tensors[field_prefix]
-        if len(tensor_list)==0:
+        values = tensors[field_prefix]
+        if len(values)==0:
             return self.create_empty()
-        result = self.embedding(torch.cat(tensor_list, dim=0))
+        result = self.embed_values(values)
         tensors[field_prefix] = result
         return result
 
@@ -258,6 +257,31 @@ class RNNOfList(BatchedStructuredEmbedding):
         else:
             return all_outputs.contiguous()
 
+    def forward_packed(self, padded_embeddings, lengths):
+        """
+        Run the LSTM once over a batch of lists of different lengths. Lists are packed, so that the padding is not
+        processed and the output of each list is taken after its last element.
+        :param padded_embeddings: num lists x max length x embedding_size, padded after the end of each list.
+        :param lengths: list with the length of each list.
+        :return: num lists x hidden_size.
+        """
+        batch_size = len(lengths)
+        # pack_padded_sequence expects lists sorted by decreasing length:
+        order = sorted(range(batch_size), key=lambda index: -lengths[index])
+        inverse_order = [0] * batch_size
+        for position, index in enumerate(order):
+            inverse_order[index] = position
+        packed = pack_padded_sequence(padded_embeddings.index_select(0, self.define_long_variable(order)),
+                                      [lengths[index] for index in order], batch_first=True)
+        hidden = Variable(torch.zeros(self.num_layers, batch_size, self.hidden_size))
+        memory = Variable(torch.zeros(self.num_layers, batch_size, self.hidden_size))
+        if self.is_cuda():
+            hidden = hidden.cuda(async=True)
+            memory = memory.cuda(async=True)
+        out, (hidden, memory) = self.lstm(packed, (hidden, memory))
+        # hidden state of the last layer after the last element of each list:
+        return hidden[-1].index_select(0, self.define_long_variable(inverse_order))
+
     def collect_tensors(self, elements, field_prefix, tensors, index_maps={}):
         assert isinstance(index_maps, dict), "index_map must be of type dict"
         self.create_tensor_holder(tensors, field_prefix)
@@ -377,30 +401,26 @@ class MapSequence(BatchedStructuredEmbedding):
         """Do a forward batch on bases. This will calculate embeddings on bases using batched Long tensors:"""
         batched_bases = self.map_bases.forward_batch(elements, field_prefix + ".bases", tensors)
         # print(batched_bases)
-        sequence_tensors = []
-        max_length = 0
-        for index_map in index_maps:
-            # we get the indices of the base embeddings (stored with .ints prefix)
-            slice_indices = index_map[field_prefix + ".bases"]
-            individual_sequence = batched_bases[slice_indices].view(1, -1, self.mapped_base_dim)
-            max_length = max(max_length, individual_sequence.size(1))
-            sequence_tensors.append(individual_sequence)
-
-        if len(sequence_tensors) == 0:
+        # we get the indices of the base embeddings of each sequence (stored with .bases prefix):
+        slices = [index_map[field_prefix + ".bases"] for index_map in index_maps]
+        if len(slices) == 0:
             tensors[field_prefix] = self.create_empty().view(1, 1, self.embedding_size)
             return tensors[field_prefix]
-        # Pad all sequences to max length:
-        padded_tensors = []
-        for sequence_tensor in sequence_tensors:
-            length = sequence_tensor.size(1)
-            padded = torch.nn.functional.pad(input=sequence_tensor, pad=(0, 0, 0, max_length - length),
-                                             mode='constant', value=0)
-            padded_tensors.append(padded)
-        # print("padded: "+str(padded_tensors))
-
-        # do forward on padded batched sequences:
-        batched_paddded = torch.cat(padded_tensors, dim=0)
-        mapped_sequences = self.map_sequence(batched_paddded)
+        lengths = [len(slice_indices) for slice_indices in slices]
+        max_length = max(lengths)
+        # Pad all sequences to max length with a single gather, the row after the last base embedding is the padding:
+        padding_index = batched_bases.size(0)
+        gather_indices = []
+        for slice_indices in slices:
+            gather_indices += slice_indices + [padding_index] * (max_length - len(slice_indices))
+        padding = Variable(torch.zeros(1, self.mapped_base_dim))
+        if self.use_cuda:
+            padding = padding.cuda(async=True)
+        batched_padded = torch.cat([batched_bases, padding], dim=0).index_select(
+            0, self.define_long_variable(gather_indices)).view(len(slices), max_length, self.mapped_base_dim)
+
+        # do forward on all the sequences of the batch at once:
+        mapped_sequences = self.map_sequence.forward_packed(batched_padded, lengths)
 
         tensors[field_prefix] = mapped_sequences
         # print("sequence mapped to size {}".format(mapped_sequences.size()))
@@ -432,8 +452,6 @@ class MapBaseInformation(BatchedStructuredEmbedding):
 
     def collect_tensors(self, elements, field_prefix, tensors, index_map={}):
         super().collect_tensors(elements, field_prefix, tensors, index_map)
-        print(elements)
-        print('=====================')
         field_prefix += ".record"
         offset = self.get_start_offset(field_prefix + ".list")
         for record in elements:
@@ -544,12 +562,12 @@ class MapSampleInfo(BatchedStructuredEmbedding):
             # print("collect_tensors, appending samples".format(len(count_indices_for_sample)))
             index += 1
 
+        # collect the counts of all the samples, in the order forward_batch maps them:
         all_counts = []
-        for count_list in (sample['counts'] for sample in elements):
+        for count_list in (self.get_observed_counts(sample) for sample in elements):
             for count in count_list[0:self.num_counts]:
-                # print(count)
                 all_counts.append(count)
-        self.count_mapper.collect_tensors(sample['counts'], field_prefix + ".counts", tensors, None)
+        self.count_mapper.collect_tensors(all_counts, field_prefix + ".counts", tensors, None)
 
         self.set_start_offset(field_prefix + ".list", index)
         return tensors
@@ -591,29 +609,33 @@ class MapSampleInfo(BatchedStructuredEmbedding):
 
 class MapCountInfo(BatchedStructuredEmbedding):
     def __init__(self, mapped_count_dim=5, count_dim=64, mapped_base_dim=2, mapped_genotype_index_dim=4,
-                 use_cuda=False):
+                 use_cuda=False, sparse_embeddings=False, log_buckets=False):
         super().__init__(count_dim, use_cuda=use_cuda)
 
-        self.frequency_list_mapper_base_qual = MapNumberWithFrequencyList(distinct_numbers=1000,use_cuda=self.use_cuda)
-        self.frequency_list_mapper_num_var = MapNumberWithFrequencyList(distinct_numbers=1000,use_cuda=self.use_cuda)
-        self.frequency_list_mapper_mapping_qual = MapNumberWithFrequencyList(distinct_numbers=100,use_cuda=self.use_cuda)
-        self.frequency_list_mapper_distance_to = MapNumberWithFrequencyList(distinct_numbers=1000,use_cuda=self.use_cuda)
-        self.frequency_list_mapper_aligned_lengths = MapNumberWithFrequencyList(distinct_numbers=1000,use_cuda=self.use_cuda)
-        self.frequency_list_mapper_read_indices = MapNumberWithFrequencyList(distinct_numbers=1000,use_cuda=self.use_cuda)
-
-        self.nf_names_mappers = [#('qualityScoresForwardStrand', self.frequency_list_mapper_base_qual),
-                                 #('qualityScoresReverseStrand', self.frequency_list_mapper_base_qual),
-                                 # ('distanceToStartOfRead', self.frequency_list_mapper_distance_to),
-                                 # ('distanceToEndOfRead', self.frequency_list_mapper_distance_to),  # OK
-                                 # ('readIndicesReverseStrand', self.frequency_list_mapper_read_indices),  # OK
-                                 # ('readIndicesForwardStrand', self.frequency_list_mapper_read_indices),  # OK
+        def nwf_list_mapper(distinct_numbers):
+            return MapNumberWithFrequencyList(distinct_numbers=distinct_numbers, use_cuda=self.use_cuda,
+                                              sparse=sparse_embeddings, log_buckets=log_buckets)
+
+        self.frequency_list_mapper_base_qual = nwf_list_mapper(1000)
+        self.frequency_list_mapper_num_var = nwf_list_mapper(1000)
+        self.frequency_list_mapper_mapping_qual = nwf_list_mapper(100)
+        self.frequency_list_mapper_distance_to = nwf_list_mapper(1000)
+        self.frequency_list_mapper_aligned_lengths = nwf_list_mapper(1000)
+        self.frequency_list_mapper_read_indices = nwf_list_mapper(1000)
+
+        self.nf_names_mappers = [('qualityScoresForwardStrand', self.frequency_list_mapper_base_qual),
+                                 ('qualityScoresReverseStrand', self.frequency_list_mapper_base_qual),
+                                 ('distanceToStartOfRead', self.frequency_list_mapper_distance_to),
+                                 ('distanceToEndOfRead', self.frequency_list_mapper_distance_to),  # OK
+                                 ('readIndicesReverseStrand', self.frequency_list_mapper_read_indices),  # OK
+                                 ('readIndicesForwardStrand', self.frequency_list_mapper_read_indices),  # OK
                                  # 'distancesToReadVariationsForwardStrand', #Wrong
                                  # 'distancesToReadVariationsReverseStrand', #Wrong
-                                 # ('targetAlignedLengths', self.frequency_list_mapper_aligned_lengths),
-                                 # ('queryAlignedLengths', self.frequency_list_mapper_aligned_lengths),  # OK
-                                 # ('numVariationsInReads', self.frequency_list_mapper_num_var),  # OK
-                                 # ('readMappingQualityForwardStrand', self.frequency_list_mapper_mapping_qual),  # OK
-                                 # ('readMappingQualityReverseStrand', self.frequency_list_mapper_mapping_qual)  # OK
+                                 ('targetAlignedLengths', self.frequency_list_mapper_aligned_lengths),
+                                 ('queryAlignedLengths', self.frequency_list_mapper_aligned_lengths),  # OK
+                                 ('numVariationsInReads', self.frequency_list_mapper_num_var),  # OK
+                                 ('readMappingQualityForwardStrand', self.frequency_list_mapper_mapping_qual),  # OK
+                                 ('readMappingQualityReverseStrand', self.frequency_list_mapper_mapping_qual)  # OK
                                  ]
         self.all_fields = []  # a list of (field_name, field_mapper)
 
@@ -623,7 +645,9 @@ class MapCountInfo(BatchedStructuredEmbedding):
                                         mapped_base_dim=mapped_base_dim,use_cuda=use_cuda)
         self.map_gobyGenotypeIndex = IntegerMapper(distinct_numbers=100, embedding_size=mapped_genotype_index_dim,use_cuda=use_cuda)
 
-        self.map_count = IntegerMapper(distinct_numbers=100000, embedding_size=mapped_count_dim,use_cuda=use_cuda)
+        self.map_count = IntegerMapper(distinct_numbers=100000, embedding_size=mapped_count_dim,use_cuda=use_cuda,
+                                       sparse=sparse_embeddings,
+                                       buckets=LogBuckets(max_value=100000) if log_buckets else None)
         self.map_boolean = BooleanMapper(use_cuda=use_cuda)
 
         self.all_fields += [('toSequence', self.map_sequence),
@@ -684,7 +708,7 @@ class MapCountInfo(BatchedStructuredEmbedding):
         field_prefix += ".count"
 
         for field_name, _ in self.all_fields:
-            if field_name not in tensors:
+            if field_prefix + "." + field_name not in tensors:
                 tensors[field_prefix + "." + field_name] = []
         offset = self.get_start_offset(field_prefix)
         for count_index, count in enumerate(list_of_counts):
@@ -720,53 +744,51 @@ class MapCountInfo(BatchedStructuredEmbedding):
                                                                                                     count
                                                                                                     in elements])
 
-        for field_name, mapper in self.all_fields:
-            # print("Mapping " + field_name, flush=True)
-            if not isinstance(mapper, MapNumberWithFrequencyList):
-                tensors["mapped$" + field_prefix + "." + field_name] = mapper.forward_batch(elements=elements,
-                                                                                            field_prefix=field_prefix + "." + field_name,
-                                                                                            tensors=tensors,
-                                                                                            index_maps=[count['indices']
-                                                                                                        for count in
-                                                                                                        elements])
-
-        # remove inputs to the nf mappers
-        # for nf_name, _ in self.nf_names_mappers:
-        #    tensors[field_prefix+nf_name]=None
-        tensors_for_individual_counts = []
-        # slice batched tensors into the instances of counts:
-
-        for count in elements:
-            # print("count -----")
-            slice_index = count['indices'][field_prefix + '.isIndel'][
-                0]  # used a field of cardinality 1 to retrieve this count index
-
-            count_components = []
-            for field_name, _ in self.all_fields:
-
-                batched_mapped_tensor = tensors["mapped$" + field_prefix + "." + field_name]
-                if slice_index < batched_mapped_tensor.size(0):
-                    tensor = batched_mapped_tensor[slice_index]
-                    if tensor is not None:
-
-                        # print("processing {} field of size {}".format(field_name, tensor.view(1, -1).size()),
-                        #      flush=True)
-                        count_components.append(tensor.view(1, -1))
-                    else:
-                        pass
-                        # print("Could not find tensor for field " + field_name)
-                else:
-                    pass
-                # print("Not enough elements for field " + field_prefix + "." + field_name)
-            if len(count_components)==0:
-                return self.create_empty()
-            tensors_for_individual_counts.append(torch.cat(count_components, dim=1))
-
-        batched_count_tensors = torch.cat(tensors_for_individual_counts, dim=0)
+        if len(elements) == 0:
+            return self.create_empty()
+        self.forward_count_fields(elements, field_prefix, tensors)
+
+        # rows of the counts in the batched tensors, a field of cardinality 1 gives the index of each count:
+        count_rows = self.define_long_variable([count['indices'][field_prefix + '.isIndel'][0] for count in elements])
+        mapped_fields = []
+        for field_name, _ in self.all_fields:
+            batched_mapped_tensor = tensors["mapped$" + field_prefix + "." + field_name]
+            mapped_fields.append(batched_mapped_tensor.view(batched_mapped_tensor.size(0), -1).index_select(0,
+                                                                                                          count_rows))
+        batched_count_tensors = torch.cat(mapped_fields, dim=1)
         result = self.reduce_count.forward_flat_inputs(batched_count_tensors)
         tensors[field_prefix] = result
         return result
 
+    def forward_count_fields(self, elements, field_prefix, tensors):
+        """
+        Map the fields that have one value per count. The strand counts share an embedding and are looked up
+        together, the two booleans are encoded together.
+        """
+
+        def key(field_name):
+            return field_prefix + "." + field_name
+
+        index_maps = [count['indices'] for count in elements]
+        tensors["mapped$" + key('toSequence')] = self.map_sequence.forward_batch(elements=elements,
+                                                                                 field_prefix=key('toSequence'),
+                                                                                 tensors=tensors,
+                                                                                 index_maps=index_maps)
+        tensors["mapped$" + key('gobyGenotypeIndex')] = self.map_gobyGenotypeIndex.forward_batch(
+            elements=elements, field_prefix=key('gobyGenotypeIndex'), tensors=tensors, index_maps=index_maps)
+
+        num_counts = len(tensors[key('genotypeCountForwardStrand')])
+        mapped_strand_counts = self.map_count.embed_values(tensors[key('genotypeCountForwardStrand')] +
+                                                           tensors[key('genotypeCountReverseStrand')])
+        tensors["mapped$" + key('genotypeCountForwardStrand')] = mapped_strand_counts[0:num_counts]
+        tensors["mapped$" + key('genotypeCountReverseStrand')] = mapped_strand_counts[num_counts:]
+
+        tensors[key('booleans')] = tensors[key('isIndel')] + tensors[key('matchesReference')]
+        mapped_booleans = self.map_boolean.forward_batch(elements=elements, field_prefix=key('booleans'),
+                                                         tensors=tensors, index_maps=index_maps)
+        tensors["mapped$" + key('isIndel')] = mapped_booleans[0:num_counts]
+        tensors["mapped$" + key('matchesReference')] = mapped_booleans[num_counts:]
+
 
 class FrequencyMapper(BatchedStructuredEmbedding):
     def __init__(self,use_cuda=None):
@@ -792,7 +814,8 @@ class FrequencyMapper(BatchedStructuredEmbedding):
         end = start + len(elements)
         index_maps[field_prefix] += list(range(start, end))
         self.set_start_offset(field_prefix, end)
-        return tensors[field_prefix].append(self.forward(elements))
+        # collect the frequencies, the tensor is created by forward_batch:
+        tensors[field_prefix] += elements
 
     def forward_batch(self, elements, field_prefix, tensors, index_maps=[]):
         super().forward_batch(elements, field_prefix, tensors, index_maps)
@@ -800,7 +823,7 @@ class FrequencyMapper(BatchedStructuredEmbedding):
         self.create_tensor_holder(tensors, field_prefix)
         if len(tensors[field_prefix])==0:
             return self.create_empty()
-        result = torch.cat(tensors[field_prefix], dim=0)
+        result = self.forward(tensors[field_prefix])
         tensors[field_prefix] = result
         return result
 
@@ -819,12 +842,15 @@ class FrequencyMapper(BatchedStructuredEmbedding):
 
 
 class MapNumberWithFrequencyList(BatchedStructuredEmbedding):
-    def __init__(self, distinct_numbers=-1, mapped_number_dim=4,use_cuda=False):
+    def __init__(self, distinct_numbers=-1, mapped_number_dim=4,use_cuda=False, sparse=False, log_buckets=False):
         mapped_frequency_dim = 3
         super().__init__(embedding_size=mapped_number_dim + mapped_frequency_dim,use_cuda=use_cuda)
 
         output_dim = mapped_number_dim + mapped_frequency_dim
-        self.map_number = IntegerMapper(distinct_numbers=distinct_numbers, embedding_size=mapped_number_dim,use_cuda=self.use_cuda)
+        # numbers up to 64 (e.g., base and mapping qualities) keep a bucket each:
+        self.map_number = IntegerMapper(distinct_numbers=distinct_numbers, embedding_size=mapped_number_dim,use_cuda=self.use_cuda,
+                                        sparse=sparse, buckets=LogBuckets(max_value=distinct_numbers - 1, linear_limit=64)
+                                        if log_buckets else None)
         self.map_frequency = FrequencyMapper(use_cuda=use_cuda)
         # stores offsets across a batch key is list name, value is offset to use when generating new indices.
         self.start_offsets = {}
@@ -859,7 +885,6 @@ class MapNumberWithFrequencyList(BatchedStructuredEmbedding):
 
         field_prefix += ".nwf"
         start_offset = self.get_start_offset(field_prefix+".list")
-        print("nwf {}: {}".format(field_prefix+".list", start_offset))
 
         number_field = field_prefix + ".number"
         frequency_field = field_prefix + ".frequency"
@@ -878,9 +903,13 @@ class MapNumberWithFrequencyList(BatchedStructuredEmbedding):
                 nwf['indices'] = {}
             index = nwf_index + start_offset
             nwf['index'] = index
-            self.map_number.collect_tensors([nwf['number']], field_prefix + '.number', tensors, index_maps)
-            self.map_frequency.collect_tensors([nwf['frequency']], field_prefix + '.frequency', tensors, index_maps)
-        print("nwf {}: {}".format(field_prefix + ".list", index+1))
+        if len(list_of_nwf) > 0:
+            # the numbers and frequencies of the whole list are collected at once, and embedded at once for the
+            # batch by forward_batch:
+            self.map_number.collect_tensors([nwf['number'] for nwf in list_of_nwf], number_field, tensors,
+                                            index_maps)
+            self.map_frequency.collect_tensors([nwf['frequency'] for nwf in list_of_nwf], frequency_field, tensors,
+                                               index_maps)
         self.set_start_offset(field_prefix + ".list",index+1)
 
         return tensors
@@ -894,44 +923,49 @@ class MapNumberWithFrequencyList(BatchedStructuredEmbedding):
 
         mapped_frequency = self.map_frequency.forward_batch(elements=elements, field_prefix=field_prefix + '.frequency',
                                                             tensors=tensors,
-                                                            index_maps=[nwf['indices'] for nwf in elements])
+                                                            index_maps=index_maps)
 
         mapped_number = self.map_number.forward_batch(elements=elements, field_prefix=field_prefix + '.number',
-                                                      tensors=tensors, index_maps=[nwf['indices'] for nwf in elements])
-        mapped_tensors = []
-        # then go through each element and assign the slices:
-        for index_map in index_maps:
-            index_map["mean-input$" + field_prefix] = []
-            # do not concat empty fields:
-            if (field_prefix + '.frequency') in index_map.keys():
-                frequency_indices = index_map[field_prefix + '.frequency']
-                number_indices = index_map[field_prefix + '.number']
-                for frequency_index, number_index in zip(iter(frequency_indices), iter(number_indices)):
-                    index_map["mean-input$" + field_prefix].append(
-                        torch.cat([mapped_number[frequency_index].view(1, -1),
-                                   mapped_frequency[number_index].view(1, -1)],
-                                  dim=1))
-            else:
-                # print("Appending empty for " + field_prefix)
-                index_map["mean-input$" + field_prefix].append(torch.cat(
-                    [self.map_number.create_empty().view(1, -1),
-                     self.map_frequency.create_empty().view(1, -1)], dim=1))
-            mapped_tensors.append(self.mean_sequence(torch.stack(index_map["mean-input$" + field_prefix])))
-
-        result = torch.stack(mapped_tensors)
+                                                      tensors=tensors, index_maps=index_maps)
+        # each index map holds the indices of the elements of one list, the lists are segments of the batch:
+        element_indices = []
+        segment_ids = []
+        segment_lengths = []
+        for list_index, index_map in enumerate(index_maps):
+            list_indices = index_map.get(field_prefix + '.number', [])
+            element_indices += list_indices
+            segment_ids += [list_index] * len(list_indices)
+            segment_lengths.append(max(1, len(list_indices)))
+        num_lists = len(index_maps)
+        sums = Variable(torch.zeros(num_lists, self.embedding_size))
+        if self.use_cuda:
+            sums = sums.cuda(async=True)
+        if len(element_indices) > 0:
+            mapped_elements = torch.cat([mapped_number, mapped_frequency], dim=1).index_select(
+                0, self.define_long_variable(element_indices))
+            sums = sums.index_add(0, self.define_long_variable(segment_ids), mapped_elements)
+        # mean over the elements of each list, empty lists are mapped to zeros:
+        lengths = Variable(torch.FloatTensor(segment_lengths).view(-1, 1))
+        if self.use_cuda:
+            lengths = lengths.cuda(async=True)
+        result = (sums / lengths).view(num_lists, 1, self.embedding_size)
         tensors[field_prefix] = result
         return result
 
 
-def configure_mappers(ploidy, extra_genotypes, num_samples, sample_dim=64, count_dim=64,use_cuda=False):
+def configure_mappers(ploidy, extra_genotypes, num_samples, sample_dim=64, count_dim=64,use_cuda=False,
+                      sparse_embeddings=False, log_buckets=False):
     """Return a tuple with two elements:
     mapper-dictionary: key is name of message type. value is function to map the message.
-    all-modules: list of modules that implement mapping. """
+    all-modules: list of modules that implement mapping.
+    :param sparse_embeddings: use sparse gradients for the embeddings of counts and NumberWithFrequency lists.
+    :param log_buckets: embed counts and NumberWithFrequency numbers by log-scale bucket (see LogBuckets)."""
 
     num_counts = ploidy + extra_genotypes
 
     map_CountInfo = MapCountInfo(mapped_count_dim=5, count_dim=count_dim, mapped_base_dim=2,
-                                 mapped_genotype_index_dim=2,use_cuda=use_cuda)
+                                 mapped_genotype_index_dim=2,use_cuda=use_cuda, sparse_embeddings=sparse_embeddings,
+                                 log_buckets=log_buckets)
     map_SampleInfo = MapSampleInfo(count_mapper=map_CountInfo, num_counts=num_counts, count_dim=count_dim,
                                    sample_dim=sample_dim,use_cuda=use_cuda)
     map_SbiRecords = MapBaseInformation(sample_mapper=map_SampleInfo, num_samples=num_samples, sample_dim=sample_dim,
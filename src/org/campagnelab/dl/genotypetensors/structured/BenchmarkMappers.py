@@ -0,0 +1,241 @@
+'''Micro-benchmarks of the batched structured mappers: time to collect, forward and backward, per record. Also times
+SbiTensorizer and the tensor path of the structured mappers (MapSampleInfo.forward_tensors).'''
+import argparse
+import copy
+import json
+import platform
+import random
+import time
+
+import torch
+import ujson
+from torch.autograd import Variable
+
+from org.campagnelab.dl.genotypetensors.structured.BatchedSbiMappers import sbi_json_string, configure_mappers, \
+    BatchedStructuredEmbedding
+from org.campagnelab.dl.genotypetensors.structured.SbiMappers import configure_mappers as configure_sbi_mappers
+from org.campagnelab.dl.genotypetensors.structured.Tensorizer import SbiTensorizer
+
+BASES = ('A', 'C', 'T', 'G')
+PHASES = ("collect", "forward", "backward")
+
+
+def synthetic_records(batch_size, num_counts, list_length, seed=0):
+    """
+    Return batch_size records derived from sbi_json_string. Each record has one sample with num_counts observed
+    counts, NumberWithFrequency lists of list_length elements and a genomic context of list_length bases.
+    """
+    rng = random.Random(seed)
+    template = ujson.loads(sbi_json_string)
+    template_count = template['samples'][0]['counts'][0]
+    records = []
+    for _ in range(batch_size):
+        record = copy.deepcopy(template)
+        record['genomicSequenceContext'] = "".join(rng.choice(BASES) for _ in range(max(1, list_length)))
+        counts = []
+        for count_index in range(num_counts):
+            count = copy.deepcopy(template_count)
+            count['toSequence'] = rng.choice(BASES)
+            count['gobyGenotypeIndex'] = count_index
+            count['genotypeCountForwardStrand'] = rng.randint(1, 50)
+            count['genotypeCountReverseStrand'] = rng.randint(0, 50)
+            for field, value in count.items():
+                if isinstance(value, list):
+                    # numbers stay below the smallest distinct_numbers of the mappers (100):
+                    count[field] = [{"type": "NumberWithFrequency", "number": rng.randrange(100),
+                                     "frequency": rng.randint(1, 20)} for _ in range(list_length)]
+            counts.append(count)
+        record['samples'][0]['counts'] = counts
+        records.append(record)
+    return records
+
+
+def new_batch(mapper):
+    if mapper is None:
+        return
+    for module in mapper.modules():
+        if isinstance(module, BatchedStructuredEmbedding):
+            module.new_batch()
+
+
+def benchmark_cases(mappers):
+    """
+    Return a dictionary from mapper name to a tuple (mapper, collect, forward). collect(records) returns the
+    elements and the collected tensors of the mapper for the records, forward(elements, tensors) maps them.
+    """
+    map_records = mappers["BaseInformation"]
+    map_samples = mappers["SampleInfo"]
+    map_counts = mappers["CountInfo"]
+    map_sequence = map_counts.map_sequence
+    map_nwf = map_counts.frequency_list_mapper_read_indices
+
+    def collect_records(records):
+        return records, map_records.collect_tensors(records, "records", {})
+
+    def collect_samples(records):
+        samples = [record['samples'][0] for record in records]
+        return samples, map_samples.collect_tensors(samples, "samples", {})
+
+    def collect_counts(records):
+        counts = [count for record in records for count in record['samples'][0]['counts']]
+        return counts, map_counts.collect_tensors(counts, "counts", {})
+
+    def collect_sequences(records):
+        tensors = {}
+        for record in records:
+            record['indices'] = {}
+            map_sequence.collect_tensors(record['genomicSequenceContext'], "contexts", tensors, record['indices'])
+        return records, tensors
+
+    def collect_lists(records):
+        lists = [{'list': record['samples'][0]['counts'][0]['readIndicesForwardStrand'], 'indices': {}}
+                 for record in records]
+        tensors = {}
+        for nwf_list in lists:
+            map_nwf.collect_tensors(nwf_list['list'], "lists", tensors, nwf_list['indices'])
+        return lists, tensors
+
+    # forward_batch finds the collected values of each element with its index map:
+    def forward(mapper, field_prefix):
+        return lambda elements, tensors: mapper.forward_batch(elements, field_prefix, tensors,
+                                                              index_maps=[element['indices'] for element in elements])
+
+    return {"MapBaseInformation": (map_records, collect_records, forward(map_records, "records")),
+            "MapSampleInfo": (map_samples, collect_samples, forward(map_samples, "samples")),
+            "MapCountInfo": (map_counts, collect_counts, forward(map_counts, "counts")),
+            "MapSequence": (map_sequence, collect_sequences, forward(map_sequence, "contexts")),
+            "MapNumberWithFrequencyList": (map_nwf, collect_lists, forward(map_nwf, "lists"))}
+
+
+def tensorizer_cases(sbi_mappers, num_counts, use_cuda=False):
+    """
+    Return the cases of the tensor path of the structured mappers (see SbiMappers.configure_mappers), in the format of
+    benchmark_cases. The SbiTensorizer case has no mapper and only times the collect phase (tensorization).
+    MapSampleInfo.forward_tensors collects with the tensorizer, then maps the tensors.
+    """
+    map_samples = sbi_mappers["SampleInfo"]
+    tensorizer = SbiTensorizer(num_counts=num_counts)
+
+    def collect_tensors(records):
+        tensors = {}
+        for key, value in tensorizer(records).items():
+            tensors[key] = Variable(value.cuda(async=True) if use_cuda else value, requires_grad=False)
+        return records, tensors
+
+    return {"SbiTensorizer": (None, lambda records: (records, tensorizer(records)), None),
+            "MapSampleInfo.forward_tensors": (map_samples, collect_tensors,
+                                              lambda elements, tensors: map_samples.forward_tensors(tensors))}
+
+
+def time_mapper(mapper, collect, forward, make_records, repeat, use_cuda=False):
+    """
+    Run collect, forward and backward repeat times (after one warm-up pass) on fresh records, since the mappers
+    store indices in the messages. Return the median time of each phase, in milliseconds per record. When forward is
+    None, only collect is timed and the other phases take 0 ms.
+    """
+
+    def now():
+        if use_cuda:
+            torch.cuda.synchronize()
+        return time.time()
+
+    timings = {phase: [] for phase in PHASES}
+    for iteration in range(repeat + 1):
+        records = make_records()
+        new_batch(mapper)
+        if mapper is not None:
+            mapper.zero_grad()
+        start = now()
+        elements, tensors = collect(records)
+        collected = now()
+        if forward is not None:
+            mapped = forward(elements, tensors)
+            forwarded = now()
+            mapped.sum().backward()
+            done = now()
+        else:
+            forwarded = done = collected
+        if iteration > 0:
+            for phase, elapsed in zip(PHASES, (collected - start, forwarded - collected, done - forwarded)):
+                timings[phase].append(elapsed * 1000.0 / len(records))
+    return {phase: sorted(values)[len(values) // 2] for phase, values in timings.items()}
+
+
+def environment(use_cuda=False):
+    """Describe the machine and the versions the timings were measured with, stored with the baselines."""
+    return {"python": platform.python_version(), "torch": torch.__version__, "platform": platform.platform(),
+            "processor": platform.processor() or platform.machine(),
+            "device": torch.cuda.get_device_name(0) if use_cuda else "cpu"}
+
+
+def find_regressions(results, baseline, tolerance):
+    """
+    Return a list of (case, phase, baseline ms, current ms) for the phases that are more than tolerance (a fraction)
+    slower than in the baseline. Cases missing from the baseline are not compared.
+    """
+    regressions = []
+    for case in sorted(results.keys()):
+        if case not in baseline:
+            continue
+        for phase in PHASES:
+            if results[case][phase] > baseline[case][phase] * (1.0 + tolerance):
+                regressions.append((case, phase, baseline[case][phase], results[case][phase]))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the collect, forward and backward phases of the batched '
+                                                 'structured mappers.')
+    parser.add_argument('--batch-sizes', type=str, default="1,32,128",
+                        help='Comma separated number of records in each batch.')
+    parser.add_argument('--list-lengths', type=str, default="1,16,64",
+                        help='Comma separated lengths of the NumberWithFrequency lists and genomic contexts.')
+    parser.add_argument('--num-counts', type=int, default=4, help='Number of observed counts per sample.')
+    parser.add_argument('--mappers', type=str, default=None,
+                        help='Comma separated names of the mappers to benchmark (default: all).')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of timed passes for each case.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the synthetic records.')
+    parser.add_argument('--cuda', action='store_true', help='Run the mappers on the GPU.')
+    parser.add_argument('--baseline', type=str, default=None,
+                        help='Compare to the timings stored in this file and exit with status 1 on regressions. '
+                             'BenchmarkMappers.baseline.json holds reference timings, see its environment entry '
+                             'for the machine they were measured on.')
+    parser.add_argument('--save-baseline', type=str, default=None, help='Store the timings in this file.')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Flag phases slower than the baseline by more than this fraction.')
+    args = parser.parse_args()
+
+    mappers, _ = configure_mappers(ploidy=2, extra_genotypes=2, num_samples=1, use_cuda=args.cuda)
+    sbi_mappers, _ = configure_sbi_mappers(ploidy=2, extra_genotypes=2, num_samples=1, use_cuda=args.cuda)
+    if args.cuda:
+        sbi_mappers["SampleInfo"].cuda()
+    cases = benchmark_cases(mappers)
+    # the tensorizer maps ploidy + extra_genotypes counts per sample:
+    cases.update(tensorizer_cases(sbi_mappers, num_counts=4, use_cuda=args.cuda))
+    names = cases.keys() if args.mappers is None else args.mappers.split(",")
+    results = {}
+    for name in names:
+        mapper, collect, forward = cases[name]
+        for batch_size in [int(value) for value in args.batch_sizes.split(",")]:
+            for list_length in [int(value) for value in args.list_lengths.split(",")]:
+                case = "{}/batch={}/length={}".format(name, batch_size, list_length)
+                results[case] = time_mapper(mapper, collect, forward,
+                                            lambda: synthetic_records(batch_size, args.num_counts, list_length,
+                                                                      seed=args.seed),
+                                            args.repeat, use_cuda=args.cuda)
+                print("{:<55} collect {:8.3f} forward {:8.3f} backward {:8.3f} ms/record".format(
+                    case, *[results[case][phase] for phase in PHASES]), flush=True)
+
+    if args.save_baseline is not None:
+        with open(args.save_baseline, "w") as baseline_file:
+            # the environment entry is not a case, find_regressions ignores it:
+            json.dump(dict(results, environment=environment(args.cuda)), baseline_file, indent=2, sort_keys=True)
+        print("Timings saved to " + args.save_baseline)
+    if args.baseline is not None:
+        with open(args.baseline) as baseline_file:
+            regressions = find_regressions(results, json.load(baseline_file), args.tolerance)
+        for case, phase, before, after in regressions:
+            print("REGRESSION {} {}: {:.3f} -> {:.3f} ms/record".format(case, phase, before, after))
+        if len(regressions) > 0:
+            exit(1)
+        print("No regression above {:.0%} of the baseline.".format(args.tolerance))
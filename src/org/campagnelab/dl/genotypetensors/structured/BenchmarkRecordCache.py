@@ -0,0 +1,64 @@
+'''Compare the time to tensorize batches of sbi records decoded from json, read through the views of a record cache,
+or sliced from the columns of the record cache.'''
+import argparse
+import os
+import tempfile
+import time
+
+import ujson
+
+from org.campagnelab.dl.genotypetensors.structured.BenchmarkMappers import synthetic_records
+from org.campagnelab.dl.genotypetensors.structured.SbiRecordCache import SbiRecordCache
+from org.campagnelab.dl.genotypetensors.structured.Tensorizer import SbiTensorizer
+
+MODES = ("json", "views", "columns")
+
+
+def time_tensorization(cache, json_lines, tensorizer, batch_size, repeat):
+    """
+    Tensorize all the records of cache in batches of batch_size, repeat times in each mode:
+    json: decode the json lines with ujson and tensorize the dicts,
+    views: tensorize the record views of the cache field by field (SbiTensorizer.tensorize_messages),
+    columns: slice the batch from the columns of the cache (SbiTensorizer.tensorize_record_cache).
+    :return: dictionary from mode to the median time per record, in microseconds.
+    """
+    batches = [range(start, min(start + batch_size, len(cache))) for start in range(0, len(cache), batch_size)]
+    timings = {mode: [] for mode in MODES}
+    for _ in range(repeat):
+        for mode in MODES:
+            start = time.time()
+            for batch in batches:
+                if mode == "json":
+                    tensorizer([ujson.loads(json_lines[index]) for index in batch])
+                elif mode == "views":
+                    tensorizer.tensorize_messages([cache.record_at(index) for index in batch])
+                else:
+                    tensorizer([cache.record_at(index) for index in batch])
+            timings[mode].append((time.time() - start) * 1E6 / len(cache))
+    return {mode: sorted(values)[len(values) // 2] for mode, values in timings.items()}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare json decoding and record cache access for the tensorizer '
+                                                 'of the batched structured model.')
+    parser.add_argument('--num-records', type=int, default=4096, help='Number of synthetic records.')
+    parser.add_argument('--batch-sizes', type=str, default="32,128",
+                        help='Comma separated number of records in each batch.')
+    parser.add_argument('--num-counts', type=int, default=4, help='Number of observed counts per sample.')
+    parser.add_argument('--list-length', type=int, default=16,
+                        help='Length of the NumberWithFrequency lists and genomic contexts.')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of timed passes for each mode.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the synthetic records.')
+    args = parser.parse_args()
+
+    records = synthetic_records(args.num_records, args.num_counts, args.list_length, seed=args.seed)
+    json_lines = [ujson.dumps(record) for record in records]
+    tensorizer = SbiTensorizer(num_counts=args.num_counts)
+    with tempfile.TemporaryDirectory() as directory:
+        cache_path = os.path.join(directory, "records.sbi_record_cache")
+        SbiRecordCache.build(cache_path, records)
+        cache = SbiRecordCache(cache_path)
+        for batch_size in [int(value) for value in args.batch_sizes.split(",")]:
+            timings = time_tensorization(cache, json_lines, tensorizer, batch_size, args.repeat)
+            print("batch={:<5} ".format(batch_size) +
+                  " ".join("{} {:8.1f}".format(mode, timings[mode]) for mode in MODES) + " us/record", flush=True)
@@ -6,11 +6,18 @@ from torchnet.dataset.dataset import Dataset
 from org.campagnelab.dl.genotypetensors.SBIToJsonIterator import sbi_json_generator, SbiToJsonGenerator
 from org.campagnelab.dl.genotypetensors.VectorCache import VectorCache
 from org.campagnelab.dl.genotypetensors.genotype_pytorch_dataset import GenotypeDataset, CachedGenotypeDataset
+from org.campagnelab.dl.genotypetensors.structured.SbiRecordCache import SbiRecordCache, RECORD_CACHE_SUFFIX
 
 
 class StructuredGenotypeDataset(Dataset):
     """Dataset to load an sbi record (JSON object)"""
-    def __init__(self, sbi_basename, vector_names=None, max_records=sys.maxsize, sample_id=0):
+    def __init__(self, sbi_basename, vector_names=None, max_records=sys.maxsize, sample_id=0, use_record_cache=True,
+                 extraction_shards=1):
+        """
+        :param use_record_cache: when True, records are converted once to a columnar record cache (see
+        SbiRecordCache) and served from it, instead of decoding JSON every epoch.
+        :param extraction_shards: number of processes used to convert the sbi file to json (see SbiToJsonGenerator).
+        """
         super().__init__()
         basename, file_extension = os.path.splitext(sbi_basename)
         # load only the labels and metaData from the vec file if vector_names is not None (not present for unlabeled):
@@ -26,15 +33,33 @@ class StructuredGenotypeDataset(Dataset):
             except FileNotFoundError as e:
                 raise Exception("Unable to find vec/vecp files with basename "+str(basename))
         # self.delegate_features=JsonGenotypeDataset(min(max_records,len(self.delegate_labels)),basename=basename)
-        self.delegate_features = JsonGenotypeDataset(max_records, basename=basename)
+        if use_record_cache:
+            self.delegate_features = RecordCacheGenotypeDataset(max_records, basename=basename,
+                                                                extraction_shards=extraction_shards)
+        else:
+            self.delegate_features = JsonGenotypeDataset(max_records, basename=basename,
+                                                         extraction_shards=extraction_shards)
         self.basename = basename
         self.vector_names = vector_names
         self.sample_id = sample_id
         self.max_records = len(self.delegate_labels) if self.delegate_labels else max_records
 
     def __len__(self):
+        if self.delegate_labels is None and self.is_random_access():
+            return min(self.max_records, len(self.delegate_features))
         return self.max_records
 
+    def is_random_access(self):
+        """True when examples can be read in any order (the sbi json cache and the vec cache are both indexed)."""
+        labels_random_access = self.delegate_labels is None or self.delegate_labels.is_random_access
+        return labels_random_access and self.delegate_features.is_random_access()
+
+    def record_lengths(self):
+        """Return the lengths of the records (see SbiRecordCache.record_lengths), or None when not available."""
+        if not hasattr(self.delegate_features, "record_lengths"):
+            return None
+        return self.delegate_features.record_lengths()[0:len(self)]
+
     def __getitem__(self, idx):
         if self.delegate_labels is not None:
             return self.delegate_features[idx], self.delegate_labels[idx]
@@ -44,29 +69,91 @@ class StructuredGenotypeDataset(Dataset):
         #self.delegate_labels.close()
         self.delegate_features.close()
 
+class RecordCacheGenotypeDataset(Dataset):
+    """Dataset over the records of an sbi file, served from a columnar record cache. The cache is built from the json
+    records of the sbi the first time the dataset is used."""
+    def __init__(self, length, basename, extraction_shards=1):
+        super().__init__()
+        self.length = length
+        self.basename = basename
+        self.extraction_shards = extraction_shards
+        self.cache = None
+
+    def _open(self):
+        if self.cache is None:
+            cache_path = self.basename + RECORD_CACHE_SUFFIX
+            if not os.path.isdir(cache_path):
+                print("Building record cache for {}..".format(self.basename))
+                generator = SbiToJsonGenerator(sbi_path=self.basename + ".sbi", sort=True,
+                                               include_frequencies=True, use_cache=True,
+                                               num_shards=self.extraction_shards)
+                try:
+                    SbiRecordCache.build(cache_path, generator)
+                finally:
+                    generator.close()
+                print("Record cache done.")
+            self.cache = SbiRecordCache(cache_path)
+        return self.cache
+
+    def is_random_access(self):
+        return True
+
+    def __len__(self):
+        return min(self.length, len(self._open()))
+
+    def record_lengths(self):
+        return self._open().record_lengths()[0:len(self)]
+
+    def __getitem__(self, idx):
+        return self._open().record_at(idx)
+
+    def close(self):
+        pass
+
+
 class JsonGenotypeDataset(Dataset):
-    def __init__(self, length, basename):
+    """Dataset over the JSON records of an sbi file. When the json cache of the sbi is available, records are read
+    in any order using the byte-offset index of the cache. Otherwise, records are streamed from the sbi-to-json
+    process and must be read in increasing and contiguous index order."""
+    def __init__(self, length, basename, extraction_shards=1):
         super().__init__()
         self.length=length
         self.basename=basename
+        self.extraction_shards=extraction_shards
         self.generator=None
         self.generator_iter=None
+        self.num_read=0
+
+    def _open(self):
+        if self.generator is not None:
+            self.generator.close()
+        self.generator = SbiToJsonGenerator(sbi_path=self.basename + ".sbi", sort=True, num_records=self.length,
+                                            include_frequencies=True, use_cache=True,
+                                            num_shards=self.extraction_shards)
+        self.generator_iter = iter(self.generator)
+        self.num_read = 0
+
+    def is_random_access(self):
+        if self.generator is None:
+            self._open()
+        return self.generator.use_cache
 
     def __len__(self):
+        if self.is_random_access():
+            return len(self.generator)
         return self.length
 
     def __getitem__(self, idx):
-        if idx==0 or self.generator is None:
-            if self.generator is not None:
-                self.generator.close()
-            self.generator = SbiToJsonGenerator(sbi_path=self.basename + ".sbi", sort=True,num_records=self.length,
-                                                include_frequencies=True, use_cache=True)
-            self.generator_iter=iter(self.generator)
-            idx=0
+        if self.is_random_access():
+            return self.generator.record_at(idx)
+        if idx==0 and self.num_read>0:
+            # restart the stream from the first record:
+            self._open()
         if idx>=self.length:
             self.generator.close()
             raise StopIteration
         else:
+            self.num_read += 1
             return next(self.generator_iter)
 
     def __del__(self):
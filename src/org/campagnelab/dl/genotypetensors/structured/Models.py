@@ -1,4 +1,7 @@
 import threading
+from bisect import bisect_right
+from collections import OrderedDict
+from math import ceil
 
 import torch
 from torch.autograd import Variable
@@ -6,44 +9,141 @@ from torch.nn import Module, Embedding, LSTM, Linear, ModuleList
 
 
 class TensorCache:
-    def __init__(self):
-        self.cached_tensors = {}
+    """
+    Cache of the tensors created by the mappers, keyed by the mapped value. Holds at most max_size tensors and
+    evicts the least recently used. Hits and misses are counted per key type (e.g., one type per mapper class).
+    Cached tensors computed from parameters (e.g., embeddings) become stale when the parameters change: call
+    invalidate after each optimizer step. Thread safe, the cache can be shared by the threads that map a batch.
+    """
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self.cached_tensors = OrderedDict()
+        self.key_types = {}
+        self.statistics = {}
         self.lock=threading.Lock()
         self.is_cuda=False
         self.device=-1
 
     def cuda(self,device=0):
-        for key in self.cached_tensors.keys():
-            tensor = self.cached_tensors[key]
-            if not tensor.is_cuda:
-                self.cached_tensors[key] = tensor.cuda(device)
-        self.is_cuda=True
-        self.device=device
-
-    def cache(self, value, tensor_creation_lambda, key=None):
-            if key is None:
-                key=value
-            internal_key=key
-            if internal_key in self.cached_tensors:
-                tensor= self.cached_tensors[internal_key]
-            else:
-                tensor= tensor_creation_lambda(value)
-                if self.is_cuda:
-                    tensor=tensor.cuda(self.device)
-                self.cached_tensors[internal_key] =tensor
-            return Variable(tensor.data,requires_grad=tensor.requires_grad, volatile=tensor.volatile)
-            #return tensor
+        with self.lock:
+            for key in self.cached_tensors.keys():
+                tensor = self.cached_tensors[key]
+                if not tensor.is_cuda:
+                    self.cached_tensors[key] = tensor.cuda(device)
+            self.is_cuda=True
+            self.device=device
+
+    def cache(self, value, tensor_creation_lambda, key=None, key_type=None):
+        """
+        Return the tensor cached for key, or create it from value with tensor_creation_lambda and cache it.
+        :param key: key of the tensor in the cache, value when None.
+        :param key_type: name under which hits and misses are counted, the type of the key when None.
+        """
+        if key is None:
+            key = value
+        if key_type is None:
+            key_type = type(key).__name__
+        with self.lock:
+            counts = self.statistics.setdefault(key_type, {"hits": 0, "misses": 0})
+            if key in self.cached_tensors:
+                counts["hits"] += 1
+                self.cached_tensors.move_to_end(key)
+                return self.cached_tensors[key]
+            counts["misses"] += 1
+        tensor = tensor_creation_lambda(value)
+        if self.is_cuda:
+            tensor = tensor.cuda(self.device)
+        with self.lock:
+            self.cached_tensors[key] = tensor
+            self.key_types[key] = key_type
+            while len(self.cached_tensors) > self.max_size:
+                evicted_key, _ = self.cached_tensors.popitem(last=False)
+                del self.key_types[evicted_key]
+        return tensor
+
+    def invalidate(self, key_type=None):
+        """Remove the cached tensors of a key type, or all the cached tensors when key_type is None."""
+        with self.lock:
+            keys = [key for key, type_of_key in self.key_types.items() if key_type is None or type_of_key == key_type]
+            for key in keys:
+                del self.cached_tensors[key]
+                del self.key_types[key]
+
+    def hit_rate(self, key_type):
+        counts = self.statistics.get(key_type, {"hits": 0, "misses": 0})
+        total = counts["hits"] + counts["misses"]
+        return counts["hits"] / total if total > 0 else float('nan')
+
+    def statistics_message(self):
+        with self.lock:
+            key_types = sorted(self.statistics.keys())
+            return " ".join(["{}: {:.3f} ({} misses)".format(key_type, self.hit_rate(key_type),
+                                                             self.statistics[key_type]["misses"])
+                             for key_type in key_types])
 
 
 class NoCache(TensorCache):
     def __init__(self):
         pass
 
-    def cache(self, value, tensor_creation_lambda,key=None ):
+    def cache(self, value, tensor_creation_lambda, key=None, key_type=None):
         if key is None:
             key = value
         return tensor_creation_lambda(value)
 
+    def invalidate(self, key_type=None):
+        pass
+
+
+class MemoCache:
+    """
+    A memo of mapped values, keyed by the input that was mapped (e.g., a sequence string). Keeps at most max_size
+    values, evicting the least recently used, and counts hits and misses to report the hit rate. Thread safe.
+    """
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.values = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, value_creation_lambda):
+        with self.lock:
+            if key in self.values:
+                self.values.move_to_end(key)
+                self.hits += 1
+                return self.values[key]
+            self.misses += 1
+        value = value_creation_lambda(key)
+        with self.lock:
+            self.values[key] = value
+            while len(self.values) > self.max_size:
+                self.values.popitem(last=False)
+        return value
+
+    def __getstate__(self):
+        # memoized values are not saved with the model:
+        state = dict(self.__dict__)
+        del state["lock"]
+        state["values"] = OrderedDict()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def clear(self):
+        with self.lock:
+            self.values.clear()
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else float('nan')
+
+    def statistics_message(self):
+        return "{} memoized values, hit rate: {:.3f} ({} hits, {} misses)".format(len(self.values), self.hit_rate(),
+                                                                                   self.hits, self.misses)
+
 
 class StructuredEmbedding(Module):
     def __init__(self, embedding_size, use_cuda):
@@ -51,6 +151,33 @@ class StructuredEmbedding(Module):
         self.embedding_size = embedding_size
         self.use_cuda=use_cuda
 
+    def enable_memo(self, max_size):
+        """
+        Memoize the values mapped by this module in eval mode (see memoized). The memo is cleared when the module
+        returns to training mode, since the parameters change.
+        """
+        self.memo = MemoCache(max_size)
+
+    def train(self, mode=True):
+        super().train(mode)
+        # models saved before memos were introduced have no memo attribute:
+        if mode and hasattr(self, "memo") and self.memo is not None:
+            self.memo.clear()
+        return self
+
+    def uses_memo(self):
+        """Return True when mapped values are memoized: the memo is enabled and the module is in eval mode."""
+        return hasattr(self, "memo") and self.memo is not None and not self.training
+
+    def memoized(self, key, map_function):
+        """
+        Return map_function(), or the value memoized for key when the memo is used (see uses_memo). Memoized values
+        do not require gradients.
+        """
+        if self.uses_memo():
+            return self.memo.get(key, lambda key: Variable(map_function().data, requires_grad=False))
+        return map_function()
+
     def define_long_variable(self, values, cuda=None):
         variable = Variable(torch.LongTensor(values), requires_grad=False)
         if self.is_cuda(cuda):
@@ -99,7 +226,7 @@ class map_Boolean(StructuredEmbedding):
 
     def forward(self, predicate, tensor_cache, cuda=None):
         assert isinstance(predicate,bool),"predicate must be a boolean"
-        value= tensor_cache.cache(key=predicate,value=predicate, tensor_creation_lambda=
+        value= tensor_cache.cache(key=predicate,value=predicate, key_type="map_Boolean", tensor_creation_lambda=
         lambda predicate: Variable(torch.FloatTensor([[1, 0]]))  if predicate else  Variable(torch.FloatTensor([[0, 1]])))
         if self.use_cuda:
             value=value.cuda(async=True)
@@ -127,17 +254,71 @@ class map_Boolean(StructuredEmbedding):
         else:
             return result
 
+class LogBuckets:
+    """
+    Assigns integers to buckets on a log scale: values below linear_limit each have their own bucket, larger values
+    share buckets that cover 1/buckets_per_octave of a doubling, up to max_value. Negative values fall in the first
+    bucket and values larger than max_value in the last one, including values below the last boundary, which can
+    exceed max_value. Bucket boundaries are integers, so that values are assigned to the same bucket by bucket (one
+    value) and bucket_tensor (a LongTensor of values).
+    """
+
+    def __init__(self, max_value, linear_limit=16, buckets_per_octave=4):
+        self.max_value = max_value
+        boundaries = list(range(min(linear_limit, max_value + 1)))
+        octave = 0
+        while len(boundaries) == 0 or boundaries[-1] < max_value:
+            boundary = int(ceil(linear_limit * 2 ** (octave / buckets_per_octave)))
+            if len(boundaries) == 0 or boundary > boundaries[-1]:
+                boundaries.append(boundary)
+            octave += 1
+        # lower bound of each bucket:
+        self.boundaries = boundaries
+        self.num_buckets = len(boundaries)
+
+    def bucket(self, value):
+        if value > self.max_value:
+            return self.num_buckets - 1
+        return max(0, bisect_right(self.boundaries, value) - 1)
+
+    def bucket_tensor(self, values):
+        """Return the buckets of the values of a LongTensor, as a LongTensor of the same shape."""
+        boundaries = torch.LongTensor(self.boundaries)
+        if values.is_cuda:
+            boundaries = boundaries.cuda()
+        flat_values = values.contiguous().view(-1, 1)
+        buckets = flat_values.expand(flat_values.size(0), self.num_buckets).ge(
+            boundaries.view(1, -1).expand(flat_values.size(0), self.num_buckets)).long().sum(1) - 1
+        buckets = buckets.clamp(min=0).masked_fill_(flat_values.view(-1).gt(self.max_value), self.num_buckets - 1)
+        return buckets.view(values.size())
+
+
 class IntegerModel(StructuredEmbedding):
-    def __init__(self, distinct_numbers, embedding_size,use_cuda):
+    def __init__(self, distinct_numbers, embedding_size,use_cuda, sparse=False, buckets=None):
+        """
+        :param sparse: when True, the embedding produces sparse gradients, which only hold the rows used in a
+        batch. Sparse gradients require an optimizer that supports them (see get_default_optimizer_training).
+        :param buckets: when given (see LogBuckets), values are embedded by bucket, and the embedding has one row per
+        bucket instead of distinct_numbers rows.
+        """
         super().__init__(embedding_size,use_cuda)
-        self.distinct_numbers = distinct_numbers
-        self.embedding = Embedding(distinct_numbers, embedding_size)
+        self.buckets = buckets
+        self.distinct_numbers = distinct_numbers if buckets is None else buckets.num_buckets
+        self.embedding = Embedding(self.distinct_numbers, embedding_size, sparse=sparse)
         self.embedding.requires_grad = True
 
+    def bucket_values(self, values):
+        """Return the rows of the embedding for a list of values."""
+        # models saved before buckets were introduced do not have the attribute:
+        if not hasattr(self, "buckets") or self.buckets is None:
+            return values
+        return [self.buckets.bucket(value) for value in values]
+
     def forward(self, values,tensor_cache=NoCache(), cuda=None):
         """Accepts a list of integer values and produces a batch of batch x embedded-value. """
 
         assert isinstance(values, list), "values must be a list of integers."
+        values = self.bucket_values(values)
         for value in values:
             assert value < self.distinct_numbers, "A value is larger than the embedding input allow: " + str(value)
 
@@ -145,14 +326,14 @@ class IntegerModel(StructuredEmbedding):
         cached_values=[]
         for value in values:
             cached_values+=[
-                tensor_cache.cache(key=(id(self),value),value=value, # one embedded value per IntegerModel and base.
+                tensor_cache.cache(key=(id(self),value),value=value, key_type="IntegerModel", # one embedded value per IntegerModel and base.
                     tensor_creation_lambda=lambda value: self.embedding(self.define_long_variable([value], cuda)))
             ]
         values=torch.cat(cached_values,dim=0)
         return values
 
     def collect_inputs(self,values,phase=0,tensor_cache=NoCache(),cuda=None, batcher=None):
-        return batcher.store_inputs(mapper=self,inputs=self.define_long_variable(values, cuda))
+        return batcher.store_inputs(mapper=self,inputs=self.define_long_variable(self.bucket_values(values), cuda))
 
     def forward_batch(self,batcher,phase=0):
         batched= self.embedding(batcher.get_batched_input(mapper=self))
@@ -199,6 +380,21 @@ class RNNOfList(StructuredEmbedding):
         else:
             return all_outputs.view(1, -1)
 
+    def forward_steps(self, embeddings):
+        """
+        Run one LSTM step from the initial state for each row of embeddings (rows x embedding_size). forward does the
+        same for the elements of a single list, and keeps the output of the last element.
+        :return: a rows x hidden_size Variable.
+        """
+        batch_size = embeddings.size(0)
+        hidden = Variable(torch.zeros(self.num_layers, batch_size, self.hidden_size))
+        memory = Variable(torch.zeros(self.num_layers, batch_size, self.hidden_size))
+        if self.use_cuda:
+            hidden = hidden.cuda(async=True)
+            memory = memory.cuda(async=True)
+        out, states = self.lstm(embeddings.view(batch_size, 1, -1), (hidden, memory))
+        return out.view(batch_size, -1)
+
 
 class Reduce(StructuredEmbedding):
     """ Reduce a list of embedded fields or messages using a feed forward. Requires list to be a constant size """
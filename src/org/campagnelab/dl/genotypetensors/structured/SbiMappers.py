@@ -4,8 +4,9 @@ import torch
 from torch.autograd import Variable
 from torch.nn import Module
 
-from org.campagnelab.dl.genotypetensors.structured.Models import Reduce, IntegerModel, map_Boolean, RNNOfList, \
+from org.campagnelab.dl.genotypetensors.structured.Models import Reduce, IntegerModel, map_Boolean, RNNOfList, LogBuckets, \
     StructuredEmbedding, NoCache, MeanOfList
+from org.campagnelab.dl.genotypetensors.structured.Tensorizer import SbiTensorizer
 
 
 def store_indices_in_message(mapper, message, indices):
@@ -32,12 +33,29 @@ class MapSequence(StructuredEmbedding):
             self.base_to_index[base[0]] = base_index
 
         self.map_bases = IntegerModel(distinct_numbers=len(self.base_to_index), embedding_size=mapped_base_dim,use_cuda=use_cuda)
+        # memo of mapped sequences, used in eval mode only (see enable_memo). Sequences (reference bases, genomic
+        # contexts, from and to sequences) repeat across sites, so most of them are then mapped once:
+        self.memo = None
 
     def forward(self, sequence_field, tensor_cache=NoCache(), cuda=None):
+        return self.memoized(sequence_field, lambda: self.map_sequence_field(sequence_field, tensor_cache, cuda))
+
+    def map_sequence_field(self, sequence_field, tensor_cache, cuda):
         return self.map_sequence(
             self.map_bases(list([self.base_to_index[b] for b in sequence_field]), tensor_cache=tensor_cache, cuda=cuda),
             cuda)
 
+    def forward_tensors(self, bases, lengths):
+        """
+        Map a batch of sequences tensorized by SbiTensorizer.
+        :param bases: num sequences x max length base indices.
+        :param lengths: length of each sequence.
+        :return: num sequences x embedding_size.
+        """
+        # forward maps the last base of each sequence, see RNNOfList:
+        last_bases = bases.gather(1, (lengths - 1).view(-1, 1)).view(-1)
+        return self.map_sequence.forward_steps(self.map_bases.embedding(last_bases))
+
 
 
 class MapBaseInformation(StructuredEmbedding):
@@ -85,6 +103,29 @@ class MapSampleInfo(Module):
                                    observed_counts[0:self.num_counts]],
                                   pad_missing=True, cuda=cuda)
 
+    def forward_tensors(self, tensors):
+        """
+        Map the samples of a batch tensorized by SbiTensorizer. Produces the same result as the collect_inputs and
+        forward_batch phases 0 to 2.
+        :return: num samples x sample_dim.
+        """
+        mapped_counts = self.count_mapper.forward_tensors(tensors)
+        # the tensorizer refers to missing counts with the index of the row after the last count:
+        padding = Variable(torch.zeros(1, self.count_dim))
+        if self.count_mapper.use_cuda:
+            padding = padding.cuda(async=True)
+        padded_counts = torch.cat([mapped_counts, padding], dim=0)
+        sample_counts = tensors["sample.counts"]
+        num_samples = sample_counts.size(0)
+        sample_inputs = padded_counts.index_select(0, sample_counts.view(-1)).view(num_samples, -1)
+        return self.reduce_counts.forward_flat_inputs(sample_inputs)
+
+    def create_tensorizer(self):
+        """Return a SbiTensorizer that extracts the tensors used by forward_tensors."""
+        map_count = self.count_mapper.map_count
+        return SbiTensorizer(num_counts=self.num_counts,
+                             count_buckets=map_count.buckets if hasattr(map_count, "buckets") else None)
+
     def get_observed_counts(self, input):
         return [count for count in input['counts'] if
                 (count['genotypeCountForwardStrand'] + count['genotypeCountReverseStrand']) > 0]
@@ -138,21 +179,33 @@ class MapSampleInfo(Module):
 
 
 class MapCountInfo(StructuredEmbedding):
-    def __init__(self, mapped_count_dim=5, count_dim=64, mapped_base_dim=2, mapped_genotype_index_dim=4,use_cuda=None):
+    def __init__(self, mapped_count_dim=5, count_dim=64, mapped_base_dim=2, mapped_genotype_index_dim=4,use_cuda=None,
+                 sparse_embeddings=False, log_buckets=False):
+        """
+        :param sparse_embeddings: use sparse gradients for the count and NumberWithFrequency embeddings.
+        :param log_buckets: embed counts and the numbers of NumberWithFrequency lists by bucket (see LogBuckets),
+        which reduces the size of their embeddings by orders of magnitude.
+        """
         super().__init__(count_dim,use_cuda)
         self.map_sequence = MapSequence(hidden_size=count_dim,
                                         mapped_base_dim=mapped_base_dim,use_cuda=use_cuda)
         self.map_gobyGenotypeIndex = IntegerModel(distinct_numbers=100, embedding_size=mapped_genotype_index_dim,use_cuda=use_cuda)
 
-        self.map_count = IntegerModel(distinct_numbers=100000, embedding_size=mapped_count_dim,use_cuda=use_cuda)
+        self.map_count = IntegerModel(distinct_numbers=100000, embedding_size=mapped_count_dim,use_cuda=use_cuda,
+                                      sparse=sparse_embeddings,
+                                      buckets=LogBuckets(max_value=100000) if log_buckets else None)
+
+        def nwf_list_mapper(distinct_numbers):
+            return MapNumberWithFrequencyList(distinct_numbers=distinct_numbers, use_cuda=use_cuda,
+                                              sparse=sparse_embeddings, log_buckets=log_buckets)
         self.map_boolean = map_Boolean(use_cuda=use_cuda)
 
-        self.frequency_list_mapper_base_qual = MapNumberWithFrequencyList(distinct_numbers=1000,use_cuda=use_cuda)
-        self.frequency_list_mapper_num_var = MapNumberWithFrequencyList(distinct_numbers=1000,use_cuda=use_cuda)
-        self.frequency_list_mapper_mapping_qual = MapNumberWithFrequencyList(distinct_numbers=100,use_cuda=use_cuda)
-        self.frequency_list_mapper_distance_to = MapNumberWithFrequencyList(distinct_numbers=1000,use_cuda=use_cuda)
-        self.frequency_list_mapper_aligned_lengths = MapNumberWithFrequencyList(distinct_numbers=1000,use_cuda=use_cuda)
-        self.frequency_list_mapper_read_indices = MapNumberWithFrequencyList(distinct_numbers=1000,use_cuda=use_cuda)
+        self.frequency_list_mapper_base_qual = nwf_list_mapper(1000)
+        self.frequency_list_mapper_num_var = nwf_list_mapper(1000)
+        self.frequency_list_mapper_mapping_qual = nwf_list_mapper(100)
+        self.frequency_list_mapper_distance_to = nwf_list_mapper(1000)
+        self.frequency_list_mapper_aligned_lengths = nwf_list_mapper(1000)
+        self.frequency_list_mapper_read_indices = nwf_list_mapper(1000)
 
         count_mappers = [self.map_gobyGenotypeIndex,
                          self.map_boolean,  # isIndel
@@ -185,8 +238,25 @@ class MapCountInfo(StructuredEmbedding):
                                       self.map_count.embedding_size * 2,
                                       self.map_boolean.embedding_size * 2,
                                       self.map_sequence.embedding_size * 2, ], encoding_output_dim=count_dim,use_cuda=use_cuda)
+        # memo of mapped counts, used in eval mode only (see enable_memo). Counts are keyed by the values of the
+        # fields that forward maps (see memo_key), so that identical counts, in the same or in different records,
+        # are mapped once:
+        self.memo = None
+
+    def memo_key(self, c):
+        """Return a hashable key made of the values of the fields of count c that forward maps."""
+        return (c['gobyGenotypeIndex'], c['isIndel'], c['matchesReference'], c['toSequence'],
+                c['genotypeCountForwardStrand'], c['genotypeCountReverseStrand']) + tuple(
+            tuple((nwf['number'], nwf['frequency']) for nwf in c[nf_name]) if nf_name in c.keys() else None
+            for nf_name, _ in self.nf_names_mappers)
 
     def forward(self, c, tensor_cache, cuda=None):
+        # memo_key reads every mapped field, build it only when the memo is used:
+        if self.uses_memo():
+            return self.memoized(self.memo_key(c), lambda: self.map_count_fields(c, tensor_cache, cuda))
+        return self.map_count_fields(c, tensor_cache, cuda)
+
+    def map_count_fields(self, c, tensor_cache, cuda=None):
         mapped_gobyGenotypeIndex = self.map_gobyGenotypeIndex([c['gobyGenotypeIndex']], tensor_cache=tensor_cache,
                                                               cuda=cuda)
         # Do not map isCalled, it is a field that contains the truth and is used to calculate the label.
@@ -220,6 +290,30 @@ class MapCountInfo(StructuredEmbedding):
                 mapped += [variable]
         return self.reduce_count(mapped, cuda)
 
+    def forward_tensors(self, tensors):
+        """
+        Map the counts of a batch tensorized by SbiTensorizer, as done by phases 0 and 1 of collect_inputs.
+        :return: num counts x count_dim.
+        """
+        genotype_counts = tensors["count.genotypeCounts"]
+        num_counts = genotype_counts.size(0)
+        mapped_goby_genotype_indices = self.map_gobyGenotypeIndex.embedding(tensors["count.gobyGenotypeIndex"])
+        if "count.genotypeCountBuckets" in tensors:
+            # buckets computed by the tensorizer:
+            genotype_counts = tensors["count.genotypeCountBuckets"]
+        elif hasattr(self.map_count, "buckets") and self.map_count.buckets is not None:
+            genotype_counts = Variable(self.map_count.buckets.bucket_tensor(genotype_counts.data), requires_grad=False)
+        mapped_counts = self.map_count.embedding(genotype_counts.view(-1)).view(num_counts, -1)
+        # the tensorizer keeps the distinct sequences of the batch, mapped once and then broadcast to the counts:
+        mapped_sequences = torch.cat([
+            self.map_sequence.forward_tensors(tensors["count.fromSequence"], tensors["count.fromSequence.lengths"])
+                .index_select(0, tensors["count.fromSequence.inverse"]),
+            self.map_sequence.forward_tensors(tensors["count.toSequence"], tensors["count.toSequence.lengths"])
+                .index_select(0, tensors["count.toSequence.inverse"])],
+            dim=1)
+        return self.reduce_batched([mapped_goby_genotype_indices, mapped_counts, tensors["count.booleans"],
+                                    mapped_sequences])
+
     def cat_inputs(self, mapper, list_of_values, tensor_cache=NoCache(), phase=0, cuda=False, direct_forward=False):
         mapper_id = id(mapper)
         results = {mapper_id: []}
@@ -331,12 +425,15 @@ class FrequencyMapper(StructuredEmbedding):
 
 
 class MapNumberWithFrequencyList(StructuredEmbedding):
-    def __init__(self, distinct_numbers=-1, mapped_number_dim=4,use_cuda=None):
+    def __init__(self, distinct_numbers=-1, mapped_number_dim=4,use_cuda=None, sparse=False, log_buckets=False):
         mapped_frequency_dim = 3
         super().__init__(embedding_size=mapped_number_dim + mapped_frequency_dim,use_cuda=use_cuda)
 
         output_dim = mapped_number_dim + mapped_frequency_dim
-        self.map_number = IntegerModel(distinct_numbers=distinct_numbers, embedding_size=mapped_number_dim,use_cuda=use_cuda)
+        # numbers up to 64 (e.g., base and mapping qualities) keep a bucket each:
+        self.map_number = IntegerModel(distinct_numbers=distinct_numbers, embedding_size=mapped_number_dim,use_cuda=use_cuda,
+                                       sparse=sparse, buckets=LogBuckets(max_value=distinct_numbers - 1, linear_limit=64)
+                                       if log_buckets else None)
         self.map_frequency = FrequencyMapper(use_cuda=use_cuda)
         # self.map_frequency = Variable(torch.FloatTensor([[]]))
         # IntegerModel(distinct_numbers=distinct_frequencies, embedding_size=mapped_frequency_dim)
@@ -377,15 +474,19 @@ class MapNumberWithFrequencyList(StructuredEmbedding):
                                          values=nwf_list['frequency'], phase=phase, cuda=cuda, batcher=batcher))
 
 
-def configure_mappers(ploidy, extra_genotypes, num_samples, sample_dim=64, count_dim=64,use_cuda=None):
+def configure_mappers(ploidy, extra_genotypes, num_samples, sample_dim=64, count_dim=64,use_cuda=None,
+                      sparse_embeddings=False, log_buckets=False):
     """Return a tuple with two elements:
     mapper-dictionary: key is name of message type. value is function to map the message.
-    all-modules: list of modules that implement mapping. """
+    all-modules: list of modules that implement mapping.
+    :param sparse_embeddings: use sparse gradients for the embeddings of counts and NumberWithFrequency lists.
+    :param log_buckets: embed counts and NumberWithFrequency numbers by log-scale bucket (see LogBuckets)."""
 
     num_counts = ploidy + extra_genotypes
 
     map_CountInfo = MapCountInfo(mapped_count_dim=5, count_dim=count_dim, mapped_base_dim=2,
-                                 mapped_genotype_index_dim=2,use_cuda=use_cuda)
+                                 mapped_genotype_index_dim=2,use_cuda=use_cuda, sparse_embeddings=sparse_embeddings,
+                                 log_buckets=log_buckets)
     map_SampleInfo = MapSampleInfo(count_mapper=map_CountInfo, num_counts=num_counts, count_dim=count_dim,
                                    sample_dim=sample_dim,use_cuda=use_cuda)
     map_SbiRecords = MapBaseInformation(sample_mapper=map_SampleInfo, num_samples=num_samples, sample_dim=sample_dim,
@@ -0,0 +1,352 @@
+import json
+import os
+import shutil
+from array import array
+from collections.abc import MutableMapping
+
+import numpy
+
+RECORD_CACHE_SUFFIX = ".sbi_record_cache"
+
+
+class SbiRecordCacheWriter:
+    """
+    Converts sbi records (JSON objects of type BaseInformation) to a columnar layout: one flat array per field of
+    the records, samples and counts, and offset arrays to find the samples of a record, the counts of a sample and
+    the elements of each NumberWithFrequency list. Strings are stored as concatenated bytes with offsets. Fields
+    may be missing in some messages: a .present column tells which messages have each field. Fields hold booleans,
+    integers, floats (integers are stored as floats once a float was seen in the field), strings or lists of
+    NumberWithFrequency messages. Other nested messages are not supported.
+    """
+
+    def __init__(self):
+        self.num_records = 0
+        self.num_samples = 0
+        self.num_counts = 0
+        # field name -> kind, for record, sample and count fields:
+        self.schema = {"record": {}, "sample": {}, "count": {}}
+        self.columns = {"record.samples": array('q', [0]), "sample.counts": array('q', [0])}
+
+    def _int_column(self, name, typecode='q', initial=None):
+        if name not in self.columns:
+            self.columns[name] = array(typecode, [] if initial is None else initial)
+        return self.columns[name]
+
+    @staticmethod
+    def _kind(name, value):
+        if isinstance(value, bool):
+            return "bool"
+        if isinstance(value, int):
+            return "int"
+        if isinstance(value, float):
+            return "float"
+        if isinstance(value, str):
+            return "str"
+        if isinstance(value, list):
+            return "nwf"
+        assert False, "field {} has unsupported value {}".format(name, value)
+
+    def _add_scalar(self, level, field, value, index):
+        name = level + "." + field
+        kind = self._kind(name, value)
+        previous_kind = self.schema[level].setdefault(field, kind)
+        if previous_kind == "float" and kind == "int":
+            kind = "float"
+        elif previous_kind == "int" and kind == "float":
+            self.columns[name] = array('d', self.columns[name])
+            self.schema[level][field] = "float"
+        assert self.schema[level][field] == kind, "field {} changed kind.".format(name)
+        self._pad(name, kind, index)
+        if kind == "str":
+            data = self.columns.setdefault(name + ".bytes", array('B'))
+            data.frombytes(value.encode())
+            self.columns[name + ".offsets"].append(len(data))
+        elif kind == "nwf":
+            numbers = self._int_column(name + ".number")
+            frequencies = self._int_column(name + ".frequency")
+            for nwf in value:
+                numbers.append(nwf["number"])
+                frequencies.append(nwf["frequency"])
+            self.columns[name + ".offsets"].append(len(numbers))
+        else:
+            self.columns[name].append(value)
+        self.columns[name + ".present"].append(True)
+
+    def _pad(self, name, kind, num_messages):
+        """Create the columns of field name if needed, and pad them to num_messages messages without the field."""
+        present = self._int_column(name + ".present", typecode='b')
+        if kind in ("str", "nwf"):
+            values = self._int_column(name + ".offsets", initial=[0])
+        else:
+            values = self._int_column(name, typecode={"bool": 'b', "int": 'q', "float": 'd'}[kind])
+        while len(present) < num_messages:
+            present.append(False)
+            values.append(values[-1] if kind in ("str", "nwf") else 0)
+
+    def add_record(self, record):
+        assert record["type"] == "BaseInformation", "Only records of type BaseInformation can be cached."
+        for field, value in record.items():
+            if field not in ("type", "samples"):
+                self._add_scalar("record", field, value, self.num_records)
+        for sample in record["samples"]:
+            for field, value in sample.items():
+                if field not in ("type", "counts"):
+                    self._add_scalar("sample", field, value, self.num_samples)
+            for count in sample["counts"]:
+                for field, value in count.items():
+                    if field != "type":
+                        self._add_scalar("count", field, value, self.num_counts)
+                self.num_counts += 1
+            self.num_samples += 1
+            self.columns["sample.counts"].append(self.num_counts)
+        self.num_records += 1
+        self.columns["record.samples"].append(self.num_samples)
+
+    def save(self, path):
+        """Write the columns to directory path. The directory is renamed into place when complete."""
+        num_messages = {"record": self.num_records, "sample": self.num_samples, "count": self.num_counts}
+        for level, fields in self.schema.items():
+            for field, kind in fields.items():
+                self._pad(level + "." + field, kind, num_messages[level])
+        temp_path = "{}.{}.tmp".format(path, os.getpid())
+        os.makedirs(temp_path, exist_ok=True)
+        for name, column in self.columns.items():
+            numpy.save(os.path.join(temp_path, name + ".npy"), numpy.array(column, dtype=column.typecode))
+        with open(os.path.join(temp_path, "schema.json"), "w") as schema_file:
+            json.dump({"num_records": self.num_records, "fields": self.schema,
+                       "columns": list(self.columns.keys())}, schema_file)
+        if os.path.isdir(path):
+            # another process built the cache concurrently:
+            shutil.rmtree(temp_path)
+        else:
+            os.replace(temp_path, path)
+
+
+class SbiRecordCache:
+    """
+    Read access to the columns written by SbiRecordCacheWriter. Columns are memory mapped, so that DataLoader workers
+    share the pages of the cache. record_at returns a view of the record that reads fields from the columns as the
+    mappers access them, without parsing JSON.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "schema.json")) as schema_file:
+            schema = json.load(schema_file)
+        self.num_records = schema["num_records"]
+        self.record_fields = schema["fields"]["record"]
+        # caches written before sample fields were stored have no sample level:
+        self.sample_fields = schema["fields"].get("sample", {})
+        self.count_fields = schema["fields"]["count"]
+        self.columns = {name: numpy.load(os.path.join(path, name + ".npy"), mmap_mode="r")
+                        for name in schema["columns"]}
+
+    @staticmethod
+    def build(path, records):
+        """Convert the records (an iterable over sbi JSON records) to a record cache stored at path."""
+        writer = SbiRecordCacheWriter()
+        for record in records:
+            writer.add_record(record)
+        writer.save(path)
+
+    def __len__(self):
+        return self.num_records
+
+    def record_at(self, index):
+        assert 0 <= index < self.num_records, "index {} out of record cache bounds {} {}.".format(index, 0,
+                                                                                                self.num_records)
+        return RecordView(self, index)
+
+    def string_lengths(self, name):
+        return numpy.diff(self.columns[name + ".offsets"])
+
+    def record_lengths(self):
+        """
+        Return the sizes of the records, computed from the columns without creating views: a numpy int64 array of
+        shape (num_records, 3) with the number of counts, the number of NumberWithFrequency elements and the length
+        of the longest sequence (genomic context, from or to sequence of the counts) of each record.
+        """
+        count_offsets = numpy.asarray(self.columns["sample.counts"])[numpy.asarray(self.columns["record.samples"])]
+        num_counts = numpy.diff(count_offsets)
+        num_elements_per_count = numpy.zeros(int(count_offsets[-1]), dtype=numpy.int64)
+        sequence_length_per_count = numpy.zeros(int(count_offsets[-1]), dtype=numpy.int64)
+        for field, kind in self.count_fields.items():
+            if kind == "nwf":
+                num_elements_per_count += numpy.diff(self.columns["count." + field + ".offsets"])
+            elif kind == "str" and field in ("fromSequence", "toSequence"):
+                sequence_length_per_count = numpy.maximum(sequence_length_per_count,
+                                                          self.string_lengths("count." + field))
+        # per record sums and maxima over the counts of the record, records without counts keep zeros:
+        num_elements = numpy.zeros(self.num_records, dtype=numpy.int64)
+        sequence_lengths = numpy.zeros(self.num_records, dtype=numpy.int64)
+        with_counts = num_counts > 0
+        if with_counts.any():
+            starts = count_offsets[:-1][with_counts]
+            num_elements[with_counts] = numpy.add.reduceat(num_elements_per_count, starts)
+            sequence_lengths[with_counts] = numpy.maximum.reduceat(sequence_length_per_count, starts)
+        if self.record_fields.get("genomicSequenceContext") == "str":
+            sequence_lengths = numpy.maximum(sequence_lengths,
+                                             self.string_lengths("record.genomicSequenceContext"))
+        return numpy.stack([num_counts, num_elements, sequence_lengths], axis=1).astype(numpy.int64)
+
+    def range(self, name, index):
+        offsets = self.columns[name]
+        return int(offsets[index]), int(offsets[index + 1])
+
+    def string(self, name, index):
+        start, end = self.range(name + ".offsets", index)
+        return self.columns[name + ".bytes"][start:end].tobytes().decode()
+
+    def present(self, name, index):
+        # caches written before scalar fields could be missing only have .present columns for the lists:
+        present = self.columns.get(name + ".present")
+        return present is None or bool(present[index])
+
+    def field_names(self, level, fields, index):
+        """Return the names of the fields of fields (a schema level) present in message index of the level."""
+        return [field for field in fields if self.present(level + "." + field, index)]
+
+    def value(self, level, fields, key, index):
+        """
+        Return field key of message index of a level (record, sample or count), where fields is the schema of the
+        level. Raise KeyError when the message does not have the field.
+        """
+        kind = fields.get(key)
+        name = level + "." + key
+        if kind is None or not self.present(name, index):
+            raise KeyError(key)
+        if kind == "str":
+            return self.string(name, index)
+        if kind == "nwf":
+            start, end = self.range(name + ".offsets", index)
+            return [NumberWithFrequencyView(self, name, element_index) for element_index in range(start, end)]
+        value = self.columns[name][index].item()
+        return bool(value) if kind == "bool" else value
+
+
+# caches opened in this process, by path. Used to unpickle views sent by DataLoader worker processes:
+_open_caches = {}
+
+
+def _open_cache(path):
+    if path not in _open_caches:
+        _open_caches[path] = SbiRecordCache(path)
+    return _open_caches[path]
+
+
+def _record_view(path, index):
+    return RecordView(_open_cache(path), index)
+
+
+class MessageView(MutableMapping):
+    """
+    A message (record, sample, count or NumberWithFrequency) backed by the columns of a record cache. Values set
+    on the view (e.g., the indices stored by the mappers) are kept with the view and hide the cached fields.
+    Lists of nested messages are created on first access and then reused, so that values set on them are
+    preserved. Views of the batched path (see SbiTensorizer.tensorize_record_cache) are only used for their index.
+    """
+    message_type = None
+
+    def __init__(self, cache, index):
+        self.cache = cache
+        self.index = index
+        # values set on the view and lists of nested messages, created when first needed:
+        self.values = None
+
+    def field_names(self):
+        return []
+
+    def field(self, key):
+        raise KeyError(key)
+
+    def __getitem__(self, key):
+        if self.values is not None and key in self.values:
+            return self.values[key]
+        if key == "type":
+            return self.message_type
+        value = self.field(key)
+        if isinstance(value, list):
+            self[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        if self.values is None:
+            self.values = {}
+        self.values[key] = value
+
+    def __delitem__(self, key):
+        if self.values is None:
+            raise KeyError(key)
+        del self.values[key]
+
+    def __iter__(self):
+        yield "type"
+        field_names = self.field_names()
+        for key in field_names:
+            yield key
+        if self.values is not None:
+            for key in self.values:
+                if key not in field_names:
+                    yield key
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    def __contains__(self, key):
+        return (key == "type" or (self.values is not None and key in self.values)
+                or key in self.field_names())
+
+
+class RecordView(MessageView):
+    message_type = "BaseInformation"
+
+    def __reduce__(self):
+        return _record_view, (self.cache.path, self.index)
+
+    def field_names(self):
+        return self.cache.field_names("record", self.cache.record_fields, self.index) + ["samples"]
+
+    def field(self, key):
+        if key == "samples":
+            start, end = self.cache.range("record.samples", self.index)
+            return [SampleView(self.cache, sample_index) for sample_index in range(start, end)]
+        return self.cache.value("record", self.cache.record_fields, key, self.index)
+
+
+class SampleView(MessageView):
+    message_type = "SampleInfo"
+
+    def field_names(self):
+        return self.cache.field_names("sample", self.cache.sample_fields, self.index) + ["counts"]
+
+    def field(self, key):
+        if key == "counts":
+            start, end = self.cache.range("sample.counts", self.index)
+            return [CountView(self.cache, count_index) for count_index in range(start, end)]
+        return self.cache.value("sample", self.cache.sample_fields, key, self.index)
+
+
+class CountView(MessageView):
+    message_type = "CountInfo"
+
+    def field_names(self):
+        return self.cache.field_names("count", self.cache.count_fields, self.index)
+
+    def field(self, key):
+        return self.cache.value("count", self.cache.count_fields, key, self.index)
+
+
+class NumberWithFrequencyView(MessageView):
+    message_type = "NumberWithFrequency"
+
+    def __init__(self, cache, list_name, index):
+        super().__init__(cache, index)
+        self.list_name = list_name
+
+    def field_names(self):
+        return ["number", "frequency"]
+
+    def field(self, key):
+        if key not in ("number", "frequency"):
+            raise KeyError(key)
+        return self.cache.columns[self.list_name + "." + key][self.index].item()
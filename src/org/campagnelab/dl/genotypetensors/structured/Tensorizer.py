@@ -0,0 +1,226 @@
+import numpy
+import torch
+
+from org.campagnelab.dl.genotypetensors.structured.SbiRecordCache import RecordView
+
+
+class SbiTensorizer:
+    """
+    Extracts from a list of sbi records the fields mapped by the batched path of SbiMappers (MapSampleInfo and
+    MapCountInfo), and stores them in tensors. Designed to run in the collate function of DataLoader workers, so that
+    the training thread only runs the embedding and reduction kernels (see MapSampleInfo.forward_tensors).
+    """
+
+    def __init__(self, num_counts, bases=('A', 'C', 'T', 'G', '-', 'N'), count_buckets=None):
+        """
+        :param num_counts: maximum number of observed counts mapped per sample (ploidy + extra genotypes).
+        :param bases: bases in the order used by MapSequence.
+        :param count_buckets: buckets of the genotype counts (see LogBuckets), when the count embedding uses them.
+        """
+        self.num_counts = num_counts
+        self.count_buckets = count_buckets
+        self.base_to_index = {}
+        for base_index, base in enumerate(bases):
+            self.base_to_index[base[0]] = base_index
+        # base index of each byte, -1 for bytes that are not bases (see tensorize_record_cache):
+        self.byte_to_index = numpy.full(256, -1, dtype=numpy.int64)
+        for base, base_index in self.base_to_index.items():
+            self.byte_to_index[ord(base)] = base_index
+
+    def observed_counts(self, sample):
+        return [count for count in sample['counts'] if
+                (count['genotypeCountForwardStrand'] + count['genotypeCountReverseStrand']) > 0][0:self.num_counts]
+
+    def sequences(self, sequences):
+        """
+        Return a LongTensor of base indices for the distinct sequences (num distinct sequences x max length, padded
+        with zeros), their lengths, and for each sequence the row of the distinct sequence it is equal to.
+        """
+        rows = {}
+        inverse = [rows.setdefault(sequence, len(rows)) for sequence in sequences]
+        distinct_sequences = sorted(rows.keys(), key=lambda sequence: rows[sequence])
+        lengths = [len(sequence) for sequence in distinct_sequences]
+        assert all(length > 0 for length in lengths), "sequences must not be empty."
+        bases = torch.zeros(len(distinct_sequences), max(lengths, default=1)).long()
+        for row, sequence in enumerate(distinct_sequences):
+            bases[row, 0:len(sequence)] = torch.LongTensor([self.base_to_index[base] for base in sequence])
+        return bases, torch.LongTensor(lengths), torch.LongTensor(inverse)
+
+    def __call__(self, records):
+        """
+        :param records: list of sbi records (BaseInformation messages).
+        :return: dictionary of tensors. Keys starting with count. have one row per observed count of the batch,
+        sample.counts has one row per sample with the indices of its counts, where the index num_counts_in_batch
+        stands for a missing count. Sequences are stored once per distinct sequence of the batch, the .inverse keys
+        give the row of the sequence of each count. When count_buckets is set, count.genotypeCountBuckets holds the
+        buckets of count.genotypeCounts. Records served by a record cache are tensorized from its columns (see
+        tensorize_record_cache).
+        """
+        if len(records) > 0 and all(isinstance(record, RecordView) and record.cache is records[0].cache
+                                    for record in records):
+            return self.tensorize_record_cache(records[0].cache, [record.index for record in records])
+        return self.tensorize_messages(records)
+
+    def tensorize_messages(self, records):
+        """Return the tensors of __call__, read from the fields of the records (dicts or views)."""
+        counts = []
+        samples = []
+        for record in records:
+            for sample in record['samples']:
+                observed = self.observed_counts(sample)
+                samples.append(list(range(len(counts), len(counts) + len(observed))))
+                counts += observed
+        num_counts_in_batch = len(counts)
+        sample_counts = torch.LongTensor(len(samples), self.num_counts).fill_(num_counts_in_batch)
+        for row, count_indices in enumerate(samples):
+            if len(count_indices) > 0:
+                sample_counts[row, 0:len(count_indices)] = torch.LongTensor(count_indices)
+
+        booleans = torch.zeros(num_counts_in_batch, 4)
+        for row, count in enumerate(counts):
+            # one-hot encoding used by map_Boolean: [1, 0] for True, [0, 1] for False.
+            booleans[row, 0 if count['isIndel'] else 1] = 1
+            booleans[row, 2 if count['matchesReference'] else 3] = 1
+
+        from_bases, from_lengths, from_inverse = self.sequences([count['fromSequence'] for count in counts])
+        to_bases, to_lengths, to_inverse = self.sequences([count['toSequence'] for count in counts])
+        genotype_counts = torch.LongTensor([[count['genotypeCountForwardStrand'],
+                                             count['genotypeCountReverseStrand']] for count in counts])
+        tensors = {"sample.counts": sample_counts,
+                   "count.gobyGenotypeIndex": torch.LongTensor([count['gobyGenotypeIndex'] for count in counts]),
+                   "count.genotypeCounts": genotype_counts,
+                   "count.booleans": booleans,
+                   "count.fromSequence": from_bases,
+                   "count.fromSequence.lengths": from_lengths,
+                   "count.fromSequence.inverse": from_inverse,
+                   "count.toSequence": to_bases,
+                   "count.toSequence.lengths": to_lengths,
+                   "count.toSequence.inverse": to_inverse}
+        if self.count_buckets is not None:
+            tensors["count.genotypeCountBuckets"] = self.count_buckets.bucket_tensor(genotype_counts)
+        return tensors
+
+    def pad(self, tensors, num_samples, max_sequence_length):
+        """
+        Pad the tensors returned by __call__ to static sizes, so that a model traced on padded tensors (see
+        TracedStructModel) maps any batch: num_samples samples, num_samples * num_counts counts and as many
+        sequences, of max_sequence_length bases. Padding samples have no count, padding counts have zero values
+        and refer to the first sequence. The rows of the samples of the batch are mapped as without padding.
+        :return: the padded tensors, or None when the batch has more samples or longer sequences than the static
+        sizes.
+        """
+        sample_counts = tensors["sample.counts"]
+        num_counts_in_batch = tensors["count.genotypeCounts"].size(0)
+        max_counts = num_samples * self.num_counts
+        sequence_keys = ["count.fromSequence", "count.toSequence"]
+        if sample_counts.size(0) > num_samples or any(tensors[key].size(1) > max_sequence_length
+                                                      for key in sequence_keys):
+            return None
+        # missing counts refer to the row after the last count, which moves to max_counts:
+        sample_counts = sample_counts.clone().masked_fill_(sample_counts.eq(num_counts_in_batch), max_counts)
+        padded = {"sample.counts": self._pad_rows(sample_counts, num_samples, max_counts)}
+        for key in ["count.gobyGenotypeIndex", "count.booleans", "count.fromSequence.inverse",
+                    "count.toSequence.inverse"]:
+            padded[key] = self._pad_rows(tensors[key], max_counts, 0)
+        for key in ["count.genotypeCounts", "count.genotypeCountBuckets"]:
+            if key in tensors:
+                # batches without counts have an empty LongTensor of genotype counts, without the strand dimension:
+                padded[key] = self._pad_rows(tensors[key].contiguous().view(-1, 2), max_counts, 0)
+        for key in sequence_keys:
+            bases = tensors[key]
+            padded_bases = bases.new(max_counts, max_sequence_length).zero_()
+            if bases.size(0) > 0:
+                padded_bases[0:bases.size(0), 0:bases.size(1)] = bases
+            padded[key] = padded_bases
+            padded[key + ".lengths"] = self._pad_rows(tensors[key + ".lengths"], max_counts, 1)
+        return padded
+
+    @staticmethod
+    def _pad_rows(tensor, num_rows, value):
+        """Return tensor with rows filled with value appended, up to num_rows rows."""
+        padded = tensor.new(num_rows, *tensor.size()[1:]).fill_(value)
+        if tensor.size(0) > 0:
+            padded[0:tensor.size(0)] = tensor
+        return padded
+
+    @staticmethod
+    def _ranges(offsets, indices):
+        """
+        Return the concatenation of the ranges offsets[index]..offsets[index + 1] for index in indices, and the
+        length of each range.
+        """
+        starts = offsets[indices]
+        lengths = offsets[indices + 1] - starts
+        ends = numpy.cumsum(lengths)
+        flat = numpy.arange(ends[-1] if len(ends) > 0 else 0, dtype=numpy.int64)
+        flat += numpy.repeat(starts - (ends - lengths), lengths)
+        return flat, lengths
+
+    def _cached_sequences(self, cache, name, counts):
+        """Same as sequences, for the strings of field name of the counts of a record cache."""
+        if len(counts) == 0:
+            return torch.zeros(0, 1).long(), torch.LongTensor(), torch.LongTensor()
+        offsets = numpy.asarray(cache.columns[name + ".offsets"])
+        starts = offsets[counts]
+        lengths = offsets[counts + 1] - starts
+        assert (lengths > 0).all(), "sequences must not be empty."
+        max_length = int(lengths.max())
+        positions = numpy.arange(max_length, dtype=numpy.int64)
+        in_sequence = positions[None, :] < lengths[:, None]
+        data = numpy.asarray(cache.columns[name + ".bytes"])
+        bases = self.byte_to_index[data[numpy.where(in_sequence, starts[:, None] + positions[None, :], 0)]]
+        assert (bases[in_sequence] >= 0).all(), "sequences must only contain the bases of the tensorizer."
+        bases[~in_sequence] = 0
+        # distinct sequences, in the order of their first occurrence:
+        rows = numpy.concatenate([lengths[:, None], bases], axis=1)
+        _, first, inverse = numpy.unique(rows, axis=0, return_index=True, return_inverse=True)
+        order = numpy.argsort(first)
+        rank = numpy.empty_like(order)
+        rank[order] = numpy.arange(len(order))
+        distinct = first[order]
+        return (torch.from_numpy(numpy.ascontiguousarray(bases[distinct])),
+                torch.from_numpy(numpy.ascontiguousarray(lengths[distinct])),
+                torch.from_numpy(numpy.ascontiguousarray(rank[inverse.reshape(-1)])))
+
+    def tensorize_record_cache(self, cache, record_indices):
+        """
+        Return the same tensors as __call__ for the records at record_indices of a SbiRecordCache. The tensors are
+        sliced from the columns of the cache, without creating views of the records, samples and counts.
+        """
+        record_indices = numpy.asarray(record_indices, dtype=numpy.int64)
+        samples, _ = self._ranges(numpy.asarray(cache.columns["record.samples"]), record_indices)
+        counts, counts_per_sample = self._ranges(numpy.asarray(cache.columns["sample.counts"]), samples)
+        sample_of_count = numpy.repeat(numpy.arange(len(samples), dtype=numpy.int64), counts_per_sample)
+        forward = numpy.asarray(cache.columns["count.genotypeCountForwardStrand"])[counts]
+        reverse = numpy.asarray(cache.columns["count.genotypeCountReverseStrand"])[counts]
+        observed = (forward + reverse) > 0
+        # rank of each observed count among the observed counts of its sample:
+        observed_before = numpy.cumsum(observed) - observed
+        sample_start_of_count = numpy.repeat(numpy.cumsum(counts_per_sample) - counts_per_sample, counts_per_sample)
+        rank = observed_before - observed_before[sample_start_of_count]
+        kept = observed & (rank < self.num_counts)
+        counts = counts[kept]
+        num_counts_in_batch = len(counts)
+        sample_counts = numpy.full((len(samples), self.num_counts), num_counts_in_batch, dtype=numpy.int64)
+        sample_counts[sample_of_count[kept], rank[kept]] = numpy.arange(num_counts_in_batch, dtype=numpy.int64)
+
+        is_indel = numpy.asarray(cache.columns["count.isIndel"])[counts] != 0
+        matches_reference = numpy.asarray(cache.columns["count.matchesReference"])[counts] != 0
+        booleans = numpy.stack([is_indel, ~is_indel, matches_reference, ~matches_reference], axis=1)
+        from_bases, from_lengths, from_inverse = self._cached_sequences(cache, "count.fromSequence", counts)
+        to_bases, to_lengths, to_inverse = self._cached_sequences(cache, "count.toSequence", counts)
+        genotype_counts = torch.from_numpy(numpy.stack([forward[kept], reverse[kept]], axis=1))
+        goby_genotype_indices = numpy.asarray(cache.columns["count.gobyGenotypeIndex"])[counts]
+        tensors = {"sample.counts": torch.from_numpy(sample_counts),
+                   "count.gobyGenotypeIndex": torch.from_numpy(goby_genotype_indices.astype(numpy.int64)),
+                   "count.genotypeCounts": genotype_counts,
+                   "count.booleans": torch.from_numpy(booleans.astype(numpy.float32)),
+                   "count.fromSequence": from_bases,
+                   "count.fromSequence.lengths": from_lengths,
+                   "count.fromSequence.inverse": from_inverse,
+                   "count.toSequence": to_bases,
+                   "count.toSequence.lengths": to_lengths,
+                   "count.toSequence.inverse": to_inverse}
+        if self.count_buckets is not None:
+            tensors["count.genotypeCountBuckets"] = self.count_buckets.bucket_tensor(genotype_counts)
+        return tensors
@@ -3,7 +3,7 @@ import unittest
 from org.campagnelab.dl.genotypetensors.SBIToJsonIterator import SbiToJsonGenerator
 from org.campagnelab.dl.genotypetensors.autoencoder.struct_genotyping_supervised_trainer import sbi_json_string
 from org.campagnelab.dl.genotypetensors.structured.BatchedSbiMappers import MapSequence, BatchedStructuredEmbedding, \
-    MapCountInfo, MapSampleInfo, MapBaseInformation, MapNumberWithFrequencyList
+    MapCountInfo, MapSampleInfo, MapBaseInformation, MapNumberWithFrequencyList, BooleanMapper, IntegerMapper
 
 use_cuda=True
 class BatchedMappersTestCase(unittest.TestCase):
@@ -29,6 +29,33 @@ class BatchedMappersTestCase(unittest.TestCase):
         print(mapped)
         self.assertIsNotNone(mapped)
 
+    def test_count_fields(self):
+        map_container = MapCountInfo(use_cuda=False)
+        import ujson
+        record = ujson.loads(sbi_json_string)
+        containers = record['samples'][0]['counts'][0:2]
+        tensors = map_container.collect_tensors(containers, "counts", tensors={})
+        map_container.forward_count_fields(containers, "counts.count", tensors)
+        for strand in ['genotypeCountForwardStrand', 'genotypeCountReverseStrand']:
+            expected = map_container.map_count.forward([count[strand] for count in containers])
+            self.assertEqual(expected.data.tolist(), tensors["mapped$counts.count." + strand].data.tolist())
+        self.assertEqual([[0, 1], [0, 1]], tensors["mapped$counts.count.isIndel"].data.tolist())
+        self.assertEqual([[1, 0], [0, 1]], tensors["mapped$counts.count.matchesReference"].data.tolist())
+
+    def test_leaf_mappers(self):
+        map_boolean = BooleanMapper(use_cuda=False)
+        map_integer = IntegerMapper(distinct_numbers=10, embedding_size=3, use_cuda=False)
+        tensors = {}
+        index_maps = {}
+        for predicate, number in [(True, 4), (False, 7), (False, 4)]:
+            map_boolean.collect_tensors(predicate, "isIndel", tensors, index_maps)
+            map_integer.collect_tensors(number, "count", tensors, index_maps)
+        self.assertEqual([0, 1, 2], index_maps["isIndel"])
+        self.assertEqual([[1, 0], [0, 1], [0, 1]], map_boolean.forward_batch([], "isIndel", tensors).data.tolist())
+        mapped = map_integer.forward_batch([], "count", tensors)
+        self.assertEqual(mapped.data.tolist(), map_integer.forward([4, 7, 4]).data.tolist())
+        self.assertEqual(mapped[0].data.tolist(), mapped[2].data.tolist())
+
     def test_sample(self):
 
 
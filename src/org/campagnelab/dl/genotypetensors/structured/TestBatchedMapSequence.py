@@ -48,5 +48,16 @@ class BatchedMappersTestCase(unittest.TestCase):
         print(batch)
         self.assertIsNotNone(batch)
         self.assertEqual(batch.size(0),2)
+
+    def test_packed_sequences(self):
+        map_container = MapContainer(embedding_size=4)
+        containers = [{'sequence': "A"}, {'sequence': "ACTG"}, {'sequence': "GA"}]
+        tensors = map_container.collect_tensors(containers, "", {})
+        batch = map_container.forward_batch(containers, "", tensors)
+        self.assertEqual(batch.size(0), 3)
+        # each sequence is mapped as if it was alone, padding does not change its output:
+        for index, container in enumerate(containers):
+            single = map_container.map_sequence.forward(container['sequence'])
+            self.assertLess((single.data.view(-1) - batch[index].data.view(-1)).abs().max(), 1e-6)
 if __name__ == '__main__':
     unittest.main()
@@ -54,6 +54,22 @@ class BatchedMappersTestCase(unittest.TestCase):
         print(batch)
         self.assertIsNotNone(batch)
 
+    def test_segment_means(self):
+        map_container = MapContainer(embedding_size=4)
+        containers = [{'qualityScores': [{'type': "NumberWithFrequency", 'number': 1, 'frequency': 34},
+                                         {'type': "NumberWithFrequency", 'number': 10, 'frequency': 2}]},
+                      {'qualityScores': []},
+                      {'qualityScores': [{'type': "NumberWithFrequency", 'number': 12, 'frequency': 3}]},
+                      ]
+        tensors = map_container.collect_tensors(containers, "", {})
+        batch = map_container.forward_batch(containers, "", tensors)
+        self.assertEqual((3, 1, map_container.map_nwl.embedding_size), tuple(batch.size()))
+        # each list is reduced to the mean of its elements, empty lists to zeros:
+        for index in [0, 2]:
+            expected = map_container.map_nwl(containers[index]['qualityScores'])
+            self.assertAlmostEqual(0, (batch[index].view(1, -1) - expected.view(1, -1)).abs().sum().data[0], places=5)
+        self.assertEqual(0, batch[1].abs().sum().data[0])
+
     def test_bug_1(self):
         failed_sbi='[{"type": "NumberWithFrequency", "frequency": 7, "number": 40, "indices": {}, "index": 0}, {"type": "NumberWithFrequency", "frequency": 4, "number": 40, "indices": {}, "index": 0}, {"type": "NumberWithFrequency", "frequency": 1, "number": 32, "indices": {}, "index": 0}, {"type": "NumberWithFrequency", "frequency": 6, "number": 42, "indices": {}, "index": 1}, {"type": "NumberWithFrequency", "frequency": 2, "number": 40, "indices": {}, "index": 0}]'
 
@@ -1,15 +1,18 @@
 import unittest
 
 import torch
+from torch.autograd import Variable
 from torch.nn import Module
 
 from org.campagnelab.dl.genotypetensors.autoencoder.ModelTrainers import define_train_auto_encoder_parser
 from org.campagnelab.dl.genotypetensors.autoencoder.struct_genotyping_supervised_trainer import \
-    StructGenotypingSupervisedTrainer, StructGenotypingModel
+    StructGenotypingSupervisedTrainer, StructGenotypingModel, trace_struct_model, sbi_json_string
 from org.campagnelab.dl.genotypetensors.structured.Batcher import Batcher
 from org.campagnelab.dl.genotypetensors.structured.Models import IntegerModel, NoCache, MeanOfList, BatchOfInstances, \
     StructuredEmbedding, map_Boolean
-from org.campagnelab.dl.genotypetensors.structured.SbiMappers import MapCountInfo, MapSampleInfo, configure_mappers
+from org.campagnelab.dl.genotypetensors.structured.SbiMappers import MapCountInfo, MapSampleInfo, configure_mappers, \
+    MapSequence
+from org.campagnelab.dl.genotypetensors.structured.Tensorizer import SbiTensorizer
 from org.campagnelab.dl.problems.StructuredSbiProblem import StructuredSbiGenotypingProblem
 
 
@@ -188,6 +191,56 @@ class BatchedStructuredSbiMapperTestCase(unittest.TestCase):
         batcher.forward_batch(mapper=mapper, phase=2)
         print(batcher.get_forward_for_example(mapper, 0))
 
+    def test_tensorized_sample(self):
+        record_json_string = '{"type":"BaseInformation","referenceBase":"A","genomicSequenceContext":"GCA","samples":[{"type":"SampleInfo","counts":[{"type":"CountInfo","matchesReference":true,"isCalled":true,"isIndel":false,"fromSequence":"A","toSequence":"A","genotypeCountForwardStrand":7,"genotypeCountReverseStrand":32,"gobyGenotypeIndex":0},{"type":"CountInfo","matchesReference":false,"isCalled":false,"isIndel":false,"fromSequence":"A","toSequence":"C","genotypeCountForwardStrand":0,"genotypeCountReverseStrand":1,"gobyGenotypeIndex":2}]}]}'
+        import ujson
+        record = ujson.loads(record_json_string)
+
+        map_CountInfo = MapCountInfo(mapped_count_dim=5, count_dim=16, mapped_base_dim=6,
+                                     mapped_genotype_index_dim=2)
+        map_SampleInfo = MapSampleInfo(count_mapper=map_CountInfo, count_dim=16, sample_dim=32, num_counts=5)
+        batcher = Batcher()
+        for phase in [0, 1, 2]:
+            batcher.collect_inputs(map_SampleInfo, record['samples'][0], phase=phase)
+            batched = batcher.forward_batch(mapper=map_SampleInfo, phase=phase)
+
+        tensors = {key: Variable(value) for key, value in SbiTensorizer(num_counts=5)([record]).items()}
+        tensorized = map_SampleInfo.forward_tensors(tensors)
+        self.assertEqual(batched.size(), tensorized.size())
+        self.assertLess((batched - tensorized).abs().max().data[0], 1E-5)
+
+    def test_sequence_memo(self):
+        map_sequence = MapSequence(hidden_size=8)
+        map_sequence.enable_memo(max_size=2)
+        map_sequence.eval()
+        mapped = map_sequence("ACT")
+        for sequence in ["ACT", "A", "ACT", "G"]:
+            map_sequence(sequence)
+        self.assertEqual(2, map_sequence.memo.hits)
+        self.assertEqual(["ACT", "G"], list(map_sequence.memo.values.keys()))
+        self.assertLess((mapped - map_sequence("ACT")).abs().max().data[0], 1E-6)
+        map_sequence.train()
+        self.assertEqual(0, len(map_sequence.memo.values))
+
+    def test_count_memo(self):
+        record_json_string = '{"type":"BaseInformation","referenceBase":"A","genomicSequenceContext":"GCA","samples":[{"type":"SampleInfo","counts":[{"type":"CountInfo","matchesReference":true,"isCalled":true,"isIndel":false,"fromSequence":"A","toSequence":"A","genotypeCountForwardStrand":7,"genotypeCountReverseStrand":32,"gobyGenotypeIndex":0},{"type":"CountInfo","matchesReference":false,"isCalled":false,"isIndel":false,"fromSequence":"A","toSequence":"C","genotypeCountForwardStrand":0,"genotypeCountReverseStrand":1,"gobyGenotypeIndex":2}]}]}'
+        import ujson
+        counts = ujson.loads(record_json_string)['samples'][0]['counts']
+        map_CountInfo = MapCountInfo(mapped_count_dim=5, count_dim=16, mapped_base_dim=6,
+                                     mapped_genotype_index_dim=2)
+        map_CountInfo.enable_memo(max_size=10)
+        map_CountInfo.eval()
+        mapped = map_CountInfo(counts[0], tensor_cache=NoCache())
+        # the isCalled field is not mapped and does not change the key:
+        counts[1]['isCalled'] = True
+        for count in [counts[0], counts[1], ujson.loads(ujson.dumps(counts[1]))]:
+            map_CountInfo(count, tensor_cache=NoCache())
+        self.assertEqual(2, map_CountInfo.memo.hits)
+        self.assertEqual(2, len(map_CountInfo.memo.values))
+        self.assertLess((mapped - map_CountInfo.map_count_fields(counts[0], NoCache())).abs().max().data[0], 1E-6)
+        map_CountInfo.train()
+        self.assertEqual(0, len(map_CountInfo.memo.values))
+
     def test_map_samples_with_model(self):
         sbi_mappers_configuration = configure_mappers(ploidy=2, extra_genotypes=2, num_samples=1,
                                                       count_dim=16,
@@ -207,6 +260,37 @@ class BatchedStructuredSbiMapperTestCase(unittest.TestCase):
         model = StructGenotypingModel(args, sbi_mapper, mapped_features_size, output_size,use_cuda=False,
                                       use_batching=True)
         print(model.map_sbi_messages(sbi_records=[record]*2,cuda=True))
+    @unittest.skipUnless(hasattr(torch, "jit") and hasattr(torch.jit, "trace"), "pytorch without torch.jit.trace")
+    def test_traced_model_batch_sizes(self):
+        import ujson
+        record = ujson.loads(sbi_json_string)
+        # a record with a single observed count changes the sizes of the count tensors:
+        single_count = ujson.loads(sbi_json_string)
+        for count in single_count['samples'][0]['counts'][1:]:
+            count['genotypeCountForwardStrand'] = 0
+            count['genotypeCountReverseStrand'] = 0
+        sbi_mappers_configuration = configure_mappers(ploidy=2, extra_genotypes=2, num_samples=1, count_dim=16,
+                                                      sample_dim=32)
+        sbi_mapper = BatchOfInstances(*sbi_mappers_configuration)
+        map_SampleInfo = sbi_mappers_configuration[0]["SampleInfo"]
+        tensors = map_SampleInfo.create_tensorizer()([record])
+        mapped_features_size = map_SampleInfo.forward_tensors(
+            {key: Variable(value) for key, value in tensors.items()}).size(1)
+        args = define_train_auto_encoder_parser().parse_args([])
+        model = StructGenotypingModel(args, sbi_mapper, mapped_features_size, [10], use_cuda=False,
+                                      use_batching=True)
+        traced, tensor_model = trace_struct_model(model, [record, record], max_samples=3)
+        trace = traced.trace
+        tensorizer = map_SampleInfo.create_tensorizer()
+        for records in [[record, record], [record, single_count, record], [single_count], [record] * 4]:
+            tensors = tensorizer(records)
+            eager = tensor_model(*tensor_model.inputs(tensors))
+            self.assertEqual(len(records), traced(tensors).size(0))
+            self.assertLess((eager - traced(tensors)).abs().max().data[0], 1E-5)
+        # batches are padded to the same sizes and share the trace, the batch of 4 records does not fit:
+        self.assertIs(trace, traced.trace)
+        self.assertEqual(2, traced.eager_batches)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,39 @@
+import unittest
+
+from org.campagnelab.dl.genotypetensors.structured.BatchedSbiMappers import configure_mappers
+from org.campagnelab.dl.genotypetensors.structured.BenchmarkMappers import synthetic_records, benchmark_cases, \
+    time_mapper, find_regressions, PHASES, tensorizer_cases
+from org.campagnelab.dl.genotypetensors.structured.SbiMappers import configure_mappers as configure_sbi_mappers
+
+
+class BenchmarkMappersTestCase(unittest.TestCase):
+    def test_synthetic_records(self):
+        records = synthetic_records(batch_size=3, num_counts=2, list_length=5)
+        self.assertEqual(3, len(records))
+        counts = records[0]['samples'][0]['counts']
+        self.assertEqual(2, len(counts))
+        self.assertEqual(5, len(counts[1]['qualityScoresForwardStrand']))
+        self.assertEqual(5, len(records[2]['genomicSequenceContext']))
+        self.assertEqual(records, synthetic_records(batch_size=3, num_counts=2, list_length=5))
+
+    def test_time_mappers(self):
+        mappers, _ = configure_mappers(ploidy=2, extra_genotypes=2, num_samples=1)
+        for name, (mapper, collect, forward) in benchmark_cases(mappers).items():
+            timings = time_mapper(mapper, collect, forward, lambda: synthetic_records(4, 3, 2), repeat=1)
+            self.assertEqual(sorted(PHASES), sorted(timings.keys()), name)
+
+    def test_time_tensorizer(self):
+        sbi_mappers, _ = configure_sbi_mappers(ploidy=2, extra_genotypes=2, num_samples=1, use_cuda=False)
+        for name, (mapper, collect, forward) in tensorizer_cases(sbi_mappers, num_counts=4).items():
+            timings = time_mapper(mapper, collect, forward, lambda: synthetic_records(4, 3, 2), repeat=1)
+            self.assertEqual(sorted(PHASES), sorted(timings.keys()), name)
+
+    def test_find_regressions(self):
+        baseline = {"a": {"collect": 1.0, "forward": 2.0, "backward": 3.0}}
+        results = {"a": {"collect": 1.1, "forward": 3.0, "backward": 1.0},
+                   "b": {"collect": 9.0, "forward": 9.0, "backward": 9.0}}
+        self.assertEqual([("a", "forward", 2.0, 3.0)], find_regressions(results, baseline, tolerance=0.2))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,7 +3,7 @@ import unittest
 import torch
 
 from org.campagnelab.dl.genotypetensors.structured.Models import IntegerModel, MeanOfList, RNNOfList, BatchOfInstances, \
-    Reduce
+    Reduce, LogBuckets
 
 
 class IntegerEmbeddingTestCase(unittest.TestCase):
@@ -84,6 +84,34 @@ class IntegerEmbeddingTestCase(unittest.TestCase):
 
         reduce([map_ints([1]),map_ints([2]),map_ints([3])])
         reduce([map_ints([1]),map_ints([2])],pad_missing=True)
+    def test_sparse_gradients(self):
+        map_ints = IntegerModel(distinct_numbers=100000, embedding_size=2, use_cuda=False, sparse=True)
+        map_ints([12, 3, 12], cuda=False).sum().backward()
+        weight = map_ints.embedding.weight
+        self.assertTrue(weight.grad.data.is_sparse)
+        before = weight.data.clone()
+        torch.optim.SparseAdam([weight], lr=0.1).step()
+        # only the rows of the values mapped in the batch are updated:
+        changed_rows = (weight.data - before).abs().sum(1).nonzero().view(-1).tolist()
+        self.assertEqual([3, 12], sorted(changed_rows))
+
+    def test_log_buckets(self):
+        buckets = LogBuckets(max_value=100000)
+        self.assertLess(buckets.num_buckets, 100)
+        values = [-5, 0, 15, 16, 19, 20, 1000, 100000, 10000000]
+        self.assertEqual([0, 0, 15, 16, 16, 17], [buckets.bucket(value) for value in values[0:6]])
+        self.assertEqual(buckets.num_buckets - 1, buckets.bucket(values[-1]))
+        # the last boundary is above max_value, values in between are larger than max_value:
+        self.assertGreater(buckets.boundaries[-1], buckets.max_value + 1)
+        self.assertEqual(buckets.num_buckets - 2, buckets.bucket(100000))
+        self.assertEqual(buckets.num_buckets - 1, buckets.bucket(100001))
+        values += [100001, buckets.boundaries[-1] - 1]
+        self.assertEqual([buckets.bucket(value) for value in values],
+                         buckets.bucket_tensor(torch.LongTensor(values)).tolist())
+        map_counts = IntegerModel(distinct_numbers=100000, embedding_size=2, use_cuda=False, buckets=buckets)
+        self.assertEqual(buckets.num_buckets, map_counts.embedding.weight.size(0))
+        self.assertEqual((len(values), 2), map_counts(values, cuda=False).size())
+
 
 if __name__ == '__main__':
     unittest.main()
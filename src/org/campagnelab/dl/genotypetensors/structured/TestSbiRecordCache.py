@@ -0,0 +1,106 @@
+import json
+import os
+import pickle
+import tempfile
+import unittest
+
+from org.campagnelab.dl.genotypetensors.genotype_pytorch_dataset import BucketingBatchSampler
+from org.campagnelab.dl.genotypetensors.structured.SbiRecordCache import SbiRecordCache
+from org.campagnelab.dl.genotypetensors.structured.Tensorizer import SbiTensorizer
+
+record_json_string = '{"type":"BaseInformation","referenceBase":"A","genomicSequenceContext":"GCAGATATAC","samples":[{"type":"SampleInfo","counts":[{"type":"CountInfo","matchesReference":true,"isCalled":true,"isIndel":false,"fromSequence":"A","toSequence":"A","genotypeCountForwardStrand":7,"genotypeCountReverseStrand":32,"gobyGenotypeIndex":0,"qualityScoresForwardStrand":[{"type":"NumberWithFrequency","frequency":7,"number":40}],"readIndicesForwardStrand":[{"type":"NumberWithFrequency","frequency":1,"number":23},{"type":"NumberWithFrequency","frequency":5,"number":34}]},{"type":"CountInfo","matchesReference":false,"isCalled":false,"isIndel":true,"fromSequence":"A","toSequence":"A--","genotypeCountForwardStrand":0,"genotypeCountReverseStrand":1,"gobyGenotypeIndex":2,"readIndicesForwardStrand":[]}]}]}'
+
+
+def as_dict(message):
+    if isinstance(message, list):
+        return [as_dict(element) for element in message]
+    if hasattr(message, "keys"):
+        return {key: as_dict(message[key]) for key in message.keys()}
+    return message
+
+
+class SbiRecordCacheTestCase(unittest.TestCase):
+    def test_round_trip(self):
+        records = [json.loads(record_json_string), json.loads(record_json_string.replace('"A--"', '"T"'))]
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "records.sbi_record_cache")
+            SbiRecordCache.build(path, records)
+            cache = SbiRecordCache(path)
+            self.assertEqual(2, len(cache))
+            for index in [1, 0]:
+                self.assertEqual(records[index], as_dict(cache.record_at(index)))
+            counts = cache.record_at(0)["samples"][0]["counts"]
+            # the second count has no quality scores:
+            self.assertNotIn("qualityScoresForwardStrand", counts[1])
+            self.assertIn("readIndicesForwardStrand", counts[1])
+
+    def test_values_set_on_views_are_kept(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "records.sbi_record_cache")
+            SbiRecordCache.build(path, [json.loads(record_json_string)])
+            record = SbiRecordCache(path).record_at(0)
+            count = record["samples"][0]["counts"][0]
+            count['indices'] = {1: [0]}
+            self.assertEqual({1: [0]}, record["samples"][0]["counts"][0]['indices'])
+            self.assertEqual(json.loads(record_json_string), as_dict(pickle.loads(pickle.dumps(record))))
+
+    def test_missing_float_and_sample_fields(self):
+        records = [{"type": "BaseInformation", "position": 1, "samples": [
+            {"type": "SampleInfo", "isTumor": True, "counts": [{"type": "CountInfo", "depth": 3, "readIndices": []}]}]},
+                   {"type": "BaseInformation", "position": 2.5, "samples": [
+                       {"type": "SampleInfo", "counts": [{"type": "CountInfo", "fraction": 0.25},
+                                                         {"type": "CountInfo", "depth": 4, "fraction": 1}]}]}]
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "records.sbi_record_cache")
+            SbiRecordCache.build(path, records)
+            cache = SbiRecordCache(path)
+            for index in [0, 1]:
+                self.assertEqual(records[index], as_dict(cache.record_at(index)))
+            self.assertNotIn("isTumor", cache.record_at(1)["samples"][0])
+            self.assertNotIn("depth", cache.record_at(1)["samples"][0]["counts"][0])
+            # integers are stored as floats once a float is seen in the field:
+            self.assertIsInstance(cache.record_at(0)["position"], float)
+
+    def test_tensorize_record_cache(self):
+        records = [json.loads(record_json_string), json.loads(record_json_string.replace('"A--"', '"T"'))]
+        no_counts = json.loads(record_json_string)
+        no_counts["samples"][0]["counts"] = []
+        records.append(no_counts)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "records.sbi_record_cache")
+            SbiRecordCache.build(path, records)
+            cache = SbiRecordCache(path)
+            tensorizer = SbiTensorizer(num_counts=1)
+            for indices in [[0, 1, 2], [1, 1], [2]]:
+                expected = tensorizer.tensorize_messages([records[index] for index in indices])
+                tensorized = tensorizer([cache.record_at(index) for index in indices])
+                self.assertEqual(sorted(expected.keys()), sorted(tensorized.keys()))
+                for key in expected.keys():
+                    self.assertEqual(expected[key].numel(), tensorized[key].numel(), key)
+                    if expected[key].numel() > 0:
+                        self.assertEqual(expected[key].tolist(), tensorized[key].tolist(), key)
+
+    def test_record_lengths(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "records.sbi_record_cache")
+            no_counts = json.loads(record_json_string)
+            no_counts["samples"][0]["counts"] = []
+            SbiRecordCache.build(path, [json.loads(record_json_string), no_counts, json.loads(record_json_string)])
+            self.assertEqual([[2, 3, 10], [0, 0, 10], [2, 3, 10]], SbiRecordCache(path).record_lengths().tolist())
+
+    def test_bucketing_batch_sampler(self):
+        lengths = [[2, 3, 10]] * 6 + [[40, 300, 10]] * 3
+        sampler = BucketingBatchSampler(lengths, batch_size=4, example_budget=1000, shuffle=True, seed=1)
+        batches = list(sampler)
+        self.assertEqual(list(range(9)), sorted(index for batch in batches for index in batch))
+        for batch in batches:
+            self.assertTrue(all(index < 6 for index in batch) or all(index >= 6 for index in batch))
+            self.assertLessEqual(len(batch), 4 if batch[0] < 6 else 2)
+        # resume after the first batch:
+        sampler.load_state_dict({"seed": 1, "epoch": 0, "position": len(batches[0])})
+        self.assertEqual(batches[1:], list(sampler))
+        self.assertEqual(len(batches) - 1, len(sampler))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,12 @@
 import unittest
 
 import os
+import sys
+import tempfile
 
-from org.campagnelab.dl.genotypetensors.SBIToJsonIterator import SbiToJsonGenerator
+from org.campagnelab.dl.genotypetensors import SbiToJsonStandIn
+from org.campagnelab.dl.genotypetensors.SBIToJsonIterator import SbiToJsonGenerator, command_supports_option, \
+    START_INDEX_OPTION
 
 
 class SbiToJSONTestCase(unittest.TestCase):
@@ -26,6 +30,58 @@ class SbiToJSONTestCase(unittest.TestCase):
             print(element)
         generator.close()
 
+    def test_random_access_with_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            sbi_path = os.path.join(directory, "records.sbi")
+            with open(sbi_path + "_json_cache.json", "w") as json_cache:
+                for index in range(5):
+                    json_cache.write('{"type": "BaseInformation", "index": %d}\n' % index)
+            generator = SbiToJsonGenerator(sbi_path=sbi_path, sort=True, num_records=4, use_cache=True)
+            self.assertEqual(4, len(generator))
+            self.assertTrue(os.path.isfile(sbi_path + "_json_cache.json.idx"))
+            for index in [3, 0, 2, 2, 1]:
+                self.assertEqual(index, generator.record_at(index)["index"])
+            generator.close()
+
+    def test_sharded_extraction(self):
+        with tempfile.TemporaryDirectory() as directory:
+            sbi_path = os.path.join(directory, "records.sbi")
+            with open(sbi_path, "w") as sbi:
+                for index in range(10):
+                    sbi.write('{"type": "BaseInformation", "index": %d, "samples": []}\n' % index)
+            with open(os.path.join(directory, "records.sbip"), "w") as properties:
+                properties.write("numRecords=10\n")
+            generator = SbiToJsonGenerator(sbi_path=sbi_path, num_shards=3, use_cache=True,
+                                           command=[sys.executable, SbiToJsonStandIn.__file__])
+            self.assertEqual(10, len(generator))
+            self.assertEqual(list(range(10)), [element["index"] for element in generator])
+            for index in [9, 0, 4]:
+                self.assertEqual(index, generator.record_at(index)["index"])
+            generator.close()
+            self.assertEqual(["records.sbi", "records.sbi_json_cache.json", "records.sbi_json_cache.json.idx",
+                              "records.sbip"], sorted(os.listdir(directory)))
+
+    def test_sharded_extraction_requires_start_index(self):
+        with tempfile.TemporaryDirectory() as directory:
+            sbi_path = os.path.join(directory, "records.sbi")
+            with open(sbi_path, "w") as sbi:
+                for index in range(3):
+                    sbi.write('{"type": "BaseInformation", "index": %d, "samples": []}\n' % index)
+            with open(os.path.join(directory, "records.sbip"), "w") as properties:
+                properties.write("numRecords=3\n")
+            self.assertTrue(command_supports_option([sys.executable, SbiToJsonStandIn.__file__], START_INDEX_OPTION))
+            # echo accepts any option and prints its arguments, without the usage of --start-index:
+            self.assertFalse(command_supports_option(["echo"], START_INDEX_OPTION))
+            # a conversion command without --start-index in its usage:
+            command_path = os.path.join(directory, "sbi-to-json.sh")
+            with open(command_path, "w") as command:
+                command.write('#!/bin/sh\ncase " $* " in *" --help "*) echo "usage: sbi-to-json.sh mem -i -n -o"; '
+                              'exit 0;; esac\nexec "{}" "{}" "$@"\n'.format(sys.executable, SbiToJsonStandIn.__file__))
+            os.chmod(command_path, 0o755)
+            generator = SbiToJsonGenerator(sbi_path=sbi_path, num_shards=2, use_cache=True, command=[command_path])
+            self.assertEqual([0, 1, 2], [generator.record_at(index)["index"] for index in range(len(generator))])
+            generator.close()
+
 
 if __name__ == '__main__':
     unittest.main()
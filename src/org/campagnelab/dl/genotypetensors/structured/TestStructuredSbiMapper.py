@@ -38,6 +38,25 @@ class StructuredSbiMapperTestCase(unittest.TestCase):
         out = mapper([record],tensor_cache=NoCache())
         print(out)
 
+    def test_tensor_cache(self):
+        tensor_cache = TensorCache(max_size=2)
+        created = []
+        create = lambda value: created.append(value) or value * 10
+        self.assertEqual(10, tensor_cache.cache(1, create, key_type="a"))
+        self.assertEqual(10, tensor_cache.cache(1, create, key_type="a"))
+        tensor_cache.cache(2, create, key_type="b")
+        tensor_cache.cache(1, create, key_type="a")
+        # 2 is the least recently used and is evicted:
+        tensor_cache.cache(3, create, key_type="b")
+        self.assertEqual([1, 3], list(tensor_cache.cached_tensors.keys()))
+        self.assertEqual({"hits": 2, "misses": 1}, tensor_cache.statistics["a"])
+        tensor_cache.invalidate(key_type="a")
+        self.assertEqual([3], list(tensor_cache.cached_tensors.keys()))
+        tensor_cache.cache(1, create, key_type="a")
+        self.assertEqual([1, 2, 3, 1], created)
+        tensor_cache.invalidate()
+        self.assertEqual(0, len(tensor_cache.cached_tensors))
+
     def test_serialize_mapper(self):
         json_string='{"type":"BaseInformation","referenceBase":"A","genomicSequenceContext":"GCAGATATACTTCACAGCCCACGCTGACTCTGCCAAGCACA","samples":[{"type":"SampleInfo","counts":[{"type":"CountInfo","matchesReference":true,"isCalled":true,"isIndel":false,"fromSequence":"A","toSequence":"A","genotypeCountForwardStrand":7,"genotypeCountReverseStrand":32,"gobyGenotypeIndex":0},{"type":"CountInfo","matchesReference":false,"isCalled":false,"isIndel":false,"fromSequence":"A","toSequence":"C","genotypeCountForwardStrand":0,"genotypeCountReverseStrand":1,"gobyGenotypeIndex":2},{"type":"CountInfo","matchesReference":false,"isCalled":false,"isIndel":false,"fromSequence":"A","toSequence":"T","genotypeCountForwardStrand":0,"genotypeCountReverseStrand":0,"gobyGenotypeIndex":1},{"type":"CountInfo","matchesReference":false,"isCalled":false,"isIndel":false,"fromSequence":"A","toSequence":"G","genotypeCountForwardStrand":0,"genotypeCountReverseStrand":0,"gobyGenotypeIndex":3},{"type":"CountInfo","matchesReference":false,"isCalled":false,"isIndel":false,"fromSequence":"A","toSequence":"N","genotypeCountForwardStrand":0,"genotypeCountReverseStrand":0,"gobyGenotypeIndex":4}]}]}'
         import ujson
@@ -0,0 +1,27 @@
+import unittest
+
+import torch
+
+from org.campagnelab.dl.multithreading.adaptive_prefetch import PrefetchDepthTuner, ResizableQueue
+
+
+class AdaptivePrefetchTestCase(unittest.TestCase):
+    def test_budget_below_min_depth(self):
+        # each batch uses 400 bytes, the budget fits two batches, less than min_depth:
+        batch = {"input": torch.zeros(10, 10)}
+        queue = ResizableQueue()
+        tuner = PrefetchDepthTuner(queue, memory_budget=1000, initial_depth=8, min_depth=4, adjust_every=5)
+        self.assertEqual(8, queue.maxsize)
+        tuner.record_produced(batch, seconds=0.001)
+        self.assertEqual(2, tuner.depth)
+        self.assertEqual(2, queue.maxsize)
+        # the consumer stalls, which would deepen the queue without the budget:
+        for _ in range(10):
+            tuner.record_produced(batch, seconds=0.001)
+            tuner.record_consumed(seconds_waited=0.1)
+        self.assertEqual(2, tuner.depth)
+        self.assertEqual(2, queue.maxsize)
+
+
+if __name__ == '__main__':
+    unittest.main()
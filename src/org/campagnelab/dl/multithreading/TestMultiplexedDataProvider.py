@@ -0,0 +1,36 @@
+import unittest
+
+import torch
+
+from org.campagnelab.dl.multithreading.sequential_implementation import MultiplexedDataProvider
+
+
+class MultiplexedDataProviderTestCase(unittest.TestCase):
+    def test_source_failure_is_raised(self):
+        def failing_source():
+            yield [0], {"input": torch.zeros(2, 3)}
+            raise ValueError("unreadable record")
+
+        def endless_source():
+            while True:
+                yield [1], {"input": torch.ones(2, 3)}
+
+        provider = MultiplexedDataProvider([failing_source(), endless_source()], ["training", "unlabeled"],
+                                           preload_n=2)
+        next(provider)
+        with self.assertRaises(ValueError):
+            next(provider)
+        with self.assertRaises(StopIteration):
+            next(provider)
+        provider.close()
+
+    def test_exhausted_source_stops(self):
+        provider = MultiplexedDataProvider([iter([([0], {"input": torch.zeros(2, 3)})])], ["training"])
+        next(provider)
+        with self.assertRaises(StopIteration):
+            next(provider)
+        provider.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,28 @@
+import unittest
+
+import torch
+
+from org.campagnelab.dl.multithreading.transforms import Transform, LabelSmoothing, TransformPipeline
+
+
+class Square(Transform):
+    def apply(self, tensor):
+        return tensor * tensor
+
+
+class TransformsTestCase(unittest.TestCase):
+    def test_apply(self):
+        labels = torch.FloatTensor([[0, 1], [1, 0]])
+        self.assertLess((LabelSmoothing(0.2).apply(labels) - torch.FloatTensor([[0.1, 0.8], [0.8, 0.1]])).abs().max(),
+                        1E-6)
+        with self.assertRaises(NotImplementedError):
+            Transform().apply(labels)
+
+    def test_pipeline_with_non_affine_transform(self):
+        pipeline = TransformPipeline({"input": [LabelSmoothing(0.2), Square()]}, on_device=False)
+        transformed = pipeline.transform_column("input", torch.FloatTensor([[0, 1]]))
+        self.assertLess((transformed - torch.FloatTensor([[0.01, 0.64]])).abs().max(), 1E-6)
+
+
+if __name__ == '__main__':
+    unittest.main()
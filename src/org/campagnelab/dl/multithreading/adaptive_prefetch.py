@@ -0,0 +1,158 @@
+import math
+import time
+from queue import Queue
+from threading import Lock
+
+
+class ResizableQueue(Queue):
+    """
+    A queue whose maximum size can be changed while producers and consumers are using it.
+    """
+
+    def resize(self, maxsize):
+        with self.mutex:
+            self.maxsize = maxsize
+            # wake up producers that may now be able to put more items:
+            self.not_full.notify_all()
+
+
+def estimate_batch_bytes(batch):
+    """
+    Estimate the number of bytes held by a batch of tensors.
+    :param batch: a tensor, Variable, or a (nested) dict/list/tuple of them.
+    :return: number of bytes, or zero when the batch does not contain tensors.
+    """
+    if isinstance(batch, dict):
+        return sum(estimate_batch_bytes(value) for value in batch.values())
+    if isinstance(batch, (list, tuple)):
+        return sum(estimate_batch_bytes(value) for value in batch)
+    tensor = batch.data if hasattr(batch, "data") and hasattr(batch.data, "storage") else batch
+    if hasattr(tensor, "storage") and hasattr(tensor, "numel"):
+        return tensor.numel() * tensor.storage().element_size()
+    return 0
+
+
+class PrefetchDepthTuner:
+    """
+    Adjusts the depth of a prefetch queue from the measured producer and consumer rates. The queue is deepened
+    when the consumer stalls waiting for batches, and made shallower when the producer keeps the queue full. Once
+    the size of a batch is known, the depth never exceeds the number of batches that fit in the memory budget, even
+    when this is less than min_depth (the queue holds at least one batch).
+    """
+
+    def __init__(self, queue, memory_budget, initial_depth, min_depth=2, max_depth=256, adjust_every=20,
+                 smoothing=0.1, stall_fraction=0.05):
+        """
+        :param queue: the ResizableQueue to tune.
+        :param memory_budget: maximum number of bytes the queued batches may use.
+        :param initial_depth: depth used until enough measurements are available, capped by the memory budget as
+        soon as the first batch is measured.
+        :param adjust_every: number of consumed batches between two adjustments.
+        :param smoothing: weight of the newest measurement in the moving averages.
+        :param stall_fraction: fraction of the consumer time spent waiting above which the queue is deepened.
+        """
+        self.queue = queue
+        self.memory_budget = memory_budget
+        self.min_depth = min_depth
+        self.max_depth = max_depth
+        self.adjust_every = adjust_every
+        self.smoothing = smoothing
+        self.stall_fraction = stall_fraction
+        self.lock = Lock()
+        self.batch_bytes = None
+        self.producer_seconds_per_batch = None
+        self.consumer_seconds_per_batch = None
+        self.consumer_busy_seconds_per_batch = None
+        self.num_consumed = 0
+        self.last_consumed = None
+        self.total_stall_time = 0.0
+        self.window_stall_time = 0.0
+        self.window_time = 0.0
+        self.window_full_count = 0
+        self.depth = self.capped_depth(initial_depth)
+        self.queue.resize(self.depth)
+
+    def _average(self, average, value):
+        return value if average is None else (1 - self.smoothing) * average + self.smoothing * value
+
+    def record_produced(self, batch, seconds):
+        """
+        Record that the producer took seconds to prepare batch.
+        """
+        with self.lock:
+            self.batch_bytes = self._average(self.batch_bytes, estimate_batch_bytes(batch))
+            self.producer_seconds_per_batch = self._average(self.producer_seconds_per_batch, seconds)
+            # apply the budget before the batch is queued, without waiting for the next adjustment:
+            if self.depth > self.max_depth_for_budget():
+                self.depth = self.max_depth_for_budget()
+                self.queue.resize(self.depth)
+
+    def record_consumed(self, seconds_waited):
+        """
+        Record that the consumer waited seconds_waited to get a batch from the queue.
+        """
+        with self.lock:
+            now = time.time()
+            seconds_since_last = seconds_waited if self.last_consumed is None else now - self.last_consumed
+            self.last_consumed = now
+            self.num_consumed += 1
+            self.total_stall_time += seconds_waited
+            self.window_stall_time += seconds_waited
+            self.window_time += seconds_since_last
+            self.consumer_seconds_per_batch = self._average(self.consumer_seconds_per_batch, seconds_since_last)
+            # time the consumer spent processing the previous batch, excluding the wait:
+            self.consumer_busy_seconds_per_batch = self._average(self.consumer_busy_seconds_per_batch,
+                                                                 max(0.0, seconds_since_last - seconds_waited))
+            if self.queue.qsize() >= self.depth - 1:
+                # the queue was full before this batch was taken:
+                self.window_full_count += 1
+            if self.num_consumed % self.adjust_every == 0:
+                self._adjust()
+
+    def max_depth_for_budget(self):
+        if self.memory_budget is None or not self.batch_bytes:
+            return self.max_depth
+        # a Queue with maxsize 0 is unbounded, keep room for one batch:
+        return max(1, min(self.max_depth, int(self.memory_budget // self.batch_bytes)))
+
+    def capped_depth(self, depth):
+        """Return depth, raised to min_depth and then lowered to the memory budget, which wins over min_depth."""
+        return min(max(self.min_depth, depth), self.max_depth_for_budget())
+
+    def _adjust(self):
+        depth = self.depth
+        producer_keeps_up = (self.producer_seconds_per_batch is not None and
+                             self.producer_seconds_per_batch <= self.consumer_busy_seconds_per_batch)
+        if self.window_time > 0 and self.window_stall_time / self.window_time > self.stall_fraction:
+            if producer_keeps_up:
+                # the consumer is starved by bursts of slow batches, prefetch further ahead:
+                depth *= 2
+            # otherwise the producer is slower on average and a deeper queue would only use more memory.
+        elif self.window_full_count >= self.adjust_every // 2:
+            # the producer keeps up, the queue does not need to be this deep:
+            depth -= 1
+            if self.producer_seconds_per_batch is not None and self.consumer_busy_seconds_per_batch:
+                # keep enough batches to cover the time it takes to produce one:
+                depth = max(depth, int(math.ceil(self.producer_seconds_per_batch /
+                                                 self.consumer_busy_seconds_per_batch)) + 1)
+        depth = self.capped_depth(depth)
+        if depth != self.depth:
+            self.depth = depth
+            self.queue.resize(depth)
+        self.window_stall_time = 0.0
+        self.window_time = 0.0
+        self.window_full_count = 0
+
+    def statistics(self):
+        """
+        Return a dictionary with the chosen depth, the total time the consumer stalled (seconds), the estimated
+        batch size (bytes) and producer/consumer rates (batches per second).
+        """
+        with self.lock:
+            return {"depth": self.depth,
+                    "stall_time": self.total_stall_time,
+                    "batch_bytes": self.batch_bytes,
+                    "producer_rate": (1.0 / self.producer_seconds_per_batch
+                                      if self.producer_seconds_per_batch else None),
+                    "consumer_rate": (1.0 / self.consumer_seconds_per_batch
+                                      if self.consumer_seconds_per_batch else None)}
@@ -1,4 +1,4 @@
-from queue import Queue, Empty
+from queue import Empty, Full
 from threading import Thread
 
 import time
@@ -6,10 +6,35 @@ import time
 import torch
 from torch.autograd import Variable
 
+from org.campagnelab.dl.genotypetensors.genotype_pytorch_dataset import PIPELINE_TIMINGS
+from org.campagnelab.dl.multithreading.adaptive_prefetch import ResizableQueue, PrefetchDepthTuner
+
+
+def print_prefetch_statistics(statistics):
+    """
+    Print the prefetch depth and stall time chosen for each queue of a data provider.
+    :param statistics: dictionary from queue name to PrefetchDepthTuner statistics.
+    """
+    if len(statistics) > 0:
+        print("Prefetch queues: " + " ".join("{}: depth={} stall={:.3f}s".format(name, stats["depth"],
+                                                                                  stats["stall_time"])
+                                             for name, stats in statistics.items()))
+
 
 class DataProvider:
-    def __init__(self, iterator, batch_names, is_cuda=False, volatile=None, requires_grad=None, recode_functions=None):
+    def __init__(self, iterator, batch_names, is_cuda=False, volatile=None, requires_grad=None, recode_functions=None,
+                 transforms=None, pipeline_helper=None):
+        """
+        :param recode_functions: dictionary from column name to a function applied to the column on the CPU.
+        :param transforms: a TransformPipeline applied to the columns (fused, in place, on the device when
+        possible) and then to the whole batch.
+        :param pipeline_helper: optional DataPipelineHelper that records the time spent in each pipeline stage.
+        """
         self.iterator = iterator
+        self.transforms = transforms
+        self.pipeline_helper = pipeline_helper
+        # True when a subclass moves batches to the GPU after prepare_batch:
+        self.transfer_later = False
         self.batch_names = batch_names
         self.batch_index = 0
         self.is_cuda = is_cuda
@@ -27,8 +52,13 @@ class DataProvider:
             if recode_functions is not None:
                 for key in recode_functions:
                     self.all_columns_to_keep+=[key]
+            if transforms is not None:
+                for key in transforms.columns():
+                    self.all_columns_to_keep+=[key]
         self.all_columns_to_keep=set(self.all_columns_to_keep)
         print(self.all_columns_to_keep)
+        # number of examples returned to the consumer, for each loader:
+        self.examples_consumed = {batch_name: 0 for batch_name in batch_names}
 
     def __enter__(self):
         return self
@@ -40,7 +70,38 @@ class DataProvider:
         return self
 
     def __next__(self):
-        return self.__next_tuple__(is_cuda=self.is_cuda)
+        return self.finish_batch(self.__next_tuple__(is_cuda=self.is_cuda))
+
+    def finish_batch(self, batch):
+        """
+        Apply the batch transforms and count the examples of a batch returned to the consumer.
+        :param batch: tuple (indices_dict, data_dict).
+        :return: the batch, transformed.
+        """
+        indices_dict, data_dict = batch
+        if self.transforms is not None:
+            start = time.time()
+            batch = (indices_dict, self.transforms.transform_batch(data_dict))
+            self.observe_stage("recode", time.time() - start)
+        num_examples = 0
+        for batch_name, batch_indices in indices_dict.items():
+            self.examples_consumed[batch_name] += len(batch_indices)
+            num_examples = max(num_examples, len(batch_indices))
+        if self.pipeline_helper is not None:
+            self.pipeline_helper.observe_examples(num_examples)
+        return batch
+
+    def observe_stage(self, stage, seconds):
+        if self.pipeline_helper is not None:
+            self.pipeline_helper.observe_stage(stage, seconds)
+
+    def state_dict(self):
+        """
+        Return the cursor state of this provider: the number of batches and, for each loader, the number of
+        examples returned to the consumer. Examples prefetched but not yet consumed are not counted, so the
+        state can be used to resume reading right after the last example the consumer has seen.
+        """
+        return {"batch_index": self.batch_index, "examples_consumed": dict(self.examples_consumed)}
 
     def __next_tuple__(self, is_cuda):
         """
@@ -57,32 +118,76 @@ class DataProvider:
 
         for loader_index, (batch_indices, batch_data) in enumerate(batch):
             loader_name = self.batch_names[loader_index]
-            data_dict[loader_name] = {}
-            if len(self.requires_grad) == 0:
-                self.requires_grad[loader_name] = []
-            if len(self.volatile) == 0:
-                self.volatile[loader_name] = []
-            for var_name in batch_data.keys():
-                if  var_name in self.all_columns_to_keep:
-                    if var_name in self.recode_functions.keys():
-                        batch_data[var_name] = self.recode_functions[var_name](batch_data[var_name])
-                    if isinstance(batch_data[var_name],Variable):
-                        # pass-through any batch data that is already a variable:
-                        data_dict[loader_name][var_name]=batch_data[var_name]
-                    else:
-                        # if we have a tensor at this point, make it into a pytorch variable:
-                        if torch.is_tensor (batch_data[var_name]):
-                            var_batch = Variable(batch_data[var_name], requires_grad=(var_name in self.requires_grad[loader_name]),
-                                             volatile=(var_name in self.volatile[loader_name]))
+            data_dict[loader_name] = self.prepare_batch(loader_name, batch_data, is_cuda)
+            indices_dict[loader_name] = batch_indices
+        return indices_dict, data_dict
+
+    def prepare_batch(self, loader_name, batch_data, is_cuda):
+        """
+        Recode, wrap as variables and optionally move to the GPU the columns of one loader's batch.
+        :param loader_name: name of the loader that produced batch_data.
+        :param batch_data: dictionary of collated columns.
+        :param is_cuda: when True, variables are moved to the GPU.
+        :return: Dictionary with the columns to keep, prepared for pytorch.
+        """
+        prepared = {}
+        transform_on_device = (self.transforms is not None and self.transforms.on_device
+                               and (is_cuda or self.transfer_later))
+        if len(self.requires_grad) == 0:
+            self.requires_grad[loader_name] = []
+        if len(self.volatile) == 0:
+            self.volatile[loader_name] = []
+        timings = batch_data.pop(PIPELINE_TIMINGS, None)
+        if timings is not None:
+            self.observe_stage("read", timings["read"])
+            self.observe_stage("collate", timings["collate"])
+        recode_time = 0.0
+        h2d_time = 0.0
+        for var_name in batch_data.keys():
+            if  var_name in self.all_columns_to_keep:
+                start = time.time()
+                if var_name in self.recode_functions.keys():
+                    batch_data[var_name] = self.recode_functions[var_name](batch_data[var_name])
+                if self.transforms is not None and not transform_on_device:
+                    batch_data[var_name] = self.transforms.transform_column(var_name, batch_data[var_name])
+                recode_time += time.time() - start
+                if isinstance(batch_data[var_name],Variable):
+                    # pass-through any batch data that is already a variable:
+                    prepared[var_name]=batch_data[var_name]
+                else:
+                    # if we have a tensor at this point, make it into a pytorch variable:
+                    if torch.is_tensor (batch_data[var_name]):
+                        var_batch = Variable(batch_data[var_name], requires_grad=(var_name in self.requires_grad[loader_name]),
+                                         volatile=(var_name in self.volatile[loader_name]))
+                        if is_cuda:
+                            start = time.time()
+                            var_batch = var_batch.cuda(async=False)
+                            h2d_time += time.time() - start
+                            if transform_on_device:
+                                start = time.time()
+                                var_batch = self.transforms.transform_column(var_name, var_batch)
+                                recode_time += time.time() - start
+
+                        prepared[var_name] = var_batch
+                    elif self.is_dict_of_tensors(batch_data[var_name]):
+                        # tensors extracted from structured messages (e.g., by SbiTensorizer):
+                        prepared[var_name] = {}
+                        for key, tensor in batch_data[var_name].items():
+                            var_batch = Variable(tensor, volatile=(var_name in self.volatile[loader_name]))
                             if is_cuda:
+                                start = time.time()
                                 var_batch = var_batch.cuda(async=False)
+                                h2d_time += time.time() - start
+                            prepared[var_name][key] = var_batch
+                    else:
+                        # just pass-through any other type of object:
+                        prepared[var_name] =batch_data[var_name]
+        self.observe_stage("recode", recode_time)
+        self.observe_stage("h2d", h2d_time)
+        return prepared
 
-                            data_dict[loader_name][var_name] = var_batch
-                        else:
-                            # just pass-through any other type of object:
-                            data_dict[loader_name][var_name] =batch_data[var_name]
-            indices_dict[loader_name] = batch_indices
-        return indices_dict, data_dict
+    def is_dict_of_tensors(self, value):
+        return isinstance(value, dict) and len(value) > 0 and all(torch.is_tensor(tensor) for tensor in value.values())
 
     def close(self):
         try:
@@ -94,17 +199,20 @@ class DataProvider:
 
 class CpuGpuDataProvider(DataProvider):
     def __init__(self, iterator, batch_names, is_cuda=False, volatile=None, requires_grad=None, preload_n=3,
-                 preload_cuda_n=3, fake_gpu_on_cpu=False, recode_functions=None):
+                 preload_cuda_n=3, fake_gpu_on_cpu=False, recode_functions=None, transforms=None,
+                 pipeline_helper=None):
         # do not put on GPU in super
         super(CpuGpuDataProvider, self).__init__(iterator=iterator, batch_names=batch_names, is_cuda=False,
                                                  volatile=volatile, requires_grad=requires_grad,
-                                                 recode_functions=recode_functions)
+                                                 recode_functions=recode_functions, transforms=transforms,
+                                                 pipeline_helper=pipeline_helper)
         self.is_cuda = is_cuda
-        self.cpu_batches_queue = Queue(maxsize=preload_n)
+        self.transfer_later = is_cuda or fake_gpu_on_cpu
+        self.cpu_batches_queue = ResizableQueue(maxsize=preload_n)
         self.batch_index = 0
         self.fake_gpu_on_cpu = fake_gpu_on_cpu
         if is_cuda or self.fake_gpu_on_cpu:
-            self.gpu_batches_queue = Queue(maxsize=preload_cuda_n)
+            self.gpu_batches_queue = ResizableQueue(maxsize=preload_cuda_n)
 
     def __next__(self):
         """
@@ -118,9 +226,9 @@ class CpuGpuDataProvider(DataProvider):
         self.batch_index += 1
         try:
             if self.is_cuda or self.fake_gpu_on_cpu:
-                return self.gpu_batches_queue.get(block=True, timeout=3)
+                return self.finish_batch(self.gpu_batches_queue.get(block=True, timeout=3))
             else:
-                return self.cpu_batches_queue.get(block=True, timeout=3)
+                return self.finish_batch(self.cpu_batches_queue.get(block=True, timeout=3))
         except Empty:
             raise StopIteration
 
@@ -133,38 +241,80 @@ class CpuGpuDataProvider(DataProvider):
             #    for var_name in recode_functions.keys():
             #    if var_name in batch.keys():
             #        batch[var_name] = recode_functions[var_name](batch[var_name])
-            self.cpu_batches_queue.put((next_indices, next_data), block=True)
+            self.queue_batch("cpu", self.cpu_batches_queue, next_indices, next_data)
+            return next_data
         except StopIteration:
             raise StopIteration
 
     def populate_gpu_queue(self):
         batch_indices, batch_data = self.cpu_batches_queue.get(block=True)
+        return self._transfer_to_gpu(batch_indices, batch_data)
+
+    def _transfer_to_gpu(self, batch_indices, batch_data):
         for batch_name in self.batch_names:
             batch = batch_data[batch_name]
             for var_name in batch.keys():
                 if not self.fake_gpu_on_cpu:
                     if hasattr(batch[var_name],"cuda"):
+                        start = time.time()
                         batch[var_name] = batch[var_name].cuda()
-        self.gpu_batches_queue.put((batch_indices, batch_data), block=True)
+                        self.observe_stage("h2d", time.time() - start)
+                    elif isinstance(batch[var_name], dict):
+                        start = time.time()
+                        for key, value in batch[var_name].items():
+                            if isinstance(value, Variable):
+                                batch[var_name][key] = value.cuda()
+                        self.observe_stage("h2d", time.time() - start)
+                if self.transforms is not None and self.transforms.on_device:
+                    start = time.time()
+                    batch[var_name] = self.transforms.transform_column(var_name, batch[var_name])
+                    self.observe_stage("recode", time.time() - start)
+        self.queue_batch("gpu", self.gpu_batches_queue, batch_indices, batch_data)
+        return batch_data
+
+    def queue_batch(self, queue_name, batch_queue, batch_indices, batch_data):
+        """Put a batch on the "cpu" or "gpu" prefetch queue."""
+        batch_queue.put((batch_indices, batch_data), block=True)
 
 
 class MultiThreadedCpuGpuDataProvider(CpuGpuDataProvider):
     def __init__(self, iterator, batch_names, is_cuda=False, volatile=None, requires_grad=None, preload_n=20,
-                 preload_cuda_n=20, recode_functions=None, fake_gpu_on_cpu=False):
+                 preload_cuda_n=20, recode_functions=None, fake_gpu_on_cpu=False, memory_budget=None,
+                 transforms=None, pipeline_helper=None):
+        """
+        :param preload_n: number of batches to prefetch on the CPU (initial depth when memory_budget is set).
+        :param preload_cuda_n: number of batches to prefetch on the GPU (initial depth when memory_budget is set).
+        :param memory_budget: when not None, number of bytes the prefetched batches may use. Queue depths are
+        then adjusted at runtime from the producer and consumer rates. The budget is shared evenly between the CPU
+        and GPU queues.
+        """
         super().__init__(iterator, batch_names, is_cuda=is_cuda,
                          volatile=volatile, requires_grad=requires_grad, preload_n=preload_n,
                          preload_cuda_n=preload_cuda_n, fake_gpu_on_cpu=fake_gpu_on_cpu,
-                         recode_functions=recode_functions)
+                         recode_functions=recode_functions, transforms=transforms,
+                         pipeline_helper=pipeline_helper)
         self.stop_iteration = False
         self.kill_threads = False
+        self.tuners = {}
+        # time each thread started producing its current batch:
+        self.produce_start = {}
+        if memory_budget is not None:
+            use_gpu_queue = is_cuda or self.fake_gpu_on_cpu
+            queue_budget = memory_budget / (2 if use_gpu_queue else 1)
+            self.tuners["cpu"] = PrefetchDepthTuner(self.cpu_batches_queue, queue_budget, initial_depth=preload_n)
+            if use_gpu_queue:
+                self.tuners["gpu"] = PrefetchDepthTuner(self.gpu_batches_queue, queue_budget,
+                                                        initial_depth=preload_cuda_n)
 
         def add_to_cpu_queue():
             while not self.kill_threads:
                 try:
                     if not self.cpu_batches_queue.full():
+                        self.produce_start["cpu"] = time.time()
                         self.populate_cpu_queue(recode_functions=recode_functions)
                     else:
                         time.sleep(10 / 1000.0)
+                        self.observe_stage("producer_wait", 10 / 1000.0)
                 except StopIteration:
                     self.stop_iteration = True
                     break
@@ -179,9 +329,11 @@ class MultiThreadedCpuGpuDataProvider(CpuGpuDataProvider):
             def add_to_gpu_queue():
                 while not self.kill_threads:
                     if not self.gpu_batches_queue.full():
+                        self.produce_start["gpu"] = time.time()
                         self.populate_gpu_queue()
                     else:
                         time.sleep(10 / 1000.0)
+                        self.observe_stage("producer_wait", 10 / 1000.0)
 
             self.t2 = Thread(target=add_to_gpu_queue, name="BatchesToGPU")
             self.t2.start()
@@ -199,21 +351,201 @@ class MultiThreadedCpuGpuDataProvider(CpuGpuDataProvider):
         This method returns the next batch of data, prepared for pytorch, on GPU when is_cuda is true.
         :return: Dictionary with named inputs and outputs.
         """
+        use_gpu_queue = self.is_cuda or self.fake_gpu_on_cpu
+        start = time.time()
         try:
-            if self.is_cuda or self.fake_gpu_on_cpu:
-                return self.gpu_batches_queue.get(block=True, timeout=3)
+            if use_gpu_queue:
+                batch = self.gpu_batches_queue.get(block=True, timeout=3)
             else:
-                return self.cpu_batches_queue.get(block=True, timeout=3)
+                batch = self.cpu_batches_queue.get(block=True, timeout=3)
         except Empty:
             raise StopIteration
+        waited = time.time() - start
+        self.observe_stage("consumer_wait", waited)
+        tuner_name = "gpu" if use_gpu_queue else "cpu"
+        if tuner_name in self.tuners:
+            self.tuners[tuner_name].record_consumed(waited)
+        self.batch_index += 1
+        return self.finish_batch(batch)
+
+    def queue_batch(self, queue_name, batch_queue, batch_indices, batch_data):
+        # measure the batch before it is queued, so that the memory budget applies to it:
+        if queue_name in self.tuners:
+            self.tuners[queue_name].record_produced(batch_data, time.time() - self.produce_start[queue_name])
+        super().queue_batch(queue_name, batch_queue, batch_indices, batch_data)
+
+    def populate_gpu_queue(self):
+        if "cpu" not in self.tuners:
+            return super().populate_gpu_queue()
+        # the GPU thread is the consumer of the CPU queue:
+        start = time.time()
+        batch_indices, batch_data = self.cpu_batches_queue.get(block=True)
+        self.tuners["cpu"].record_consumed(time.time() - start)
+        return self._transfer_to_gpu(batch_indices, batch_data)
+
+    def prefetch_statistics(self):
+        """
+        Return a dictionary from queue name ("cpu" or "gpu") to the statistics of its depth tuner (see
+        PrefetchDepthTuner.statistics). Empty when the provider was created without a memory budget.
+        """
+        return {name: tuner.statistics() for name, tuner in self.tuners.items()}
 
     def close(self):
         super().close()
         self.kill_threads = True
         time.sleep(1)
+        print_prefetch_statistics(self.prefetch_statistics())
 
     def queues_are_empty(self):
         return (self.cpu_batches_queue.empty()
                 or ((self.is_cuda or self.fake_gpu_on_cpu)
                     and self.gpu_batches_queue.empty()
                     and self.cpu_batches_queue.empty()))
+
+
+class ProducerFailure:
+    """Queued by a producer thread in place of a batch when reading its source raised an exception."""
+
+    def __init__(self, batch_name, exception):
+        self.batch_name = batch_name
+        self.exception = exception
+
+
+class MultiplexedDataProvider(DataProvider):
+    """
+    A data provider that prefetches each named source in its own thread, with its own queue, and combines the
+    batches of all sources when the consumer asks for the next batch. Use this provider instead of
+    zip(loader_1, loader_2) so that a slow source (e.g., an endless unlabeled set) does not stall the others
+    while they are prefetched. Time spent waiting for each source is recorded to identify the bottleneck.
+    """
+
+    def __init__(self, iterators, batch_names, is_cuda=False, volatile=None, requires_grad=None, preload_n=20,
+                 recode_functions=None, fake_gpu_on_cpu=False, memory_budget=None, transforms=None,
+                 pipeline_helper=None):
+        """
+        :param iterators: list of loader iterators, one per name in batch_names.
+        :param batch_names: names of the sources, in the order of iterators.
+        :param preload_n: number of batches to prefetch per source. Either an int (same depth for every source)
+        or a dictionary from source name to depth. Used as initial depth when memory_budget is set.
+        :param memory_budget: when not None, number of bytes the prefetched batches may use, shared evenly between
+        the sources. The depth of each queue is then adjusted at runtime from the producer and consumer rates.
+        """
+        assert len(iterators) == len(batch_names), "one iterator must be provided per batch name."
+        super().__init__(iterator=None, batch_names=batch_names, is_cuda=is_cuda, volatile=volatile,
+                         requires_grad=requires_grad, recode_functions=recode_functions, transforms=transforms,
+                         pipeline_helper=pipeline_helper)
+        self.iterators = dict(zip(batch_names, iterators))
+        self.fake_gpu_on_cpu = fake_gpu_on_cpu
+        self.kill_threads = False
+        self.queues = {}
+        self.wait_time = {}
+        self.num_waits = {}
+        self.threads = []
+        self.tuners = {}
+        self.exhausted = set()
+        for batch_name in batch_names:
+            depth = preload_n[batch_name] if isinstance(preload_n, dict) else preload_n
+            self.queues[batch_name] = ResizableQueue(maxsize=depth)
+            self.wait_time[batch_name] = 0.0
+            self.num_waits[batch_name] = 0
+            if memory_budget is not None:
+                self.tuners[batch_name] = PrefetchDepthTuner(self.queues[batch_name],
+                                                             memory_budget / len(batch_names), initial_depth=depth)
+
+        def add_to_queue(batch_name):
+            iterator = self.iterators[batch_name]
+            batch_queue = self.queues[batch_name]
+            try:
+                start = time.time()
+                for batch_indices, batch_data in iterator:
+                    if self.kill_threads:
+                        break
+                    prepared = self.prepare_batch(batch_name, batch_data, is_cuda=(is_cuda and not fake_gpu_on_cpu))
+                    if batch_name in self.tuners:
+                        self.tuners[batch_name].record_produced(prepared, time.time() - start)
+                    self._put(batch_queue, (batch_indices, prepared))
+                    start = time.time()
+            except Exception as exception:
+                # re-raised by the consumer, so that a failing source does not end the epoch silently:
+                self._put(batch_queue, ProducerFailure(batch_name, exception))
+                return
+            # signal the consumer that this source is exhausted:
+            self._put(batch_queue, None)
+
+        for batch_name in batch_names:
+            thread = Thread(target=add_to_queue, args=(batch_name,), name="Batches-" + batch_name)
+            thread.start()
+            self.threads.append(thread)
+
+    def _put(self, batch_queue, item):
+        start = time.time()
+        while not self.kill_threads:
+            try:
+                batch_queue.put(item, block=True, timeout=0.1)
+                break
+            except Full:
+                pass
+        self.observe_stage("producer_wait", time.time() - start)
+
+    def __next__(self):
+        """
+        This method returns the next batch of data, combining one batch from each source. Iteration stops as soon
+        as one of the sources is exhausted (like zip). An exception raised while reading a source is raised here.
+        :return: Dictionary with named inputs and outputs.
+        """
+        data_dict = {}
+        indices_dict = {}
+        for batch_name in self.batch_names:
+            if batch_name in self.exhausted:
+                raise StopIteration
+            start = time.time()
+            item = self.queues[batch_name].get(block=True)
+            waited = time.time() - start
+            self.observe_stage("consumer_wait", waited)
+            self.wait_time[batch_name] += waited
+            self.num_waits[batch_name] += 1
+            if item is None:
+                self.exhausted.add(batch_name)
+                raise StopIteration
+            if isinstance(item, ProducerFailure):
+                self.exhausted.add(batch_name)
+                raise item.exception
+            if batch_name in self.tuners:
+                self.tuners[batch_name].record_consumed(waited)
+            indices_dict[batch_name], data_dict[batch_name] = item
+        self.batch_index += 1
+        return self.finish_batch((indices_dict, data_dict))
+
+    def wait_statistics(self):
+        """
+        Return a dictionary from source name to a tuple (total seconds the consumer waited for the source, average
+        seconds per batch). The source with the largest wait is the bottleneck.
+        """
+        return {batch_name: (self.wait_time[batch_name],
+                             self.wait_time[batch_name] / max(1, self.num_waits[batch_name]))
+                for batch_name in self.batch_names}
+
+    def bottleneck(self):
+        """Return the name of the source the consumer waited for the longest."""
+        return max(self.batch_names, key=lambda batch_name: self.wait_time[batch_name])
+
+    def prefetch_statistics(self):
+        """
+        Return a dictionary from source name to the statistics of its depth tuner (see
+        PrefetchDepthTuner.statistics). Empty when the provider was created without a memory budget.
+        """
+        return {batch_name: tuner.statistics() for batch_name, tuner in self.tuners.items()}
+
+    def close(self):
+        self.kill_threads = True
+        for batch_name, iterator in self.iterators.items():
+            try:
+                iterator.close()
+            except:
+                pass
+        print("Time waiting for sources: " + " ".join("{}={:.3f}s".format(batch_name, total)
+                                                      for batch_name, (total, _) in
+                                                      self.wait_statistics().items()))
+        print_prefetch_statistics(self.prefetch_statistics())
+        for thread in self.threads:
+            thread.join(timeout=1)
@@ -0,0 +1,143 @@
+import numpy
+import torch
+from torch.autograd import Variable
+
+
+def _data(value):
+    return value.data if isinstance(value, Variable) else value
+
+
+class Transform:
+    """A transformation of one column of a batch. Transforms that are affine (x*scale+shift) expose their
+    coefficients so that a pipeline can fuse consecutive transforms into a single pass over the data."""
+
+    def affine(self, tensor):
+        """
+        Return the (scale, shift) coefficients of this transform for tensor, or None if the transform is not affine.
+        Scale and shift are either numbers or tensors that broadcast over tensor.
+        """
+        return None
+
+    def apply(self, tensor):
+        """
+        Return the transformed tensor. Transforms that are not affine must override this method, affine transforms
+        are applied from their coefficients.
+        """
+        coefficients = self.affine(tensor)
+        if coefficients is None:
+            raise NotImplementedError
+        scale, shift = coefficients
+        return tensor * scale + shift
+
+
+class Normalize(Transform):
+    """Normalize by mean and standard deviation: (x-mean)/(std+epsilon)."""
+
+    def __init__(self, mean, std, epsilon=1E-15):
+        self.scale = 1.0 / (std + epsilon)
+        self.shift = -mean * self.scale
+        # copies of the coefficients for each tensor type (e.g., on the GPU):
+        self.coefficients = {}
+
+    def affine(self, tensor):
+        tensor_type = tensor.type()
+        if tensor_type not in self.coefficients:
+            self.coefficients[tensor_type] = (self.scale.type(tensor_type), self.shift.type(tensor_type))
+        return self.coefficients[tensor_type]
+
+
+class LabelSmoothing(Transform):
+    """Smooth one-hot encoded labels: ones become 1-epsilon and zeros epsilon/num_classes."""
+
+    def __init__(self, epsilon):
+        self.epsilon = epsilon
+
+    def affine(self, tensor):
+        num_classes = tensor.size(1)
+        return 1.0 - self.epsilon - self.epsilon / num_classes, self.epsilon / num_classes
+
+
+class MixupPairing:
+    """Mix the examples of two sources of a batch with a weight drawn from Beta(alpha, alpha). The mixed
+    columns are stored in the batch under a new source name."""
+
+    def __init__(self, first, second, alpha, columns=("input", "softmaxGenotype"), output="mixup"):
+        self.first = first
+        self.second = second
+        self.alpha = alpha
+        self.columns = columns
+        self.output = output
+
+    def __call__(self, data_dict):
+        lam = numpy.random.beta(self.alpha, self.alpha)
+        mixed = {}
+        for column in self.columns:
+            value_1 = data_dict[self.first][column]
+            value_2 = data_dict[self.second][column]
+            assert value_1.size() == value_2.size(), ("{} size {} does not equal {} for mixup"
+                                                      .format(column, value_1.size(), value_2.size()))
+            mixed[column] = lam * value_1 + (1.0 - lam) * value_2
+        data_dict[self.output] = mixed
+        return data_dict
+
+
+class TransformPipeline:
+    """
+    A declarative set of transforms applied by the data providers. Column transforms apply to the column with
+    the same name in every source. Consecutive affine transforms of a column are fused into one multiply-add,
+    done in place, on the device after transfer when on_device is True (or in place on the CPU otherwise).
+    Batch transforms (e.g., MixupPairing) see the batches of all sources and run last.
+    """
+
+    def __init__(self, column_transforms=None, batch_transforms=None, on_device=True):
+        """
+        :param column_transforms: dictionary from column name to a transform or a list of transforms.
+        :param batch_transforms: list of callables that take and return the dictionary of sources of a batch.
+        :param on_device: when True and the provider uses the GPU, apply column transforms after transfer.
+        """
+        self.column_transforms = {}
+        for column, transforms in ({} if column_transforms is None else column_transforms).items():
+            self.column_transforms[column] = transforms if isinstance(transforms, list) else [transforms]
+        self.batch_transforms = [] if batch_transforms is None else batch_transforms
+        self.on_device = on_device
+
+    def columns(self):
+        return self.column_transforms.keys()
+
+    def transform_column(self, column, value):
+        """
+        Apply the transforms of column to value (a tensor or a Variable), in place when possible.
+        :return: the transformed value.
+        """
+        if column not in self.column_transforms:
+            return value
+        tensor = _data(value)
+        scale, shift = 1.0, 0.0
+        for transform in self.column_transforms[column]:
+            coefficients = transform.affine(tensor)
+            if coefficients is None:
+                tensor = self._apply_affine(tensor, scale, shift)
+                scale, shift = 1.0, 0.0
+                tensor = transform.apply(tensor)
+            else:
+                # fuse (x*scale+shift)*a+b into x*(scale*a)+(shift*a+b):
+                a, b = coefficients
+                scale, shift = scale * a, shift * a + b
+        tensor = self._apply_affine(tensor, scale, shift)
+        if isinstance(value, Variable):
+            if tensor is not value.data:
+                value.data = tensor
+            return value
+        return tensor
+
+    def _apply_affine(self, tensor, scale, shift):
+        if torch.is_tensor(scale) or scale != 1.0:
+            tensor.mul_(scale)
+        if torch.is_tensor(shift) or shift != 0.0:
+            tensor.add_(shift)
+        return tensor
+
+    def transform_batch(self, data_dict):
+        for batch_transform in self.batch_transforms:
+            data_dict = batch_transform(data_dict)
+        return data_dict
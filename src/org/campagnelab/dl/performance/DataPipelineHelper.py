@@ -0,0 +1,61 @@
+import time
+from threading import Lock
+
+from org.campagnelab.dl.performance.PerformanceEstimator import PerformanceEstimator
+
+
+class DataPipelineHelper(PerformanceEstimator):
+    """
+        Record the time spent in each stage of the data pipeline (dataset read, collate, recode, copy to the GPU,
+        producers waiting on full queues, consumer waiting on empty queues) and the number of examples delivered
+        per second. Stage times are summed over all the threads of the pipeline, in seconds.
+    """
+    stages = ["read", "collate", "recode", "h2d", "producer_wait", "consumer_wait"]
+
+    def __init__(self, prefix="train_"):
+        self.prefix = prefix
+        self.lock = Lock()
+        self.init_performance_metrics()
+
+    def init_performance_metrics(self):
+        with self.lock:
+            self.stage_times = {stage: 0.0 for stage in self.stages}
+            self.num_examples = 0
+            self.start_time = time.time()
+            self.end_time = self.start_time
+
+    def observe_stage(self, stage, seconds):
+        with self.lock:
+            self.stage_times[stage] += seconds
+
+    def observe_examples(self, num_examples):
+        with self.lock:
+            self.num_examples += num_examples
+            self.end_time = time.time()
+
+    def examples_per_second(self):
+        elapsed = self.end_time - self.start_time
+        return self.num_examples / elapsed if elapsed > 0 else float('nan')
+
+    def metric_names(self):
+        return [self.prefix + stage + "_time" for stage in self.stages] + [self.prefix + "examples_per_sec"]
+
+    def estimates_of_metric(self):
+        with self.lock:
+            return [self.stage_times[stage] for stage in self.stages] + [self.examples_per_second()]
+
+    def get_metric(self, metric_name):
+        names = self.metric_names()
+        if metric_name in names:
+            return self.estimates_of_metric()[names.index(metric_name)]
+        return None
+
+    def observe_performance_metric(self, iteration, loss, outputs, targets):
+        # stages are observed by the data providers.
+        pass
+
+    def progress_message(self):
+        """ Return a message suitable for logging progress of the metrics."""
+        with self.lock:
+            return " ".join(["{}: {:.2f}s".format(stage, self.stage_times[stage]) for stage in self.stages] +
+                            ["examples/s: {:.1f}".format(self.examples_per_second())])
@@ -58,7 +58,7 @@ class Problem:
         """Returns the test DataSet."""
         return None
 
-    def loader_for_dataset(self, dataset):
+    def loader_for_dataset(self, dataset, shuffle=False, sampler_state=None):
         pass
 
     def train_loader(self):
@@ -69,11 +69,13 @@ class Problem:
         """Returns the torch dataloader over the test set. """
         pass
 
-    def train_loader_subset_range(self, start, end):
+    def train_loader_subset_range(self, start, end, sampler_state=None):
         """Returns the torch dataloader over the training set, shuffled,
-        but limited to the example range start-end."""
+        but limited to the example range start-end. When sampler_state is given (dictionary with keys seed,
+        epoch and position), the shuffle is determined by seed and epoch and iteration starts at position."""
         if start==0:
-            return self.loader_for_dataset(SmallerDataset(delegate=self.train_set(), new_size=end),shuffle=True)
+            return self.loader_for_dataset(SmallerDataset(delegate=self.train_set(), new_size=end),shuffle=True,
+                                           sampler_state=sampler_state)
         else:
             return self.train_loader_subset(range(start, end))
 
@@ -121,7 +123,7 @@ class Problem:
         else:
             return self.unlabeled_loader_subset(range(start,end))
 
-    def unlabeled_loader(self):
+    def unlabeled_loader(self, sampler_state=None):
         """Returns the torch dataloader over the regularization set (unsupervised examples only). """
         pass
 
@@ -3,10 +3,11 @@ from pathlib import Path
 
 import torch
 from torch.utils.data import DataLoader
+from torch.utils.data.dataloader import default_collate
 
 from org.campagnelab.dl.genotypetensors.VectorReader import VectorReader
 from org.campagnelab.dl.genotypetensors.genotype_pytorch_dataset import EmptyDataset, \
-    ListDataset
+    ListDataset, ResumableSampler, TimedDataset, TimedCollate
 from org.campagnelab.dl.problems.Problem import Problem
 
 
@@ -38,8 +39,9 @@ class SbiProblem(Problem):
     def unlabeled_set(self):
         return ListDataset(self.basename, "unlabeled", self.get_input_names())
 
-    def __init__(self, mini_batch_size, code, drop_last_batch=True, num_workers=0):
+    def __init__(self, mini_batch_size, code, drop_last_batch=True, num_workers=0, seed=0):
         super().__init__(mini_batch_size)
+        self.seed = seed
         self.basename = code[len(self.basename_prefix()):]
         self.num_workers = num_workers
         self.drop_last_batch = drop_last_batch
@@ -84,10 +86,10 @@ class SbiProblem(Problem):
         identified by the indices. """
         assert False, "Not support for text .vec files"
 
-    def unlabeled_loader(self):
+    def unlabeled_loader(self, sampler_state=None):
         dataset = self.unlabeled_set()
         use_shuffle = not isinstance(dataset, EmptyDataset)
-        return self.loader_for_dataset(dataset=dataset, shuffle=use_shuffle)
+        return self.loader_for_dataset(dataset=dataset, shuffle=use_shuffle, sampler_state=sampler_state)
 
     def unlabeled_loader_subset(self, indices):
         """Returns the torch dataloader over the unlabeled set, limiting to the examples
@@ -103,8 +105,18 @@ class SbiProblem(Problem):
 
         assert False, "Not support for text .vec files"
 
-    def loader_for_dataset(self, dataset, shuffle=False):
-        return iter(DataLoader(dataset=dataset, shuffle=shuffle, batch_size=self.mini_batch_size(),
+    def loader_for_dataset(self, dataset, shuffle=False, sampler_state=None):
+        """
+        Return an iterator over mini-batches of dataset.
+        :param shuffle: when True, visit the examples in a random order determined by the sampler seed and epoch.
+        :param sampler_state: optional dictionary with keys seed, epoch and position (see ResumableSampler). When
+        provided, iteration starts at position in the order defined by seed and epoch.
+        """
+        sampler = ResumableSampler(len(dataset), shuffle=shuffle, seed=self.seed)
+        if sampler_state is not None:
+            sampler.load_state_dict(sampler_state)
+        return iter(DataLoader(dataset=TimedDataset(dataset), sampler=sampler, batch_size=self.mini_batch_size(),
+                               collate_fn=TimedCollate(default_collate),
                                num_workers=self.num_workers, pin_memory=True, drop_last=self.drop_last_batch))
 
     def loss_function(self, output_name):
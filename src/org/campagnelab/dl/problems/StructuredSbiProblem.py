@@ -1,4 +1,6 @@
 import sys
+from collections.abc import Mapping
+from functools import partial
 from pathlib import Path
 
 import copy
@@ -9,19 +11,22 @@ from torchnet.dataset.dataset import Dataset
 
 from org.campagnelab.dl.genotypetensors.VectorReader import VectorReader
 from org.campagnelab.dl.genotypetensors.genotype_pytorch_dataset import GenotypeDataset, EmptyDataset, \
-    InterleaveDatasets, CyclicInterleavedDatasets, CachedGenotypeDataset, DispatchDataset
+    InterleaveDatasets, CyclicInterleavedDatasets, CachedGenotypeDataset, DispatchDataset, TimedDataset, TimedCollate, \
+    ResumableSampler, BucketingBatchSampler
 from org.campagnelab.dl.genotypetensors.structured.Datasets import StructuredGenotypeDataset
 from org.campagnelab.dl.problems.Problem import Problem
 from org.campagnelab.dl.problems.SbiProblem import SbiProblem
 
 
-def collate_sbi(batch):
-    """ For each batch, organize sbi messages in a list, returned as first element of the batch tuple"""
+def collate_sbi(batch, tensorizer=None):
+    """ For each batch, organize sbi messages in a list, returned as first element of the batch tuple.
+    When a tensorizer is given (see SbiTensorizer), the sbi messages are replaced by the tensors it extracts."""
     element = batch[0]
-    if isinstance(element[0], dict) and element[0]['type'] == "BaseInformation":
+    if isinstance(element[0], Mapping) and element[0]["type"] == "BaseInformation":
         # note that batch_element[1][1] drops the index of the example: batch_element[1][0] to
         # keep only softmaxGenotype and metaData.
-        data_map = {"sbi":[batch_element[0] for batch_element in batch]}
+        records = [batch_element[0] for batch_element in batch]
+        data_map = {"sbi": records if tensorizer is None else tensorizer(records)}
         example_indices = default_collate([batch_element[1][0] for batch_element in batch])
         elements_to_collate = []
         for batch_element in batch:
@@ -44,10 +49,21 @@ class StructSmallerDataset(Dataset):
     def __len__(self):
         return min(self.length, len(self.delegate))
 
+    def is_random_access(self):
+        return hasattr(self.delegate, "is_random_access") and self.delegate.is_random_access()
+
+    def record_lengths(self):
+        if not hasattr(self.delegate, "record_lengths"):
+            return None
+        lengths = self.delegate.record_lengths()
+        return None if lengths is None else lengths[0:len(self)]
+
     def __getitem__(self, idx):
         if idx < self.length:
             value = self.delegate[idx]
-            if idx==self.length-1:
+            # streamed datasets are read in order and end at the last index. Random access datasets may be read in
+            # any order, they stay open for the rest of the epoch:
+            if idx==self.length-1 and not self.is_random_access():
                 print("Closing Struct dataset.")
                 self.delegate.close()
             return value
@@ -59,6 +75,20 @@ class StructuredSbiGenotypingProblem(SbiProblem):
     """An SBI problem where the tensors are generated from structured messages directly from an SBI, and
     labels are loaded from the vec file. """
 
+    def __init__(self, mini_batch_size, code, drop_last_batch=True, num_workers=0, seed=0, extraction_shards=1,
+                 batch_budget=None):
+        """
+        :param extraction_shards: number of processes used to convert sbi files to json the first time they are read.
+        :param batch_budget: when set, records of similar lengths are batched together and the sum of the lengths
+        of the records of a batch (counts, NumberWithFrequency elements and bases) is kept under this budget (see
+        BucketingBatchSampler).
+        """
+        super().__init__(mini_batch_size, code, drop_last_batch=drop_last_batch, num_workers=num_workers, seed=seed)
+        self.extraction_shards = extraction_shards
+        self.batch_budget = batch_budget
+        # when set, sbi records are tensorized in the loaders (see SbiTensorizer):
+        self.tensorizer = None
+
     def name(self):
         return self.basename_prefix() + self.basename
 
@@ -72,36 +102,64 @@ class StructuredSbiGenotypingProblem(SbiProblem):
         return ["softmaxGenotype", "metaData"]
 
     def train_set(self):
-        return StructuredGenotypeDataset(self.basename + "-train", vector_names=["softmaxGenotype","metaData"])
+        return StructuredGenotypeDataset(self.basename + "-train", vector_names=["softmaxGenotype","metaData"],
+                                         extraction_shards=self.extraction_shards)
 
     def validation_set(self):
-        return StructuredGenotypeDataset(self.basename + "-validation",vector_names=["softmaxGenotype","metaData"])
+        return StructuredGenotypeDataset(self.basename + "-validation",vector_names=["softmaxGenotype","metaData"],
+                                         extraction_shards=self.extraction_shards)
 
     def test_set(self):
-        return StructuredGenotypeDataset(self.basename + "-test",vector_names=["softmaxGenotype","metaData"])
+        return StructuredGenotypeDataset(self.basename + "-test",vector_names=["softmaxGenotype","metaData"],
+                                         extraction_shards=self.extraction_shards)
 
     def unlabeled_set(self):
         if self.file_exists(self.basename + "-unlabeled.list") or \
                 (self.file_exists(self.basename + "-unlabeled.sbi") and
                  self.file_exists(self.basename + "-unlabeled.sbip")):
-            return StructuredGenotypeDataset(self.basename + "-unlabeled")
+            return StructuredGenotypeDataset(self.basename + "-unlabeled", extraction_shards=self.extraction_shards)
         else:
             return EmptyDataset()
 
-    def loader_for_dataset(self, dataset, shuffle=False):
-        return iter(DataLoader(dataset=dataset, shuffle=False, batch_size=self.mini_batch_size(),
-                               collate_fn=lambda batch: collate_sbi(batch),
-                               num_workers=0, pin_memory=False, drop_last=self.drop_last_batch))
-    def loader_subset_range(self,dataset, start, end):
-        """Returns the torch dataloader over the training set, shuffled,
-        but limited to the example range start-end."""
+    def loader_for_dataset(self, dataset, shuffle=False, sampler_state=None):
+        """
+        Return an iterator over mini-batches of dataset. Datasets backed by an indexed json cache are read in the
+        order of a ResumableSampler, with num_workers DataLoader workers. Other structured datasets are streamed
+        from the sbi-to-json process: they are read sequentially in the main process, shuffle and sampler_state
+        are ignored and iteration starts at the first example. When batch_budget is set and the lengths of the
+        records are known (record cache), batches group records of similar lengths (see BucketingBatchSampler).
+        """
+        collate_fn = TimedCollate(partial(collate_sbi, tensorizer=self.tensorizer))
+        lengths = dataset.record_lengths() if hasattr(dataset, "record_lengths") else None
+        if self.batch_budget is not None and lengths is not None and dataset.is_random_access():
+            batch_sampler = BucketingBatchSampler(lengths, self.mini_batch_size(), example_budget=self.batch_budget,
+                                                  drop_last=self.drop_last_batch, shuffle=shuffle, seed=self.seed)
+            if sampler_state is not None:
+                batch_sampler.load_state_dict(sampler_state)
+            return iter(DataLoader(dataset=TimedDataset(dataset), batch_sampler=batch_sampler, collate_fn=collate_fn,
+                                   num_workers=self.num_workers, pin_memory=False))
+        if hasattr(dataset, "is_random_access") and dataset.is_random_access():
+            sampler = ResumableSampler(len(dataset), shuffle=shuffle, seed=self.seed)
+            if sampler_state is not None:
+                sampler.load_state_dict(sampler_state)
+            num_workers = self.num_workers
+        else:
+            sampler = ResumableSampler(len(dataset))
+            num_workers = 0
+        return iter(DataLoader(dataset=TimedDataset(dataset), sampler=sampler, batch_size=self.mini_batch_size(),
+                               collate_fn=collate_fn,
+                               num_workers=num_workers, pin_memory=False, drop_last=self.drop_last_batch))
+
+    def loader_subset_range(self,dataset, start, end, shuffle=False, sampler_state=None):
+        """Returns the torch dataloader over the dataset, limited to the example range start-end."""
         if start==0:
-            return self.loader_for_dataset(StructSmallerDataset(delegate=dataset, new_size=end),shuffle=False)
+            return self.loader_for_dataset(StructSmallerDataset(delegate=dataset, new_size=end),shuffle=shuffle,
+                                           sampler_state=sampler_state)
         else:
             return self.train_loader_subset(range(start, end))
 
-    def train_loader_subset_range(self, start, end):
-        return self.loader_subset_range(self.train_set(),start,end)
+    def train_loader_subset_range(self, start, end, sampler_state=None):
+        return self.loader_subset_range(self.train_set(),start,end, shuffle=True, sampler_state=sampler_state)
 
     def validation_loader_subset_range(self, start, end):
         return self.loader_subset_range(self.validation_set(),start,end)